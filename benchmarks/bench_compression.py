@@ -0,0 +1,79 @@
+"""
+Benchmark compressing response exports, reporting the bytes on the wire and the CPU time spent
+generating and compressing the CSV for each content encoding. Exports are generated for course
+sizes from a discussion section to a large lecture, with a mix of multiple choice, numeric, and
+short free text answers.
+
+Usage: python -m benchmarks.bench_compression [--questions N] [--repeat N] [--seed N]
+"""
+
+import click
+import random
+import statistics
+import time
+
+from collections import deque
+from typing import List
+
+from nbforms_server.utils import compress_chunks, CONTENT_ENCODINGS, iter_csv
+
+
+COURSE_SIZES = [30, 300, 1500]
+
+WORDS = ["the", "mean", "is", "larger", "because", "of", "outliers", "sample", "variance", "data", "not", "sure"]
+
+
+def make_rows(n_users: int, n_questions: int, rng: random.Random) -> List[List[str]]:
+  """
+  Generate an export with usernames of ``n_users`` users' responses to ``n_questions`` questions,
+  some of which are unanswered.
+  """
+  header = ["user"] + [f"q{i:02d}" for i in range(n_questions)]
+  rows = [header]
+  for u in range(n_users):
+    row = [f"student{u:05d}@university.edu"]
+    for q in range(n_questions):
+      kind = q % 3
+      if rng.random() < 0.1:
+        row.append("")
+      elif kind == 0:
+        row.append(rng.choice("ABCD"))
+      elif kind == 1:
+        row.append(str(round(rng.gauss(50, 15), 2)))
+      else:
+        row.append(" ".join(rng.choices(WORDS, k=rng.randint(3, 12))))
+    rows.append(row)
+
+  return rows
+
+
+@click.command()
+@click.option("--questions", default=30, help="Number of questions per notebook")
+@click.option("--repeat", default=5, help="Number of times to time each encoding")
+@click.option("--seed", default=42, help="Random seed for the generated responses")
+def main(questions, repeat, seed):
+  rng = random.Random(seed)
+
+  click.echo(f"{'users':>6} {'encoding':>9} {'bytes':>10} {'ratio':>6} {'cpu ms':>8}")
+  for n_users in COURSE_SIZES:
+    rows = make_rows(n_users, questions, rng)
+    raw = sum(len(c) for c in iter_csv(rows))
+
+    for encoding in ["identity", *CONTENT_ENCODINGS]:
+      def export():
+        chunks = iter_csv(rows)
+        return compress_chunks(chunks, encoding) if encoding != "identity" else chunks
+
+      size = sum(len(c) for c in export())
+      times = []
+      for _ in range(repeat):
+        start = time.process_time()
+        deque(export(), maxlen=0)
+        times.append(time.process_time() - start)
+
+      click.echo(
+        f"{n_users:>6} {encoding:>9} {size:>10} {raw / size:>6.1f} {statistics.median(times) * 1000:>8.1f}")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,122 @@
+"""
+Benchmark exporting a notebook's responses to CSV at 1k, 10k and 100k responses, comparing the
+column-projected streaming export (``iter_responses`` and ``iter_csv``) with the previous ORM-based
+``export_responses`` and ``to_csv``. Reports wall time and peak memory (as traced by
+``tracemalloc``).
+
+Usage: python -m benchmarks.bench_export [--questions N]
+"""
+
+import click
+import datetime as dt
+import os
+import tempfile
+import time
+import tracemalloc
+
+from collections import deque
+from sqlalchemy import insert, select
+from typing import Dict, List
+
+from nbforms_server import create_app
+from nbforms_server.models import db, iter_responses, Notebook, Response, User
+from nbforms_server.utils import iter_csv, to_csv
+
+
+SIZES = [1_000, 10_000, 100_000]
+
+
+def legacy_export_responses(session, notebook, req_questions):
+  """
+  Export responses the way ``export_responses`` did before the column-projected query: load every
+  ``Response`` and lazy-load its ``User``.
+  """
+  stmt = select(Response).where(Response.notebook_id == notebook.id)
+  responses = session.scalars(stmt).all()
+
+  questions = set()
+  by_user_and_question: Dict[int, Dict[str, Response]] = {}
+  users_by_username: Dict[str, User] = {}
+  for r in responses:
+    questions.add(r.question_identifier)
+    by_user_and_question.setdefault(r.user_id, {})[r.question_identifier] = r
+    users_by_username[r.user.username] = r.user
+
+  questions = sorted(questions)
+  rows: List[List[str]] = [["user"] + questions]
+  for un in sorted(users_by_username.keys()):
+    user_res = by_user_and_question[users_by_username[un].id]
+    rows.append([un] + [user_res[q].response if q in user_res else "" for q in questions])
+
+  return rows
+
+
+def seed(app, size, n_questions):
+  """
+  Create a notebook with ``size`` responses spread over ``n_questions`` questions.
+  """
+  n_users = max(1, size // n_questions)
+  with app.app_context():
+    nb = Notebook(identifier=f"nb{size}")
+    db.session.add(nb)
+    db.session.flush()
+
+    user_ids = db.session.scalars(
+      insert(User).returning(User.id),
+      [{"username": f"u{size}_{i}", "password_hash": ""} for i in range(n_users)],
+    ).all()
+
+    now = dt.datetime.now()
+    db.session.execute(insert(Response), [
+      {
+        "user_id": user_ids[i // n_questions],
+        "notebook_id": nb.id,
+        "question_identifier": f"q{i % n_questions}",
+        "response": f"response {i}",
+        "timestamp": now,
+      } for i in range(size)
+    ])
+    db.session.commit()
+
+
+def measure(fn):
+  """
+  Call ``fn``, returning its wall time in seconds and peak traced memory in MB.
+  """
+  tracemalloc.start()
+  start = time.perf_counter()
+  fn()
+  elapsed = time.perf_counter() - start
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return elapsed, peak / 2 ** 20
+
+
+@click.command()
+@click.option("--questions", default=20, help="Number of questions per notebook")
+def main(questions):
+  with tempfile.TemporaryDirectory() as tmp:
+    app = create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(tmp, 'bench.db')}"})
+
+    click.echo(f"{'responses':>10} {'export':>8} {'time s':>8} {'peak MB':>8}")
+    for size in SIZES:
+      seed(app, size, questions)
+
+      with app.app_context():
+        nb = db.session.query(Notebook).filter_by(identifier=f"nb{size}").one()
+
+        def legacy():
+          to_csv(legacy_export_responses(db.session, nb, []))
+
+        def streaming():
+          rows, _ = iter_responses(db.session, nb, [], usernames=True)
+          deque(iter_csv(rows), maxlen=0)
+
+        for name, fn in [("legacy", legacy), ("stream", streaming)]:
+          db.session.expunge_all()
+          elapsed, peak = measure(fn)
+          click.echo(f"{size:>10} {name:>8} {elapsed:>8.3f} {peak:>8.1f}")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,251 @@
+"""
+Microbenchmarks of the stages of exporting a notebook's responses (as for ``/data`` and the
+``reports responses`` command) over in-memory DBs of 100 to 100,000 responses with varying
+sparsity. The density of a notebook is the fraction of its questions that each user has answered, so
+sparser notebooks have more users (and so more rows) for the same number of responses.
+
+Each stage is timed separately on the output of the stage before it:
+
+* ``query``: executing ``export_statement`` and fetching every row
+* ``pivot``: pivoting the rows into one row per user with ``iter_user_rows``
+* ``hash``: the same with pseudonymized usernames (``user_hashes=True``)
+* ``shuffle``: shuffling the pseudonymized rows
+* ``to_csv`` and ``iter_csv``: rendering the rows as CSV
+* ``export``: the whole streamed export, ``iter_responses`` and ``iter_csv``
+
+Each stage is repeated until a sample takes at least ``--min-time`` seconds and the median of
+``--repeat`` samples is reported with its spread (the interquartile range as a percentage of the
+median), along with the peak memory allocated by the stage as traced by ``tracemalloc`` in a
+separate run. ``compare`` compares two JSON results and exits with status 1 if any stage regressed,
+so that results can gate refactors of the export path.
+
+Usage:
+  python -m benchmarks.bench_export_stages run [--size N ...] [--density D ...] [--questions N]
+    [--stage NAME ...] [--repeat N] [--min-time SECONDS] [--seed N] [--output FILE]
+  python -m benchmarks.bench_export_stages compare BASELINE RESULTS [--threshold PERCENT]
+"""
+
+import click
+import datetime as dt
+import gc
+import json
+import math
+import random
+import statistics
+import time
+import tracemalloc
+
+from collections import deque
+from sqlalchemy import insert
+from typing import Any, Callable, Dict, List, Tuple
+
+from nbforms_server import create_app
+from nbforms_server.models import db, export_statement, iter_responses, iter_user_rows, Notebook, Response, User
+from nbforms_server.utils import iter_csv, to_csv
+
+from .common import compare_results, percentile, report_comparison, result_metadata
+
+
+SIZES = [100, 1_000, 10_000, 100_000]
+
+DENSITIES = [1.0, 0.5, 0.1]
+
+STAGES = ["query", "pivot", "hash", "shuffle", "to_csv", "iter_csv", "export"]
+
+COMPARED_METRICS = {
+  "median_ms": -1,
+  "peak_mb": -1,
+}
+"""the metrics compared by ``compare``, mapped to -1 since lower is better for each"""
+
+COMPARISON_KEYS = ["size", "density", "stage"]
+"""the keys that identify a stage's results when comparing them"""
+
+COMPARISON_COLUMNS = [("size", "responses", 10, ""), ("density", "density", 8, ".2f"), ("stage", "stage", 9, "")]
+"""the columns that identify a stage in the output of ``compare``"""
+
+
+def seed_notebook(size: int, density: float, n_questions: int, rng: random.Random) -> Tuple[Notebook, int]:
+  """
+  Create a notebook with ``size`` responses to ``n_questions`` questions, where each user has
+  answered a random ``density`` fraction of the questions, returning it and its number of users.
+  Must be called in an app context.
+  """
+  per_user = max(1, round(n_questions * density))
+  n_users = math.ceil(size / per_user)
+
+  nb = Notebook(identifier=f"nb{size}_{density}")
+  db.session.add(nb)
+  db.session.flush()
+
+  user_ids = db.session.scalars(
+    insert(User).returning(User.id),
+    [{"username": f"u{size}_{density}_{i}", "password_hash": ""} for i in range(n_users)],
+  ).all()
+
+  now = dt.datetime.now()
+  responses = []
+  for user_id in user_ids:
+    for q in sorted(rng.sample(range(n_questions), per_user)):
+      responses.append({
+        "user_id": user_id,
+        "notebook_id": nb.id,
+        "question_identifier": f"q{q}",
+        "response": f"response {len(responses)}",
+        "timestamp": now,
+      })
+
+  db.session.execute(insert(Response), responses[:size])
+  db.session.commit()
+  return nb, n_users
+
+
+def make_stages(nb: Notebook) -> Dict[str, Callable[[], Any]]:
+  """
+  Return functions that run each stage of exporting ``nb``'s responses. The input of each stage is
+  computed up front so that only the stage itself is timed.
+  """
+  stmt = export_statement(nb.id, [])
+  results = db.session.execute(stmt).all()
+  questions = sorted({r[2] for r in results})
+  header = ["user"] + questions
+  rows = [header] + list(iter_user_rows(results, questions, usernames=True))
+  hashed_rows = list(iter_user_rows(results, questions, user_hashes=True))
+
+  def export():
+    rows, _ = iter_responses(db.session, nb, [], user_hashes=True)
+    deque(iter_csv(rows), maxlen=0)
+
+  return {
+    "query": lambda: db.session.execute(stmt).all(),
+    "pivot": lambda: deque(iter_user_rows(results, questions, usernames=True), maxlen=0),
+    "hash": lambda: deque(iter_user_rows(results, questions, user_hashes=True), maxlen=0),
+    "shuffle": lambda: random.shuffle(hashed_rows),
+    "to_csv": lambda: to_csv(rows),
+    "iter_csv": lambda: deque(iter_csv(rows), maxlen=0),
+    "export": export,
+  }
+
+
+def time_stage(fn: Callable[[], Any], repeat: int, min_time: float) -> Tuple[List[float], int]:
+  """
+  Time ``fn``, returning ``repeat`` samples of the mean seconds per call and the number of calls per
+  sample, which is chosen so that each sample takes at least ``min_time`` seconds.
+  """
+  fn()  # warm up
+  number = 1
+  while True:
+    start = time.perf_counter()
+    for _ in range(number):
+      fn()
+    if time.perf_counter() - start >= min_time:
+      break
+    number *= 2
+
+  samples = []
+  for _ in range(repeat):
+    gc.collect()
+    start = time.perf_counter()
+    for _ in range(number):
+      fn()
+    samples.append((time.perf_counter() - start) / number)
+
+  return samples, number
+
+
+def peak_memory(fn: Callable[[], Any]) -> float:
+  """
+  Return the peak memory in MB allocated by a call to ``fn``, as traced by ``tracemalloc``.
+  """
+  gc.collect()
+  tracemalloc.start()
+  try:
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  return peak / 2 ** 20
+
+
+@click.group()
+def cli():
+  pass
+
+
+@cli.command()
+@click.option("--size", "sizes", multiple=True, type=int, default=SIZES, show_default=True, help="Numbers of responses")
+@click.option("--density", "densities", multiple=True, type=click.FloatRange(0, 1, min_open=True), default=DENSITIES, show_default=True, help="Fractions of the questions answered by each user")
+@click.option("--questions", default=20, show_default=True, help="Number of questions per notebook")
+@click.option("--stage", "stages", multiple=True, type=click.Choice(STAGES), help="Stages to time (defaults to all)")
+@click.option("--repeat", default=7, show_default=True, help="Number of samples of each stage; the median is reported")
+@click.option("--min-time", default=0.05, show_default=True, help="Minimum number of seconds per sample")
+@click.option("--seed", default=42, show_default=True, help="Random seed for the seeded responses and shuffles")
+@click.option("--output", type=click.File("w"), help="File to write the results to as JSON")
+def run(sizes, densities, questions, stages, repeat, min_time, seed, output):
+  """
+  Seed a notebook for each size and density and time each stage of exporting it.
+  """
+  stages = [s for s in STAGES if not stages or s in stages]
+  results: Dict[str, Any] = result_metadata({
+    "questions": questions,
+    "repeat": repeat,
+    "min_time": min_time,
+    "seed": seed,
+  })
+  results["stages"] = []
+
+  rng = random.Random(seed)
+  random.seed(seed)
+  app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+
+  click.echo(
+    f"{'responses':>10} {'density':>8} {'users':>7} {'stage':>9} {'median ms':>10} {'min ms':>9} "
+    f"{'spread':>7} {'peak MB':>8}")
+  with app.app_context():
+    for size in sizes:
+      for density in densities:
+        nb, n_users = seed_notebook(size, density, questions, rng)
+        fns = make_stages(nb)
+
+        for stage in stages:
+          samples, number = time_stage(fns[stage], repeat, min_time)
+          median = statistics.median(samples)
+          spread = (percentile(samples, 75) - percentile(samples, 25)) / median if median else 0.0
+          s = {
+            "size": size,
+            "density": density,
+            "users": n_users,
+            "stage": stage,
+            "median_ms": median * 1000,
+            "min_ms": min(samples) * 1000,
+            "spread": spread,
+            "calls_per_sample": number,
+            "peak_mb": peak_memory(fns[stage]),
+          }
+          results["stages"].append(s)
+          click.echo(
+            f"{size:>10} {density:>8.2f} {n_users:>7} {stage:>9} {s['median_ms']:>10.3f} "
+            f"{s['min_ms']:>9.3f} {spread:>7.1%} {s['peak_mb']:>8.2f}")
+
+        db.session.expunge_all()
+
+  if output is not None:
+    json.dump(results, output, indent=2)
+    output.write("\n")
+
+
+@cli.command()
+@click.argument("baseline", type=click.File())
+@click.argument("current", type=click.File())
+@click.option("--threshold", default=10.0, show_default=True, help="Percent increase in a metric that counts as a regression")
+def compare(baseline, current, threshold):
+  """
+  Compare the results CURRENT with BASELINE, exiting with status 1 if any stage regressed.
+  """
+  baseline, current = json.load(baseline), json.load(current)
+  rows = compare_results(baseline, current, "stages", COMPARISON_KEYS, COMPARED_METRICS, threshold)
+  report_comparison(baseline, current, rows, COMPARISON_COLUMNS)
+
+
+if __name__ == "__main__":
+  cli()
@@ -0,0 +1,86 @@
+"""
+Benchmark the export formats on a full-semester attendance report, reporting the size of each
+export, the time to produce it, and the time to load it into a pandas ``DataFrame`` (with the
+timestamps parsed, which CSV and NDJSON need to be told to do). Requires pandas and pyarrow.
+
+Usage: python -m benchmarks.bench_formats [--students N] [--lectures N] [--repeat N]
+"""
+
+import click
+import datetime as dt
+import io
+import pandas as pd
+import pyarrow as pa
+import random
+import statistics
+import time
+
+from typing import Callable, List
+
+from nbforms_server.formats import EXPORT_FORMATS, iter_export
+from nbforms_server.models import AttendanceSubmission
+
+
+READERS = {
+  "csv": lambda buf: pd.read_csv(buf, parse_dates=["timestamp"]),
+  "ndjson": lambda buf: pd.read_json(buf, lines=True, convert_dates=["timestamp"]),
+  "arrow": lambda buf: pa.ipc.open_stream(buf).read_pandas(),
+  "parquet": lambda buf: pd.read_parquet(buf),
+}
+"""functions that load each export format into a ``DataFrame``"""
+
+
+def make_rows(n_students: int, n_lectures: int, rng: random.Random) -> List[List]:
+  """
+  Generate an attendance report in which each student submits attendance for most lectures, and
+  sometimes more than once.
+  """
+  start = dt.datetime(2024, 1, 16, 10)
+  rows = [AttendanceSubmission.header_row()]
+  for lecture in range(n_lectures):
+    opened = start + dt.timedelta(days=lecture // 2 * 7 + lecture % 2 * 2)
+    for student in range(n_students):
+      for _ in range(rng.choices([0, 1, 2], [0.15, 0.8, 0.05])[0]):
+        timestamp = opened + dt.timedelta(seconds=rng.randrange(3600), microseconds=rng.randrange(10 ** 6))
+        rows.append([
+          len(rows),
+          student + 1,
+          f"student{student:05d}@university.edu",
+          f"lecture-{lecture + 1:02d}",
+          timestamp,
+          rng.random() < 0.95,
+        ])
+
+  return rows
+
+
+def median_time(fn: Callable, repeat: int) -> float:
+  """
+  Return the median wall time of ``repeat`` calls to ``fn`` in milliseconds.
+  """
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - start)
+  return statistics.median(times) * 1000
+
+
+@click.command()
+@click.option("--students", default=1500, help="Number of students in the course")
+@click.option("--lectures", default=30, help="Number of lectures in the semester")
+@click.option("--repeat", default=5, help="Number of times to time each step")
+def main(students, lectures, repeat):
+  rows = make_rows(students, lectures, random.Random(42))
+  click.echo(f"{len(rows) - 1} attendance submissions")
+
+  click.echo(f"{'format':>8} {'bytes':>10} {'write ms':>9} {'load ms':>8}")
+  for fmt in EXPORT_FORMATS:
+    data = b"".join(iter_export(rows, fmt))
+    write_ms = median_time(lambda: b"".join(iter_export(rows, fmt)), repeat)
+    load_ms = median_time(lambda: READERS[fmt](io.BytesIO(data)), repeat)
+    click.echo(f"{fmt:>8} {len(data):>10} {write_ms:>9.1f} {load_ms:>8.1f}")
+
+
+if __name__ == "__main__":
+  main()
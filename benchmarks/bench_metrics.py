@@ -0,0 +1,68 @@
+"""
+Benchmark the overhead of recording metrics, comparing the latency of ``/submit``, ``/data``, and
+``/stats`` requests made through the Flask test client with metrics disabled, enabled, and enabled
+with a metrics directory (as for a multi-worker server). The modes are interleaved request by
+request so that they see the same DB and cache state.
+
+Usage: python -m benchmarks.bench_metrics [--requests N] [--responses N]
+"""
+
+import click
+import os
+import statistics
+import tempfile
+import time
+
+from nbforms_server import create_app
+from nbforms_server.metrics import server_metrics
+from nbforms_server.models import db, User
+
+
+MODES = ["disabled", "enabled", "dir"]
+
+
+@click.command()
+@click.option("--requests", "n_requests", default=1000, help="Number of requests to time per endpoint and mode")
+@click.option("--responses", "n_responses", default=10, help="Number of responses per submission")
+def main(n_requests, n_responses):
+  with tempfile.TemporaryDirectory() as tmp:
+    metrics_dir = os.path.join(tmp, "metrics")
+    app = create_app({
+      "SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+      "METRICS": True,
+      "METRICS_DIR": metrics_dir,
+    })
+    with app.app_context():
+      db.session.add(User(username="u", password_hash="", api_key="key"))
+      db.session.commit()
+
+    client = app.test_client()
+    requests = {
+      "/submit": lambda i: client.post("/submit", json={
+        "api_key": "key",
+        "notebook": "nb",
+        "responses": [{"identifier": f"q{j}", "response": f"r{i}"} for j in range(n_responses)],
+      }),
+      "/data": lambda i: client.get("/data", json={"notebook": "nb"}),
+      "/stats": lambda i: client.get("/stats", json={"notebook": "nb"}),
+    }
+
+    click.echo(f"{'endpoint':>8} {'disabled ms':>12} {'enabled ms':>11} {'dir ms':>7} {'overhead':>9}")
+    for path, make_request in requests.items():
+      times = {m: [] for m in MODES}
+      for i in range(n_requests):
+        for mode in MODES:
+          server_metrics.enabled = mode != "disabled"
+          server_metrics.directory = metrics_dir if mode == "dir" else None
+          start = time.perf_counter()
+          with make_request(i) as res:
+            res.get_data()
+          times[mode].append(time.perf_counter() - start)
+
+      base, enabled, with_dir = (statistics.median(times[m]) * 1000 for m in MODES)
+      overhead = (max(enabled, with_dir) - base) / base * 100
+      click.echo(f"{path:>8} {base:>12.3f} {enabled:>11.3f} {with_dir:>7.3f} {overhead:>8.1f}%")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,96 @@
+"""
+Benchmark computing a notebook's response statistics at 1k, 10k and 100k responses, comparing
+``get_response_stats`` (``GROUP BY`` in the DB) with counting the answers in a full export, which is
+what clients had to do with ``/data``. The questions are multiple choice except for ``--free-text``
+of them, whose answers are all distinct.
+
+Usage: python -m benchmarks.bench_stats [--questions N] [--free-text N] [--repeat N]
+"""
+
+import click
+import datetime as dt
+import os
+import statistics
+import tempfile
+import time
+
+from collections import Counter
+from sqlalchemy import insert
+
+from nbforms_server import create_app
+from nbforms_server.models import db, export_responses, get_response_stats, Notebook, Response, User
+
+
+SIZES = [1_000, 10_000, 100_000]
+
+CHOICES = ["a", "b", "c", "d"]
+
+
+def seed(app, size, n_questions, n_free_text):
+  """
+  Create a notebook with ``size`` responses spread over ``n_questions`` questions, of which the
+  first ``n_free_text`` are free text and the rest are multiple choice.
+  """
+  n_users = max(1, size // n_questions)
+  with app.app_context():
+    nb = Notebook(identifier=f"nb{size}")
+    db.session.add(nb)
+    db.session.flush()
+
+    user_ids = db.session.scalars(
+      insert(User).returning(User.id),
+      [{"username": f"u{size}_{i}", "password_hash": ""} for i in range(n_users)],
+    ).all()
+
+    now = dt.datetime.now()
+    db.session.execute(insert(Response), [
+      {
+        "user_id": user_ids[i // n_questions],
+        "notebook_id": nb.id,
+        "question_identifier": f"q{i % n_questions}",
+        "response": f"response {i}" if i % n_questions < n_free_text else CHOICES[i // n_questions % len(CHOICES)],
+        "timestamp": now,
+      } for i in range(size)
+    ])
+    db.session.commit()
+
+
+def export_stats(session, notebook):
+  """
+  Count the answers to each question from a full export of the notebook's responses.
+  """
+  rows, _ = export_responses(session, notebook, [])
+  return {q: Counter(answers) for q, *answers in zip(*rows)}
+
+
+@click.command()
+@click.option("--questions", default=10, help="Number of questions per notebook")
+@click.option("--free-text", default=0, help="Number of free text questions per notebook")
+@click.option("--repeat", default=5, help="Number of times to time each method")
+def main(questions, free_text, repeat):
+  with tempfile.TemporaryDirectory() as tmp:
+    app = create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(tmp, 'bench.db')}"})
+
+    click.echo(f"{'responses':>10} {'method':>8} {'median ms':>10}")
+    for size in SIZES:
+      seed(app, size, questions, free_text)
+
+      with app.app_context():
+        nb = db.session.query(Notebook).filter_by(identifier=f"nb{size}").one()
+        methods = [
+          ("export", lambda: export_stats(db.session, nb)),
+          ("stats", lambda: get_response_stats(db.session, nb.id, [])),
+          ("top 10", lambda: get_response_stats(db.session, nb.id, [], max_answers=10)),
+        ]
+        for name, fn in methods:
+          times = []
+          for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+
+          click.echo(f"{size:>10} {name:>8} {statistics.median(times) * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+  main()
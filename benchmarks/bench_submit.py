@@ -0,0 +1,77 @@
+"""
+Benchmark the latency of writing a single ``/submit`` payload to the DB, comparing the bulk upsert
+path (``upsert_responses``) with the previous per-response ``get_or_create`` loop.
+
+Usage: python -m benchmarks.bench_submit [--repeat N]
+"""
+
+import click
+import datetime as dt
+import os
+import statistics
+import tempfile
+import time
+
+from nbforms_server import create_app
+from nbforms_server.models import db, get_or_create, Notebook, Response, upsert_responses, User
+
+
+SIZES = [1, 10, 100, 1000]
+
+
+def legacy_submit(session, user, notebook, responses):
+  """
+  Write responses one at a time with ``get_or_create``, as ``/submit`` did before bulk upserts.
+  """
+  for q, r, ts in responses:
+    response = get_or_create(session, Response, user=user, notebook=notebook, question_identifier=q)
+    response.response = r
+    response.timestamp = ts
+    session.add(response)
+
+
+def bulk_submit(session, user, notebook, responses):
+  """
+  Write responses with ``upsert_responses``.
+  """
+  upsert_responses(session, user.id, notebook.id, responses)
+
+
+def time_submissions(app, submit, size, repeat):
+  """
+  Time ``repeat`` submissions of ``size`` responses each, alternating between inserting new rows
+  and updating the rows written by the previous submission. Returns the latencies in ms.
+  """
+  latencies = []
+  with app.app_context():
+    user = User(username=f"{submit.__name__}_{size}", password_hash="")
+    notebook = Notebook(identifier=f"{submit.__name__}_{size}")
+    db.session.add_all([user, notebook])
+    db.session.commit()
+
+    for i in range(repeat):
+      # every other submission reuses the previous submission's questions
+      responses = [(f"q{i // 2}_{j}", f"response {i}", dt.datetime.now()) for j in range(size)]
+      start = time.perf_counter()
+      submit(db.session, user, notebook, responses)
+      db.session.commit()
+      latencies.append((time.perf_counter() - start) * 1000)
+
+  return latencies
+
+
+@click.command()
+@click.option("--repeat", default=20, help="Number of submissions to time at each size")
+def main(repeat):
+  with tempfile.TemporaryDirectory() as tmp:
+    app = create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(tmp, 'bench.db')}"})
+
+    click.echo(f"{'responses':>10} {'legacy p50 ms':>14} {'bulk p50 ms':>12} {'speedup':>8}")
+    for size in SIZES:
+      legacy = statistics.median(time_submissions(app, legacy_submit, size, repeat))
+      bulk = statistics.median(time_submissions(app, bulk_submit, size, repeat))
+      click.echo(f"{size:>10} {legacy:>14.2f} {bulk:>12.2f} {legacy / bulk:>7.1f}x")
+
+
+if __name__ == "__main__":
+  main()
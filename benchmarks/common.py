@@ -0,0 +1,333 @@
+"""Shared helpers for the nbforms server benchmarks"""
+
+import click
+import contextlib
+import datetime as dt
+import http.client
+import json
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from typing import Any, Callable, Dict, Iterator, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Result(NamedTuple):
+  """
+  The outcome of a single request made during a load test.
+  """
+
+  status: int
+  """the HTTP status code, or 0 if the request failed to complete"""
+
+  latency: float
+  """the request latency in seconds"""
+
+
+def free_port() -> int:
+  """
+  Return a TCP port on localhost that is not in use.
+  """
+  with socket.socket() as s:
+    s.bind(("127.0.0.1", 0))
+    return s.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 30):
+  """
+  Block until a server is accepting connections on ``port``.
+  """
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    with contextlib.suppress(OSError), socket.create_connection(("127.0.0.1", port), timeout=1):
+      return
+    time.sleep(0.1)
+  raise TimeoutError(f"server did not start listening on port {port}")
+
+
+@contextlib.contextmanager
+def run_server(
+  argv: List[str],
+  env: Optional[Dict[str, str]] = None,
+  port: Optional[int] = None,
+) -> Iterator[int]:
+  """
+  Run a server process from the repo root, yielding the port it listens on once it is accepting
+  connections. ``argv`` may contain ``{port}``, which is replaced with the port.
+  """
+  port = port or free_port()
+  proc = subprocess.Popen(
+    [a.format(port=port) for a in argv],
+    cwd = REPO_ROOT,
+    env = {**os.environ, "PYTHONPATH": REPO_ROOT, **(env or {})},
+    stdout = subprocess.DEVNULL,
+    stderr = subprocess.DEVNULL,
+  )
+  try:
+    wait_for_port(port)
+    yield port
+  finally:
+    proc.terminate()
+    proc.wait()
+
+
+def run_gunicorn(
+  workers: int,
+  env: Optional[Dict[str, str]] = None,
+  app: str = "nbforms_server.wsgi:app",
+  extra_args: Optional[List[str]] = None,
+):
+  """
+  Run the WSGI app under gunicorn with ``workers`` worker processes (see ``run_server``).
+  """
+  argv = [
+    sys.executable, "-m", "gunicorn",
+    "--workers", str(workers),
+    "--bind", "127.0.0.1:{port}",
+    *(extra_args or []),
+    app,
+  ]
+  return run_server(argv, env)
+
+
+def run_uvicorn(
+  workers: int,
+  env: Optional[Dict[str, str]] = None,
+  app: str = "nbforms_server.asgi:app",
+):
+  """
+  Run the ASGI app under uvicorn with ``workers`` worker processes (see ``run_server``).
+  """
+  argv = [
+    sys.executable, "-m", "uvicorn",
+    "--workers", str(workers),
+    "--host", "127.0.0.1",
+    "--port", "{port}",
+    "--no-access-log",
+    app,
+  ]
+  return run_server(argv, env)
+
+
+@contextlib.contextmanager
+def idle_connections(port: int, n: int) -> Iterator[List[socket.socket]]:
+  """
+  Open ``n`` connections to the server on ``port`` that each send the start of a request and then
+  go quiet, like clients on slow networks.
+  """
+  conns = []
+  try:
+    for _ in range(n):
+      s = socket.create_connection(("127.0.0.1", port))
+      s.sendall(b"POST /submit HTTP/1.1\r\nHost: localhost\r\n")
+      conns.append(s)
+    yield conns
+  finally:
+    for s in conns:
+      s.close()
+
+
+def request(
+  port: int,
+  method: str,
+  path: str,
+  body: Optional[dict] = None,
+  headers: Optional[Dict[str, str]] = None,
+) -> Tuple[int, bytes]:
+  """
+  Make an HTTP request to the server on ``port`` with a JSON body, returning the status and body.
+  """
+  conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+  try:
+    conn.request(
+      method,
+      path,
+      body = json.dumps(body) if body is not None else None,
+      headers = {"Content-Type": "application/json", **(headers or {})},
+    )
+    res = conn.getresponse()
+    return res.status, res.read()
+  finally:
+    conn.close()
+
+
+def run_load(
+  make_request: Callable[[int, int], int],
+  concurrency: int,
+  duration: float,
+) -> List[Result]:
+  """
+  Call ``make_request(client, i)`` (which should make the ``i``-th request for client number
+  ``client`` and return its status code) from ``concurrency`` threads in a closed loop for
+  ``duration`` seconds, returning the result of every request.
+  """
+  results: List[Result] = []
+  lock = threading.Lock()
+  deadline = time.monotonic() + duration
+
+  def client(c):
+    i = 0
+    while time.monotonic() < deadline:
+      start = time.perf_counter()
+      try:
+        status = make_request(c, i)
+      except OSError:
+        status = 0
+      latency = time.perf_counter() - start
+      with lock:
+        results.append(Result(status, latency))
+      i += 1
+
+  threads = [threading.Thread(target=client, args=(c,)) for c in range(concurrency)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+
+  return results
+
+
+def warm_up(port: int, workers: int, timeout: float = 60):
+  """
+  Block until all ``workers`` worker processes of the server on ``port`` have booted, by making
+  concurrent requests to ``/`` until they are all answered quickly.
+  """
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    results = run_load(lambda c, i: request(port, "GET", "/")[0], workers, 0.5)
+    if all(r.status == 200 and r.latency < 0.25 for r in results):
+      return
+  raise TimeoutError("server workers did not finish booting")
+
+
+def percentile(values: List[float], p: float) -> float:
+  """
+  Return the ``p``-th percentile of ``values`` using the nearest-rank method.
+  """
+  if not values:
+    return math.nan
+  values = sorted(values)
+  return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(results: List[Result], duration: float) -> Dict[str, float]:
+  """
+  Summarize the results of a load test: throughput, error rate, and latency percentiles (in ms).
+  """
+  latencies = [r.latency * 1000 for r in results]
+  errors = sum(1 for r in results if not 200 <= r.status < 400)
+  return {
+    "requests": len(results),
+    "rps": len(results) / duration,
+    "error_rate": errors / len(results) if results else math.nan,
+    "p50_ms": percentile(latencies, 50),
+    "p95_ms": percentile(latencies, 95),
+    "p99_ms": percentile(latencies, 99),
+  }
+
+
+def git_revision() -> Dict[str, Any]:
+  """
+  Return the commit that the repo is at and whether the working tree has uncommitted changes.
+  """
+  def git(*args):
+    return subprocess.run(["git", *args], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip()
+
+  return {"commit": git("rev-parse", "HEAD") or None, "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def result_metadata(params: Dict[str, Any]) -> Dict[str, Any]:
+  """
+  Return the header of a benchmark's JSON results: when it was run, on which commit, Python, and
+  number of CPUs, and with which parameters.
+  """
+  return {
+    "timestamp": dt.datetime.now().isoformat(),
+    "git": git_revision(),
+    "python": platform.python_version(),
+    "cpus": os.cpu_count(),
+    "params": params,
+  }
+
+
+def match_results(
+  baseline: Dict[str, Any],
+  current: Dict[str, Any],
+  rows_key: str,
+  keys: Sequence[str],
+) -> Iterator[Tuple[Dict[str, Any], Dict[str, Any]]]:
+  """
+  Yield each pair of a baseline row and a current row under ``rows_key`` in two sets of results
+  that have the same values of ``keys``.
+  """
+  base_rows = {tuple(r[k] for k in keys): r for r in baseline[rows_key]}
+  for r in current[rows_key]:
+    base = base_rows.get(tuple(r[k] for k in keys))
+    if base is not None:
+      yield base, r
+
+
+def compare_results(
+  baseline: Dict[str, Any],
+  current: Dict[str, Any],
+  rows_key: str,
+  keys: Sequence[str],
+  metrics: Mapping[str, int],
+  threshold: float,
+) -> List[Dict[str, Any]]:
+  """
+  Compare the rows under ``rows_key`` in two sets of results (see ``match_results``), returning a
+  row for each metric of each row in both with the relative change and whether it is a regression
+  of more than ``threshold`` percent. ``metrics`` maps each compared metric to 1 if higher is better
+  and -1 if lower is better.
+  """
+  rows = []
+  for base, r in match_results(baseline, current, rows_key, keys):
+    for metric, direction in metrics.items():
+      change = (r[metric] - base[metric]) / base[metric] * 100 if base[metric] else 0.0
+      rows.append({
+        **{k: r[k] for k in keys},
+        "metric": metric,
+        "baseline": base[metric],
+        "current": r[metric],
+        "change": change,
+        "regression": change * direction < -threshold,
+      })
+
+  return rows
+
+
+def report_comparison(
+  baseline: Dict[str, Any],
+  current: Dict[str, Any],
+  rows: List[Dict[str, Any]],
+  columns: Sequence[Tuple[str, str, int, str]],
+):
+  """
+  Print the rows returned by ``compare_results`` as a table and exit with status 1 if any of them
+  is a regression. ``columns`` lists the key, heading, width, and format spec of each column that
+  identifies a row.
+  """
+  if baseline["params"] != current["params"]:
+    click.echo("Warning: the results were run with different parameters", err=True)
+
+  headings = " ".join(f"{heading:>{width}}" for _, heading, width, _ in columns)
+  click.echo(f"{headings} {'metric':>10} {'baseline':>10} {'current':>10} {'change':>8}")
+  for r in rows:
+    keys = " ".join(f"{r[key]:>{width}{spec}}" for key, _, width, spec in columns)
+    flag = "  REGRESSION" if r["regression"] else ""
+    click.echo(
+      f"{keys} {r['metric']:>10} {r['baseline']:>10.3f} {r['current']:>10.3f} "
+      f"{r['change']:>+7.1f}%{flag}")
+
+  regressions = sum(r["regression"] for r in rows)
+  click.echo(f"{regressions} regressions ({baseline['git']['commit']} -> {current['git']['commit']})")
+  sys.exit(1 if regressions else 0)
@@ -0,0 +1,225 @@
+"""
+A reproducible load test of the HTTP API. ``run`` seeds a synthetic course through the models,
+drives ``/submit``, ``/attendance``, ``/data`` and ``/auth`` in turn at each concurrency against
+gunicorn, and reports the throughput, error rate and latency percentiles of each scenario and the
+size of the DB, optionally as JSON. Each scenario is run several times and the median of each
+metric is reported, so that results are stable enough to compare. ``compare`` compares two JSON
+results (e.g. from the commits before and after a change) and exits with status 1 if any scenario
+regressed.
+
+Usage:
+  python -m benchmarks.harness run [--users N] [--notebooks N] [--questions N] [--concurrency N ...]
+    [--duration SECONDS] [--repeat N] [--workers N] [--threads N] [--scenario NAME ...] [--output FILE]
+  python -m benchmarks.harness compare BASELINE RESULTS [--threshold PERCENT]
+"""
+
+import click
+import datetime as dt
+import json
+import os
+import random
+import statistics
+import tempfile
+
+from sqlalchemy import insert
+from typing import Any, Callable, Dict, List
+
+from nbforms_server import create_app
+from nbforms_server.models import db, hash_password, Notebook, record_responses, set_password_hasher, User
+from nbforms_server.passwords import ARGON2_PROFILES
+
+from .common import (
+  compare_results,
+  match_results,
+  report_comparison,
+  request,
+  result_metadata,
+  run_gunicorn,
+  run_load,
+  summarize,
+  warm_up,
+)
+
+
+PASSWORD = "password"
+"""the password of every seeded user"""
+
+SCENARIOS = ["submit", "attendance", "data", "auth"]
+"""the scenarios run by ``run``, in order; ``auth`` is last because logging in replaces API keys"""
+
+COMPARED_METRICS = {
+  "rps": 1,
+  "p50_ms": -1,
+  "p95_ms": -1,
+  "p99_ms": -1,
+}
+"""the metrics compared by ``compare``, mapped to 1 if higher is better and -1 if lower is better"""
+
+COMPARISON_KEYS = ["scenario", "concurrency"]
+"""the keys that identify a scenario's results when comparing them"""
+
+COMPARISON_COLUMNS = [("scenario", "scenario", 10, ""), ("concurrency", "clients", 8, "")]
+"""the columns that identify a scenario in the output of ``compare``"""
+
+
+def seed_course(uri: str, n_users: int, n_notebooks: int, n_questions: int, argon2_profile: str, seed: int):
+  """
+  Create ``n_users`` users named ``student0``, ``student1``, etc. with the password ``PASSWORD`` and
+  API keys ``key0``, ``key1``, etc., and ``n_notebooks`` notebooks named ``nb0``, ``nb1``, etc. with
+  attendance open, to each of which every user has responded to ``n_questions`` questions.
+  """
+  app = create_app({"SQLALCHEMY_DATABASE_URI": uri, "ARGON2_PROFILE": argon2_profile})
+  set_password_hasher(ARGON2_PROFILES[argon2_profile])
+  password_hash = hash_password(PASSWORD)
+  rng = random.Random(seed)
+
+  with app.app_context():
+    user_ids = db.session.scalars(insert(User).returning(User.id), [
+      {"username": f"student{i}", "password_hash": password_hash, "api_key": f"key{i}"}
+      for i in range(n_users)
+    ]).all()
+    notebooks = [Notebook(identifier=f"nb{i}", attendance_open=True) for i in range(n_notebooks)]
+    db.session.add_all(notebooks)
+    db.session.flush()
+
+    now = dt.datetime.now()
+    for nb in notebooks:
+      for user_id in user_ids:
+        responses = [(f"q{q}", rng.choice("ABCD"), now) for q in range(n_questions)]
+        record_responses(db.session, user_id, nb.id, responses)
+      db.session.commit()
+
+
+def make_scenario(name: str, port: int, n_users: int, n_notebooks: int, n_questions: int) -> Callable[[int, int], int]:
+  """
+  Return a function that makes the ``i``-th request of client ``c`` in a scenario (see
+  ``run_load``). Client ``c`` acts as user ``c`` (modulo the number of users).
+  """
+  def make_request(c, i):
+    user = c % n_users
+    notebook = f"nb{(c + i) % n_notebooks}"
+    if name == "submit":
+      body = {
+        "api_key": f"key{user}",
+        "notebook": notebook,
+        "responses": [{"identifier": f"q{q}", "response": str(i)} for q in range(n_questions)],
+      }
+      return request(port, "POST", "/submit", body)[0]
+    elif name == "attendance":
+      return request(port, "POST", "/attendance", {"api_key": f"key{user}", "notebook": notebook})[0]
+    elif name == "data":
+      return request(port, "GET", "/data", {"notebook": notebook})[0]
+    elif name == "auth":
+      return request(port, "POST", "/auth", {"username": f"student{user}", "password": PASSWORD})[0]
+    raise ValueError(f"Unknown scenario: {name}")
+
+  return make_request
+
+
+def db_size(path: str) -> int:
+  """
+  Return the size in bytes of a SQLite DB, including its write-ahead log.
+  """
+  return sum(os.path.getsize(p) for p in [path, f"{path}-wal"] if os.path.exists(p))
+
+
+@click.group()
+def cli():
+  pass
+
+
+@cli.command()
+@click.option("--users", default=200, show_default=True, help="Number of users in the course")
+@click.option("--notebooks", default=5, show_default=True, help="Number of notebooks in the course")
+@click.option("--questions", default=10, show_default=True, help="Number of questions per notebook")
+@click.option("--concurrency", multiple=True, type=int, default=[1, 16], show_default=True, help="Numbers of concurrent clients")
+@click.option("--duration", default=10.0, show_default=True, help="Number of seconds to run each scenario for")
+@click.option("--repeat", default=3, show_default=True, help="Number of times to run each scenario; the median of each metric is reported")
+@click.option("--workers", default=4, show_default=True, help="Number of gunicorn worker processes")
+@click.option("--threads", default=4, show_default=True, help="Number of threads per gunicorn worker")
+@click.option("--scenario", "scenarios", multiple=True, type=click.Choice(SCENARIOS), help="Scenarios to run (defaults to all)")
+@click.option("--argon2-profile", default="default", show_default=True, type=click.Choice(list(ARGON2_PROFILES)), help="argon2 profile of the server")
+@click.option("--seed", default=42, show_default=True, help="Random seed for the seeded responses")
+@click.option("--output", type=click.File("w"), help="File to write the results to as JSON")
+def run(users, notebooks, questions, concurrency, duration, repeat, workers, threads, scenarios, argon2_profile, seed, output):
+  """
+  Seed a synthetic course and load test each scenario at each concurrency.
+  """
+  scenarios = [s for s in SCENARIOS if not scenarios or s in scenarios]
+  results: Dict[str, Any] = result_metadata({
+    "users": users,
+    "notebooks": notebooks,
+    "questions": questions,
+    "duration": duration,
+    "repeat": repeat,
+    "workers": workers,
+    "threads": threads,
+    "argon2_profile": argon2_profile,
+    "seed": seed,
+  })
+  results["scenarios"] = []
+
+  click.echo(f"{'scenario':>10} {'clients':>8} {'req/s':>8} {'errors':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+  with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, "bench.db")
+    uri = f"sqlite:///{path}"
+    seed_course(uri, users, notebooks, questions, argon2_profile, seed)
+    results["db_bytes_seeded"] = db_size(path)
+
+    env = {"NBFORMS_SERVER_SQLALCHEMY_DATABASE_URI": uri, "NBFORMS_SERVER_ARGON2_PROFILE": argon2_profile}
+    extra_args = ["--worker-class", "gthread", "--threads", str(threads)]
+    with run_gunicorn(workers, env, extra_args=extra_args) as port:
+      warm_up(port, workers)
+      for scenario in scenarios:
+        for clients in concurrency:
+          make_request = make_scenario(scenario, port, users, notebooks, questions)
+          runs = [summarize(run_load(make_request, clients, duration), duration) for _ in range(repeat)]
+          s = {k: statistics.median(r[k] for r in runs) for k in runs[0]}
+          results["scenarios"].append({"scenario": scenario, "concurrency": clients, **s})
+          click.echo(
+            f"{scenario:>10} {clients:>8} {s['rps']:>8.1f} {s['error_rate']:>8.2%} {s['p50_ms']:>8.1f} "
+            f"{s['p95_ms']:>8.1f} {s['p99_ms']:>8.1f}")
+
+    results["db_bytes"] = db_size(path)
+
+  click.echo(f"DB size: {results['db_bytes_seeded'] / 1e6:.1f}MB seeded, {results['db_bytes'] / 1e6:.1f}MB after load")
+  if output is not None:
+    json.dump(results, output, indent=2)
+    output.write("\n")
+
+
+def compare_scenarios(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> List[Dict[str, Any]]:
+  """
+  Compare the scenarios in two sets of results (see ``compare_results``). Any errors in a scenario
+  that had none is a regression whatever the threshold.
+  """
+  rows = compare_results(baseline, current, "scenarios", COMPARISON_KEYS, COMPARED_METRICS, threshold)
+  for base, s in match_results(baseline, current, "scenarios", COMPARISON_KEYS):
+    if s["error_rate"] > 0 and base["error_rate"] == 0:
+      rows.append({
+        "scenario": s["scenario"],
+        "concurrency": s["concurrency"],
+        "metric": "error_rate",
+        "baseline": 0,
+        "current": s["error_rate"],
+        "change": float("inf"),
+        "regression": True,
+      })
+
+  return rows
+
+
+@cli.command()
+@click.argument("baseline", type=click.File())
+@click.argument("current", type=click.File())
+@click.option("--threshold", default=10.0, show_default=True, help="Percent change in a metric that counts as a regression")
+def compare(baseline, current, threshold):
+  """
+  Compare the results CURRENT with BASELINE, exiting with status 1 if any scenario regressed.
+  """
+  baseline, current = json.load(baseline), json.load(current)
+  report_comparison(baseline, current, compare_scenarios(baseline, current, threshold), COMPARISON_COLUMNS)
+
+
+if __name__ == "__main__":
+  cli()
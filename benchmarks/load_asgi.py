@@ -0,0 +1,56 @@
+"""
+Load test ``/submit`` served by the WSGI app under gunicorn and by the ASGI app under uvicorn with
+the same number of worker processes and clients, while a number of idle clients hold connections
+open, reporting throughput, error rate and p99 latency.
+
+Usage: python -m benchmarks.load_asgi [--duration SECONDS] [--workers N] [--clients N] [--idle N]
+"""
+
+import click
+import os
+import tempfile
+
+from .common import idle_connections, request, run_gunicorn, run_load, run_uvicorn, summarize, warm_up
+from .load_submit import seed_users
+
+
+SERVERS = {
+  "wsgi": run_gunicorn,
+  "asgi": run_uvicorn,
+}
+
+
+@click.command()
+@click.option("--duration", default=10.0, help="Number of seconds to run each load test for")
+@click.option("--workers", default=4, help="Number of worker processes")
+@click.option("--clients", default=32, help="Number of concurrent active clients")
+@click.option("--idle", "idle_counts", multiple=True, type=int, default=[0, 100, 1_000], help="Numbers of idle clients to test")
+@click.option("--profile", default="fast", help="SQLite profile to use")
+def main(duration, workers, clients, idle_counts, profile):
+  click.echo(f"{'server':>6} {'idle':>6} {'req/s':>8} {'errors':>8} {'p99 ms':>8}")
+  for idle in idle_counts:
+    for name, run in SERVERS.items():
+      with tempfile.TemporaryDirectory() as tmp:
+        uri = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        env = {"NBFORMS_SERVER_SQLALCHEMY_DATABASE_URI": uri, "NBFORMS_SERVER_SQLITE_PROFILE": profile}
+        seed_users(uri, profile, clients)
+
+        with run(workers, env) as port:
+          warm_up(port, workers)
+
+          def submit(c, i):
+            status, _ = request(port, "POST", "/submit", {
+              "api_key": f"key{c}",
+              "notebook": f"nb{i % 5}",
+              "responses": [{"identifier": f"q{j}", "response": str(i)} for j in range(10)],
+            })
+            return status
+
+          with idle_connections(port, idle):
+            s = summarize(run_load(submit, clients, duration), duration)
+
+      click.echo(f"{name:>6} {idle:>6} {s['rps']:>8.1f} {s['error_rate']:>8.2%} {s['p99_ms']:>8.1f}")
+
+
+if __name__ == "__main__":
+  main()
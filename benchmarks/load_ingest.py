@@ -0,0 +1,58 @@
+"""
+Load test ``/submit`` with 50, 200 and 1,000 concurrent clients under gunicorn, with write-behind
+mode off (each request commits its own transaction) and on (requests are queued and written in
+batched transactions), reporting throughput, error rate and p99 latency.
+
+Usage: python -m benchmarks.load_ingest [--duration SECONDS] [--workers N] [--threads N]
+"""
+
+import click
+import os
+import tempfile
+
+from .common import request, run_gunicorn, run_load, summarize, warm_up
+from .load_submit import seed_users
+
+
+CLIENTS = [50, 200, 1_000]
+
+
+@click.command()
+@click.option("--duration", default=10.0, help="Number of seconds to run each load test for")
+@click.option("--workers", default=4, help="Number of gunicorn worker processes")
+@click.option("--threads", default=16, help="Number of threads per gunicorn worker")
+@click.option("--profile", default="fast", help="SQLite profile to use")
+def main(duration, workers, threads, profile):
+  click.echo(f"{'mode':>13} {'clients':>8} {'req/s':>8} {'errors':>8} {'p99 ms':>8}")
+  for write_behind in [False, True]:
+    for clients in CLIENTS:
+      with tempfile.TemporaryDirectory() as tmp:
+        uri = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        env = {
+          "NBFORMS_SERVER_SQLALCHEMY_DATABASE_URI": uri,
+          "NBFORMS_SERVER_SQLITE_PROFILE": profile,
+          "NBFORMS_SERVER_WRITE_BEHIND": "true" if write_behind else "false",
+          "NBFORMS_SERVER_WRITE_BEHIND_SPOOL_DIR": os.path.join(tmp, "spool"),
+        }
+        seed_users(uri, profile, clients)
+
+        extra_args = ["--worker-class", "gthread", "--threads", str(threads), "--backlog", "2048"]
+        with run_gunicorn(workers, env, extra_args=extra_args) as port:
+          warm_up(port, workers)
+
+          def submit(c, i):
+            status, _ = request(port, "POST", "/submit", {
+              "api_key": f"key{c}",
+              "notebook": f"nb{i % 5}",
+              "responses": [{"identifier": f"q{j}", "response": str(i)} for j in range(10)],
+            })
+            return status
+
+          s = summarize(run_load(submit, clients, duration), duration)
+
+      mode = "write-behind" if write_behind else "direct"
+      click.echo(f"{mode:>13} {clients:>8} {s['rps']:>8.1f} {s['error_rate']:>8.2%} {s['p99_ms']:>8.1f}")
+
+
+if __name__ == "__main__":
+  main()
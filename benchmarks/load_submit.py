@@ -0,0 +1,62 @@
+"""
+Load test ``/submit`` under gunicorn with 4 to 16 workers for each SQLite profile, reporting the
+rate of failed requests (which are mostly "database is locked" errors) and the p99 latency.
+
+Usage: python -m benchmarks.load_submit [--duration SECONDS] [--profile NAME ...]
+"""
+
+import click
+import os
+import tempfile
+
+from nbforms_server import create_app
+from nbforms_server.models import db, User
+
+from .common import request, run_gunicorn, run_load, summarize, warm_up
+
+
+WORKERS = [4, 8, 16]
+
+
+def seed_users(uri, profile, n):
+  """
+  Create ``n`` users with API keys ``key0``, ``key1``, etc. in the DB at ``uri``. The DB is created
+  with the SQLite profile ``profile``, since the journal mode is persisted in the DB file.
+  """
+  app = create_app({"SQLALCHEMY_DATABASE_URI": uri, "SQLITE_PROFILE": profile})
+  with app.app_context():
+    db.session.add_all(User(username=f"u{i}", password_hash="", api_key=f"key{i}") for i in range(n))
+    db.session.commit()
+
+
+@click.command()
+@click.option("--duration", default=10.0, help="Number of seconds to run each load test for")
+@click.option("--clients", default=32, help="Number of concurrent clients")
+@click.option("--profile", "profiles", multiple=True, default=["default", "fast"], help="SQLite profiles to test")
+def main(duration, clients, profiles):
+  click.echo(f"{'profile':>8} {'workers':>8} {'req/s':>8} {'errors':>8} {'p99 ms':>8}")
+  for profile in profiles:
+    for workers in WORKERS:
+      with tempfile.TemporaryDirectory() as tmp:
+        uri = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        env = {"NBFORMS_SERVER_SQLALCHEMY_DATABASE_URI": uri, "NBFORMS_SERVER_SQLITE_PROFILE": profile}
+        seed_users(uri, profile, clients)
+
+        with run_gunicorn(workers, env) as port:
+          warm_up(port, workers)
+
+          def submit(c, i):
+            status, _ = request(port, "POST", "/submit", {
+              "api_key": f"key{c}",
+              "notebook": f"nb{i % 5}",
+              "responses": [{"identifier": f"q{j}", "response": str(i)} for j in range(10)],
+            })
+            return status
+
+          s = summarize(run_load(submit, clients, duration), duration)
+
+      click.echo(f"{profile:>8} {workers:>8} {s['rps']:>8.1f} {s['error_rate']:>8.2%} {s['p99_ms']:>8.1f}")
+
+
+if __name__ == "__main__":
+  main()
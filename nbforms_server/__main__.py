@@ -2,28 +2,61 @@
 
 import click
 import csv
+import math
+import os
+import statistics
 import sys
+import time
 
+from argon2 import PasswordHasher
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from itertools import islice
 from sqlalchemy import create_engine, select
-from typing import IO, TYPE_CHECKING
+from typing import IO, List, Optional, TYPE_CHECKING
 
 from . import create_app
+from .cache import api_keys
 from .models import (
   AttendanceSubmission,
+  bump_cache_generation,
   db,
   export_responses,
   get_or_create,
+  get_response_stats,
+  hash_password,
   Notebook,
   Response,
+  ResponseLogEntry,
+  RESPONSES_GENERATION,
+  set_password_hasher,
+  upgrade_db,
+  upsert_users,
   User,
+  USERS_GENERATION,
 )
-from .utils import to_csv
+from .formats import EXPORT_FORMATS, iter_export
+from .passwords import ARGON2_PROFILES, get_argon2_parameters
+from .profiling import load_slow_requests
+from .snapshots import (
+  BackupProgress,
+  BackupStats,
+  create_snapshot,
+  get_sqlite_path,
+  restore_snapshot,
+  SNAPSHOT_STEP_PAGES,
+)
+from .utils import compress_chunks, CONTENT_ENCODINGS, to_csv
 
 if TYPE_CHECKING:
   from flask import Flask
   from sqlalchemy.orm import Session as SessionType
 
 
+MIN_PARALLEL_SEED_ROWS = 32
+"""the smallest batch of users whose passwords ``seed`` will hash in a process pool"""
+
+
 class Context:
   """
   A context object for managing things like the DB connection in the CLI.
@@ -114,7 +147,7 @@ def clear():
 @click.pass_obj
 def clear_all(ctx: Context, force: bool):
   """
-  Clear all response and attendance submission entries in the database.
+  Clear all response, response history, and attendance submission entries in the database.
   """
   if not force:
     if not click.confirm("Are you sure you want to delete everything?"):
@@ -123,7 +156,9 @@ def clear_all(ctx: Context, force: bool):
 
   with ctx.app.app_context():
     db.session.query(Response).delete()
+    db.session.query(ResponseLogEntry).delete()
     db.session.query(AttendanceSubmission).delete()
+    bump_cache_generation(db.session, RESPONSES_GENERATION)
     db.session.commit()
 
 
@@ -133,7 +168,8 @@ def clear_all(ctx: Context, force: bool):
 @click.pass_obj
 def clear_all(ctx: Context, username: str, force: bool):
   """
-  Clear all response and attendance submission entries for the user with username USERNAME.
+  Clear all response, response history, and attendance submission entries for the user with
+  username USERNAME.
   """
   if not force:
     if not click.confirm("Are you sure you want to delete this user's data?"):
@@ -146,9 +182,15 @@ def clear_all(ctx: Context, username: str, force: bool):
       raise ValueError(f"No such user: {username}")
 
     db.session.query(Response).filter_by(user=u).delete()
+    db.session.query(ResponseLogEntry).filter_by(user=u).delete()
     db.session.query(AttendanceSubmission).filter_by(user=u).delete()
+    bump_cache_generation(db.session, USERS_GENERATION)
+    bump_cache_generation(db.session, RESPONSES_GENERATION)
     db.session.commit()
 
+    if u.api_key:
+      api_keys.invalidate(u.api_key)
+
 
 @clear.command("notebook")
 @click.argument("notebook")
@@ -156,7 +198,8 @@ def clear_all(ctx: Context, username: str, force: bool):
 @click.pass_obj
 def clear_all(ctx: Context, notebook: str, force: bool):
   """
-  Clear all response and attendance submission entries for the notebook with identifier NOTEBOOK.
+  Clear all response, response history, and attendance submission entries for the notebook with
+  identifier NOTEBOOK.
   """
   if not force:
     if not click.confirm("Are you sure you want to delete this notebook's data?"):
@@ -166,53 +209,98 @@ def clear_all(ctx: Context, notebook: str, force: bool):
   with ctx.app.app_context():
     nb = ctx.maybe_get_or_create_notebook(notebook, False)
     db.session.query(Response).filter_by(notebook=nb).delete()
+    db.session.query(ResponseLogEntry).filter_by(notebook=nb).delete()
     db.session.query(AttendanceSubmission).filter_by(notebook=nb).delete()
+    bump_cache_generation(db.session, RESPONSES_GENERATION)
     db.session.commit()
 
 
 @cli.group("reports")
 def reports():
   """
-  Generate reports from the database.
+  Generate reports from the database. Reports are CSV files unless another format is selected with
+  --format; unlike CSV, the other formats preserve the types of values.
   """
   pass
 
 
+compress_option = click.option(
+  "--compress",
+  type=click.Choice(CONTENT_ENCODINGS),
+  help="Compress the report with this encoding",
+)
+"""an option for compressing a report"""
+
+format_option = click.option(
+  "--format",
+  "fmt",
+  type=click.Choice(list(EXPORT_FORMATS)),
+  default="csv",
+  show_default=True,
+  help="The format of the report",
+)
+"""an option for selecting the format of a report"""
+
+
+def write_report(dest: IO, rows: List[List], fmt: str, compress: Optional[str]):
+  """
+  Write a report, whose first row is the header, to ``dest`` in the export format ``fmt``,
+  compressing it with the content encoding ``compress`` if provided.
+  """
+  if fmt == "csv" and compress is None:
+    dest.write(to_csv(rows))
+    return
+
+  chunks = iter_export(rows, fmt)
+  if compress is not None:
+    chunks = compress_chunks(chunks, compress)
+
+  dest.flush()
+  for chunk in chunks:
+    dest.buffer.write(chunk)
+
+
 @reports.command("users")
 @click.argument("dest", type=click.File("w"), default=sys.stdout)
+@format_option
+@compress_option
 @click.pass_obj
-def reports_users(ctx: Context, dest: IO):
+def reports_users(ctx: Context, dest: IO, fmt: str, compress: Optional[str]):
   """
   Generate a CSV report of all users in the database and write it to DEST (or stdout if DEST is
   unsepcified).
   """
   with ctx.app.app_context():
     users = db.session.query(User).order_by(User.username).all()
-    csv = to_csv([User.header_row(), *(u.to_row() for u in users)])
+    rows = [User.header_row(), *(u.to_row() for u in users)]
 
-  dest.write(csv)
+  write_report(dest, rows, fmt, compress)
 
 
 @reports.command("notebooks")
 @click.argument("dest", type=click.File("w"), default=sys.stdout)
+@format_option
+@compress_option
 @click.pass_obj
-def reports_notebooks(ctx: Context, dest: IO):
+def reports_notebooks(ctx: Context, dest: IO, fmt: str, compress: Optional[str]):
   """
   Generate a CSV report of all notebooks in the database and write it to DEST (or stdout if DEST is
   unsepcified).
   """
   with ctx.app.app_context():
     nbs = db.session.query(Notebook).order_by(Notebook.identifier).all()
-    csv = to_csv([Notebook.header_row(), *(nb.to_row() for nb in nbs)])
+    rows = [Notebook.header_row(), *(nb.to_row() for nb in nbs)]
 
-  dest.write(csv)
+  write_report(dest, rows, fmt, compress)
 
 
 @reports.command("responses")
 @click.argument("notebook", required=True)
 @click.argument("dest", type=click.File("w"), default=sys.stdout)
+@format_option
+@compress_option
 @click.pass_obj
-def reports_responses(ctx: Context, notebook: str, dest: IO):
+def reports_responses(ctx: Context, notebook: str, dest: IO, fmt: str, compress: Optional[str]):
   """
   Generate a CSV report of all responses to notebook with identifier NOTEBOOK and write it to
   DEST (or stdout if DEST is unsepcified).
@@ -224,14 +312,67 @@ def reports_responses(ctx: Context, notebook: str, dest: IO):
   if err:
     raise ValueError(err)
 
-  dest.write(to_csv(rows))
+  write_report(dest, rows, fmt, compress)
+
+
+@reports.command("history")
+@click.argument("notebook", required=True)
+@click.argument("dest", type=click.File("w"), default=sys.stdout)
+@click.option("--user", "username", help="Only include responses from the user with this username")
+@format_option
+@compress_option
+@click.pass_obj
+def reports_history(ctx: Context, notebook: str, dest: IO, username: Optional[str], fmt: str, compress: Optional[str]):
+  """
+  Generate a CSV report of every response ever submitted to notebook with identifier NOTEBOOK,
+  including those that have since been replaced, and write it to DEST (or stdout if DEST is
+  unspecified).
+  """
+  with ctx.app.app_context():
+    nb = ctx.maybe_get_or_create_notebook(notebook, False)
+    query = db.session.query(ResponseLogEntry).filter_by(notebook=nb).join(User)
+    if username is not None:
+      query = query.filter(User.username == username)
+
+    entries = query.order_by(User.username, ResponseLogEntry.question_identifier, ResponseLogEntry.id).all()
+    rows = [ResponseLogEntry.header_row(), *(e.to_row() for e in entries)]
+
+  write_report(dest, rows, fmt, compress)
+
+
+@reports.command("stats")
+@click.argument("notebook", required=True)
+@click.argument("dest", type=click.File("w"), default=sys.stdout)
+@click.option("--max-answers", type=click.IntRange(min=0), help="Only include the N most common answers to each question")
+@format_option
+@compress_option
+@click.pass_obj
+def reports_stats(ctx: Context, notebook: str, dest: IO, max_answers: Optional[int], fmt: str, compress: Optional[str]):
+  """
+  Generate a CSV report of the number of users who gave each answer to each question in notebook
+  with identifier NOTEBOOK and write it to DEST (or stdout if DEST is unspecified). The statistics
+  are computed in the database, so this is much faster than the responses report for large
+  notebooks.
+  """
+  with ctx.app.app_context():
+    nb = ctx.maybe_get_or_create_notebook(notebook, False)
+    stats = get_response_stats(db.session, nb.id, [], max_answers=max_answers)
+
+  rows = [["question", "responses", "answer", "count"]]
+  for q, question_stats in stats["questions"].items():
+    for answer, count in question_stats["answers"]:
+      rows.append([q, question_stats["responses"], answer, count])
+
+  write_report(dest, rows, fmt, compress)
 
 
 @reports.command("attendance")
 @click.argument("notebook", required=True)
 @click.argument("dest", type=click.File("w"), default=sys.stdout)
+@format_option
+@compress_option
 @click.pass_obj
-def attendance_report(ctx: Context, notebook: str, dest: IO):
+def attendance_report(ctx: Context, notebook: str, dest: IO, fmt: str, compress: Optional[str]):
   """
   Generate a CSV report of attendance submissions for notebook identifier NOTEBOOK and write it to
   DEST (or stdout if DEST is unsepcified).
@@ -239,17 +380,206 @@ def attendance_report(ctx: Context, notebook: str, dest: IO):
   with ctx.app.app_context():
     nb = ctx.maybe_get_or_create_notebook(notebook, False)
     subms = db.session.query(AttendanceSubmission).filter_by(notebook=nb).join(User).order_by(User.username).all()
-    csv = to_csv([AttendanceSubmission.header_row(), *(s.to_row() for s in subms)])
+    rows = [AttendanceSubmission.header_row(), *(s.to_row() for s in subms)]
+
+  write_report(dest, rows, fmt, compress)
+
+
+@cli.group("snapshot")
+def snapshot():
+  """
+  Copy the whole SQLite database to and from snapshot files while the server is running.
+  """
+  pass
+
+
+def make_progress_reporter(interval: float = 1.0):
+  """
+  Make a backup progress callback that reports progress to stderr at most every ``interval``
+  seconds.
+  """
+  last = -interval
 
-  dest.write(csv)
+  def report(progress: BackupProgress):
+    nonlocal last
+    if progress.seconds - last >= interval or progress.copied == progress.total:
+      last = progress.seconds
+      pct = progress.copied / progress.total * 100 if progress.total else 100.0
+      click.echo(f"Copied {progress.copied}/{progress.total} pages ({pct:.0f}%)", err=True)
+
+  return report
+
+
+def echo_backup_stats(stats: BackupStats):
+  """
+  Write the size, duration, and throughput of a backup to stderr.
+  """
+  click.echo(
+    f"Copied {stats.bytes / 1e6:.1f}MB ({stats.pages} pages) in {stats.seconds:.2f}s "
+    f"({stats.throughput / 1e6:.1f}MB/s, {stats.steps} steps, longest step "
+    f"{stats.max_step_seconds * 1000:.1f}ms, {stats.restarts} restarts)",
+    err=True,
+  )
+
+
+@snapshot.command("create")
+@click.argument("dest", type=click.Path(dir_okay=False))
+@click.option("--pages", default=SNAPSHOT_STEP_PAGES, show_default=True, help="Number of pages to copy in each step")
+@click.option("--pause", default=0.0, show_default=True, help="Seconds to wait between steps")
+@click.option("--force", is_flag=True, help="Overwrite DEST if it exists")
+@click.pass_obj
+def snapshot_create(ctx: Context, dest: str, pages: int, pause: float, force: bool):
+  """
+  Write a consistent snapshot of the database to DEST while the server is running. The database is
+  copied a few pages at a time; in WAL mode (the default SQLite profile), submissions are not
+  blocked while it is copied.
+  """
+  if os.path.exists(dest) and not force:
+    raise ValueError(f"{dest} already exists; use --force to overwrite it")
+
+  with ctx.app.app_context():
+    db_path = get_sqlite_path(db.engine)
+
+  stats = create_snapshot(db_path, dest, pages=pages, pause=pause, progress=make_progress_reporter())
+  echo_backup_stats(stats)
+  click.echo(f"Wrote snapshot to {dest}")
+
+
+@snapshot.command("restore")
+@click.argument("src", type=click.Path(exists=True, dir_okay=False))
+@click.option("--pages", default=SNAPSHOT_STEP_PAGES, show_default=True, help="Number of pages to copy in each step")
+@click.option("--force", is_flag=True, help="Do not ask for confirmation before restoring")
+@click.pass_obj
+def snapshot_restore(ctx: Context, src: str, pages: int, force: bool):
+  """
+  Replace the contents of the database with the snapshot SRC. The server must be stopped first,
+  since its processes cache user and notebook IDs that the restore can change.
+  """
+  if not force:
+    if not click.confirm("Are you sure you want to replace the database with this snapshot?"):
+      click.echo("snapshot restore aborted")
+      return
+
+  with ctx.app.app_context():
+    db_path = get_sqlite_path(db.engine)
+    db.session.remove()
+    db.engine.dispose()
+
+    stats = restore_snapshot(src, db_path, pages=pages, progress=make_progress_reporter())
+
+    # snapshots of older versions of the server are missing newer tables and indexes
+    db.create_all()
+    upgrade_db(db.engine)
+
+  echo_backup_stats(stats)
+  click.echo(f"Restored snapshot from {src}")
+
+
+@cli.group("profile")
+def profile():
+  """
+  Analyze request profiles and the slow-request log.
+  """
+  pass
+
+
+@profile.command("summarize")
+@click.argument("log", type=click.File())
+@click.option("--top", default=10, show_default=True, help="Number of slowest requests and SQL statements to list")
+@click.option("--route", help="Only summarize requests to this route (e.g. /data)")
+def profile_summarize(log: IO, top: int, route: Optional[str]):
+  """
+  Summarize the slow-request log LOG (see SLOW_REQUEST_LOG): the number of slow requests to each
+  route with their latency percentiles and average time in each phase, the slowest requests, and
+  the SQL statements that took the most time in total.
+  """
+  records = [r for r in load_slow_requests(log) if route is None or r["route"] == route]
+  if not records:
+    click.echo("No slow requests")
+    return
+
+  by_route = {}
+  for r in records:
+    by_route.setdefault((r["route"], r["method"]), []).append(r)
+
+  click.echo(
+    f"{'route':<12} {'method':<6} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} "
+    f"{'sql ms':>8} {'commit ms':>9} {'stream ms':>9}")
+  for (r_route, method), rs in sorted(by_route.items(), key=lambda kv: -len(kv[1])):
+    durations = sorted(r["duration_ms"] for r in rs)
+    p50, p95 = (durations[math.ceil(p / 100 * len(durations)) - 1] for p in (50, 95))
+    sql, commit, stream = (statistics.mean(r["phases"][p] for r in rs) for p in ("sql_ms", "commit_ms", "stream_ms"))
+    click.echo(
+      f"{r_route:<12} {method:<6} {len(rs):>6} {p50:>9.1f} {p95:>9.1f} {durations[-1]:>9.1f} "
+      f"{sql:>8.1f} {commit:>9.1f} {stream:>9.1f}")
+
+  click.echo("\nSlowest requests:")
+  for r in sorted(records, key=lambda r: -r["duration_ms"])[:top]:
+    click.echo(
+      f"  {r['duration_ms']:>9.1f}ms {r['timestamp']} {r['method']} {r['route']} {r['status']} "
+      f"notebook={r.get('notebook')} responses={r.get('responses')} sql={r['sql_statements']}"
+      + (f" profile={r['profile']}" if r.get("profile") else ""))
+
+  statements = {}
+  for r in records:
+    for s in r["slowest_sql"]:
+      count, total = statements.get(s["statement"], (0, 0.0))
+      statements[s["statement"]] = (count + 1, total + s["ms"])
+
+  click.echo("\nSQL statements with the most time:")
+  for statement, (count, total) in sorted(statements.items(), key=lambda kv: -kv[1][1])[:top]:
+    click.echo(f"  {total:>9.1f}ms {count:>5}x  {' '.join(statement.split())[:120]}")
+
+
+@cli.group("passwords")
+def passwords():
+  """
+  Manage password hashing.
+  """
+  pass
+
+
+@passwords.command("benchmark")
+@click.option("--target-ms", default=250.0, show_default=True, help="The target login latency in milliseconds")
+@click.option("--repeat", default=5, show_default=True, help="Number of hashes to time for each profile")
+@click.pass_obj
+def passwords_benchmark(ctx: Context, target_ms: float, repeat: int):
+  """
+  Time argon2 hashing with each profile on this host and recommend the most expensive profile whose
+  median hash time is within the target login latency. Set the profile with the ARGON2_PROFILE
+  config value; existing passwords are rehashed with the new profile when users next log in.
+  """
+  click.echo(f"{'profile':<10} {'time_cost':>9} {'memory_cost':>11} {'parallelism':>11} {'median ms':>9}")
+
+  recommended = None
+  for name, params in ARGON2_PROFILES.items():
+    ph = PasswordHasher(**params)
+    times = []
+    for _ in range(repeat):
+      start = time.perf_counter()
+      ph.hash("benchmark")
+      times.append((time.perf_counter() - start) * 1000)
+
+    median = statistics.median(times)
+    click.echo(f"{name:<10} {params['time_cost']:>9} {params['memory_cost']:>11} {params['parallelism']:>11} {median:>9.1f}")
+    if median <= target_ms:
+      recommended = name
+
+  if recommended is None:
+    click.echo(f"No profile hashes within {target_ms:g}ms on this host; use 'low' and consider a larger host")
+  else:
+    click.echo(f"Recommended profile: {recommended}")
 
 
 @cli.command("seed")
 @click.argument("file", type=click.File())
+@click.option("--jobs", type=int, help="Number of processes to hash passwords with (defaults to the number of CPUs)")
+@click.option("--batch-size", default=500, show_default=True, help="Number of users to hash and insert at a time")
 @click.pass_obj
-def seed(ctx: Context, file: IO):
+def seed(ctx: Context, file: IO, jobs: Optional[int], batch_size: int):
   """
-  Seed the users table with users from the CSV file FILE.
+  Seed the users table with users from the CSV file FILE. Users that already exist have their
+  passwords updated.
 
   The CSV file must be formatted as below (the column ordering is required):
 
@@ -259,21 +589,41 @@ def seed(ctx: Context, file: IO):
   u2,p2
   # etc.
   """
-  rows = list(csv.reader(file))
-  if rows[0] != ["username", "password"]:
+  reader = csv.reader(file)
+  if next(reader, None) != ["username", "password"]:
     raise ValueError("CSV file does not contain expected headers; the columns should be 'username' and 'password' (in that order)")
 
-  with ctx.app.app_context():
-    for i, r in enumerate(rows[1:]):
-      if len(r) != 2:
-        raise ValueError(f"Row {i + 2} does not have 2 columns")
+  rows = enumerate(reader, start=2)
+  count, start = 0, time.perf_counter()
+  with ctx.app.app_context(), ExitStack() as stack:
+    executor = None
+    while batch := list(islice(rows, batch_size)):
+      for i, r in batch:
+        if len(r) != 2:
+          raise ValueError(f"Row {i} does not have 2 columns")
+
+      # starting worker processes costs more than it saves for small rosters
+      passwords = [r[1] for _, r in batch]
+      if executor is None and jobs != 1 and len(batch) >= MIN_PARALLEL_SEED_ROWS:
+        executor = stack.enter_context(ProcessPoolExecutor(
+          jobs,
+          initializer = set_password_hasher,
+          initargs = (get_argon2_parameters(ctx.app.config),),
+        ))
+
+      if executor is not None:
+        hashes = list(executor.map(hash_password, passwords, chunksize=8))
+      else:
+        hashes = [hash_password(pw) for pw in passwords]
 
-      u = User.with_credentials(*r)
-      db.session.add(u)
+      upsert_users(db.session, [(r[0], h) for (_, r), h in zip(batch, hashes)])
+      count += len(batch)
 
     db.session.commit()
 
-  click.echo(f"Successfully import {len(rows) - 1} users")
+  elapsed = time.perf_counter() - start
+  click.echo(f"Successfully import {count} users")
+  click.echo(f"Seeded {count} users in {elapsed:.2f}s ({count / elapsed:.1f} users/s)", err=True)
 
 
 if __name__ == "__main__":
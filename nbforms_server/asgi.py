@@ -0,0 +1,7 @@
+"""A module for running nbforms-server as an ASGI application"""
+
+from . import create_app
+from .bridge import AsgiApp
+
+
+app = AsgiApp(create_app())
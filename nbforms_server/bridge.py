@@ -0,0 +1,202 @@
+"""An ASGI adapter for serving the nbforms Flask app"""
+
+import asyncio
+import contextvars
+import io
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from flask import Flask
+
+from .ingest import write_behind
+from .passwords import password_pool
+
+
+Scope = Dict[str, Any]
+Receive = Callable[[], Awaitable[Dict[str, Any]]]
+Send = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class AsgiApp:
+  """
+  An ASGI application that serves the nbforms Flask app.
+
+  Connections and request bodies are handled on the event loop, so idle and slow clients only cost
+  a coroutine. Once a request's body has been read, the Flask app handles it in a thread from a
+  pool of ``ASGI_THREADS`` threads, and each chunk of a streamed response is produced in that pool
+  and sent from the event loop. Requests are routed, validated, and handled by the same code as the
+  WSGI app.
+
+  A handler thread waits while its password is hashed, so the password pool must reject logins
+  before they can occupy every thread: a ``ValueError`` is raised if the pool's size plus
+  ``PASSWORD_POOL_MAX_QUEUE`` is not less than ``ASGI_THREADS``.
+  """
+
+  flask_app: Flask
+  """the Flask app that handles requests"""
+
+  def __init__(self, flask_app: Flask):
+    threads = flask_app.config["ASGI_THREADS"]
+    if password_pool.size + password_pool.max_queue >= threads:
+      raise ValueError(
+        f"The password pool allows {password_pool.size + password_pool.max_queue} operations in "
+        f"flight, which could occupy all {threads} ASGI threads; reduce PASSWORD_POOL_MAX_QUEUE or "
+        "increase ASGI_THREADS")
+
+    self.flask_app = flask_app
+    self._executor = ThreadPoolExecutor(threads, thread_name_prefix="nbforms-asgi")
+
+  async def __call__(self, scope: Scope, receive: Receive, send: Send):
+    if scope["type"] == "http":
+      await self._handle_http(scope, receive, send)
+    elif scope["type"] == "lifespan":
+      await self._handle_lifespan(receive, send)
+    else:
+      raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+
+  async def _run(self, fn: Callable, *args: Any, context: Optional[contextvars.Context] = None) -> Any:
+    """
+    Call ``fn(*args)`` in the thread pool, in ``context`` if specified.
+    """
+    if context is not None:
+      fn, args = context.run, (fn, *args)
+    return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+  async def _handle_lifespan(self, receive: Receive, send: Send):
+    """
+    Handle the lifespan protocol, writing any queued submissions at shutdown.
+    """
+    while True:
+      message = await receive()
+      if message["type"] == "lifespan.startup":
+        await send({"type": "lifespan.startup.complete"})
+      elif message["type"] == "lifespan.shutdown":
+        await self._run(write_behind.shutdown)
+        self._executor.shutdown()
+        await send({"type": "lifespan.shutdown.complete"})
+        return
+
+  async def _handle_http(self, scope: Scope, receive: Receive, send: Send):
+    """
+    Read a request's body, have the Flask app handle it, and send its response.
+    """
+    chunks = []
+    while True:
+      message = await receive()
+      if message["type"] == "http.disconnect":
+        return
+      chunks.append(message.get("body", b""))
+      if not message.get("more_body", False):
+        break
+
+    # the steps of a streamed response may run in different threads, so they share one context
+    # (which holds Flask's request context)
+    context = contextvars.copy_context()
+    environ = make_environ(scope, b"".join(chunks))
+    status, headers, first, body = await self._run(
+      start_wsgi, self.flask_app, environ, context=context)
+    try:
+      await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": headers,
+      })
+
+      chunk = first
+      while chunk is not None:
+        if chunk:
+          await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        chunk = await self._run(next, body, None, context=context)
+
+      await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    finally:
+      if hasattr(body, "close"):
+        await self._run(body.close, context=context)
+
+
+def make_environ(scope: Scope, body: bytes) -> Dict[str, Any]:
+  """
+  Create the WSGI environ for an ASGI HTTP request.
+  """
+  server = scope.get("server") or ("localhost", 80)
+  environ = {
+    "REQUEST_METHOD": scope["method"],
+    "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+    "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+    "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+    "SERVER_NAME": server[0],
+    "SERVER_PORT": str(server[1]),
+    "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+    "CONTENT_LENGTH": str(len(body)),
+    "wsgi.version": (1, 0),
+    "wsgi.url_scheme": scope.get("scheme", "http"),
+    "wsgi.input": io.BytesIO(body),
+    "wsgi.errors": sys.stderr,
+    "wsgi.multithread": True,
+    "wsgi.multiprocess": True,
+    "wsgi.run_once": False,
+  }
+
+  if scope.get("client"):
+    environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = scope["client"][0], str(scope["client"][1])
+
+  for name, value in scope.get("headers", []):
+    name = name.decode("latin-1").upper().replace("-", "_")
+    value = value.decode("latin-1")
+    if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+      environ[name] = value
+      continue
+
+    key = f"HTTP_{name}"
+    environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+  return environ
+
+
+def start_wsgi(
+  wsgi_app: Callable,
+  environ: Dict[str, Any],
+) -> Tuple[int, List[Tuple[bytes, bytes]], Optional[bytes], Iterator[bytes]]:
+  """
+  Call a WSGI app and produce the first chunk of its response, returning the status, the headers,
+  the first chunk (``None`` if the body is empty), and an iterator over the rest of the body.
+  """
+  started = []
+
+  def start_response(status, headers, exc_info=None):
+    started[:] = [status, headers]
+
+  result: Iterable[bytes] = wsgi_app(environ, start_response)
+  body = iter(result)
+  first = next(body, None)
+
+  # keep the iterable's close method (which runs teardown for streamed responses) reachable
+  if hasattr(result, "close") and not hasattr(body, "close"):
+    body = _Closing(body, result.close)
+
+  status, headers = started
+  return (
+    int(status.split(" ", 1)[0]),
+    [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+    first,
+    body,
+  )
+
+
+class _Closing:
+  """
+  An iterator that wraps another iterator and a ``close`` callback.
+  """
+
+  def __init__(self, it: Iterator[bytes], close: Callable[[], None]):
+    self._it, self.close = it, close
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    return next(self._it)
+
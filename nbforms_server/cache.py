@@ -0,0 +1,245 @@
+"""In-process caches for hot lookups in an nbforms server"""
+
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Dict, Generic, Hashable, NamedTuple, Optional, Tuple, TypeVar, TYPE_CHECKING
+
+from .metrics import Metrics, server_metrics
+
+if TYPE_CHECKING:
+  from flask import Flask
+
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class CachedUser(NamedTuple):
+  """
+  The attributes of a ``User`` needed to handle an authenticated request.
+  """
+
+  id: int
+  """the user's ID"""
+
+  username: str
+  """the user's username"""
+
+  no_auth: Optional[bool]
+  """whether the user was created with no auth"""
+
+
+class CachedNotebook(NamedTuple):
+  """
+  The attributes of a ``Notebook`` needed to handle a request.
+  """
+
+  id: int
+  """the notebook's ID"""
+
+  identifier: str
+  """the notebook's identifier"""
+
+  attendance_open: bool
+  """whether attendance on the notebook was open when it was cached"""
+
+
+class LRUCache(Generic[K, V]):
+  """
+  A thread-safe, size-bounded LRU cache whose entries optionally expire after a TTL.
+
+  The cache can also be tied to a generation counter stored outside the process (see ``sync``):
+  when the counter changes, every entry is dropped, which lets other processes invalidate it.
+  """
+
+  maxsize: int
+  """the maximum number of entries in the cache"""
+
+  ttl: Optional[float]
+  """the number of seconds after which an entry expires, or ``None`` if entries do not expire"""
+
+  shared: bool
+  """whether callers should check the shared generation counter before each lookup"""
+
+  hits: int
+  """the number of lookups that found an entry"""
+
+  misses: int
+  """the number of lookups that did not find an entry"""
+
+  def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None, shared: bool = False):
+    self._lock = threading.Lock()
+    self._entries: "OrderedDict[K, Tuple[V, Optional[float]]]" = OrderedDict()
+    self._generation: Optional[int] = None
+    self.configure(maxsize, ttl, shared)
+
+  def __len__(self):
+    return len(self._entries)
+
+  def configure(self, maxsize: int, ttl: Optional[float], shared: bool):
+    """
+    Update the cache's settings and clear it.
+    """
+    self.maxsize, self.ttl, self.shared = maxsize, ttl, shared
+    self._generation = None
+    self.clear()
+
+  @property
+  def generation(self) -> Optional[int]:
+    """
+    The generation the cache was last synced to, or ``None`` if it has never been synced.
+    """
+    return self._generation
+
+  def get(self, key: K) -> Optional[V]:
+    """
+    Return the value cached for ``key``, or ``None`` if there is no unexpired entry for it.
+    """
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+        del self._entries[key]
+        entry = None
+
+      if entry is None:
+        self.misses += 1
+        return None
+
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+  def put(self, key: K, value: V, generation: Optional[int] = None):
+    """
+    Cache ``value`` for ``key``, evicting the least recently used entry if the cache is full.
+    ``generation`` should be the cache's generation from before ``value`` was read; if the cache
+    has since been synced to a different generation, the value is discarded, since it may have
+    been read before the invalidation.
+    """
+    if self.maxsize <= 0:
+      return
+
+    with self._lock:
+      if generation != self._generation:
+        return
+
+      expires = time.monotonic() + self.ttl if self.ttl is not None else None
+      self._entries[key] = (value, expires)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.maxsize:
+        self._entries.popitem(last=False)
+
+  def invalidate(self, key: K):
+    """
+    Remove the entry for ``key``, if present.
+    """
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def clear(self):
+    """
+    Remove all entries and reset the hit and miss counters.
+    """
+    with self._lock:
+      self._entries.clear()
+      self.hits, self.misses = 0, 0
+
+  def sync(self, generation: int):
+    """
+    Drop all entries if ``generation`` differs from the generation last synced to.
+    """
+    with self._lock:
+      if generation != self._generation:
+        self._entries.clear()
+        self._generation = generation
+
+  def record_metrics(self, metrics: Metrics, name: str):
+    """
+    Set the cache's size and hit and miss counters in ``metrics``, labeled with ``name``.
+    """
+    stats = self.stats()
+    metrics.set("nbforms_cache_size", stats["size"], name)
+    metrics.set("nbforms_cache_hits_total", stats["hits"], name)
+    metrics.set("nbforms_cache_misses_total", stats["misses"], name)
+
+  def stats(self) -> Dict[str, int]:
+    """
+    Return the cache's size and hit and miss counters.
+    """
+    return {
+      "size": len(self._entries),
+      "maxsize": self.maxsize,
+      "hits": self.hits,
+      "misses": self.misses,
+    }
+
+
+class ApiKeyCache(LRUCache[str, CachedUser]):
+  """
+  A cache mapping API keys to the users they belong to.
+  """
+
+  def init_app(self, app: "Flask"):
+    """
+    Configure the cache from the app's config:
+
+    * ``API_KEY_CACHE_SIZE``: the maximum number of cached API keys (0 disables the cache)
+    * ``API_KEY_CACHE_TTL``: the number of seconds an API key stays cached
+    * ``API_KEY_CACHE_SHARED``: whether to check the shared generation counter before each lookup;
+      this should be enabled when running multiple server processes against the same DB so that a
+      rotated API key stops working in every process immediately
+    """
+    self.configure(
+      app.config["API_KEY_CACHE_SIZE"],
+      app.config["API_KEY_CACHE_TTL"],
+      app.config["API_KEY_CACHE_SHARED"],
+    )
+    app.extensions["nbforms_api_key_cache"] = self
+    server_metrics.add_collector("api_keys", lambda m: self.record_metrics(m, "api_keys"))
+
+
+class NotebookRegistry(LRUCache[str, CachedNotebook]):
+  """
+  A cache mapping notebook identifiers to notebooks.
+
+  Notebook IDs never change, so cached entries can always be used to resolve an identifier to an
+  ID. The ``attendance_open`` state can change, so callers that need it should sync the registry
+  with the shared generation counter first.
+  """
+
+  def init_app(self, app: "Flask"):
+    """
+    Configure the registry from the app's config:
+
+    * ``NOTEBOOK_CACHE_SIZE``: the maximum number of cached notebooks (0 disables the cache)
+    """
+    self.configure(app.config["NOTEBOOK_CACHE_SIZE"], None, True)
+    app.extensions["nbforms_notebook_registry"] = self
+    server_metrics.add_collector("notebooks", lambda m: self.record_metrics(m, "notebooks"))
+
+
+class StatsCache(LRUCache[Tuple[int, Tuple[str, ...], Optional[int]], Dict[str, Any]]):
+  """
+  A cache mapping a notebook ID, requested questions, and histogram size to the notebook's response
+  statistics. Entries are not invalidated when responses are submitted, so they are only cached for
+  a short TTL.
+  """
+
+  def init_app(self, app: "Flask"):
+    """
+    Configure the cache from the app's config:
+
+    * ``STATS_CACHE_SIZE``: the maximum number of cached statistics
+    * ``STATS_CACHE_TTL``: the number of seconds statistics stay cached (0 disables the cache)
+    """
+    ttl = app.config["STATS_CACHE_TTL"]
+    self.configure(app.config["STATS_CACHE_SIZE"] if ttl else 0, ttl, False)
+    app.extensions["nbforms_stats_cache"] = self
+    server_metrics.add_collector("stats", lambda m: self.record_metrics(m, "stats"))
+
+
+api_keys = ApiKeyCache()
+notebooks = NotebookRegistry()
+response_stats = StatsCache()
@@ -0,0 +1,31 @@
+"""Database engine settings for an nbforms server"""
+
+from sqlalchemy import make_url
+from typing import Any, Dict, Mapping
+
+
+POOL_OPTIONS = {
+  "DATABASE_POOL_SIZE": "pool_size",
+  "DATABASE_MAX_OVERFLOW": "max_overflow",
+  "DATABASE_POOL_TIMEOUT": "pool_timeout",
+  "DATABASE_POOL_RECYCLE": "pool_recycle",
+  "DATABASE_POOL_PRE_PING": "pool_pre_ping",
+}
+"""the config values that set connection pool options, mapped to the ``create_engine`` arguments"""
+
+
+def get_engine_options(config: Mapping[str, Any]) -> Dict[str, Any]:
+  """
+  Determine the arguments to pass to ``create_engine`` from an app config. Connection pool options
+  are only set for server databases (e.g. PostgreSQL), since SQLite is always used with the pools
+  that Flask-SQLAlchemy selects for it. Any options in ``SQLALCHEMY_ENGINE_OPTIONS`` take precedence.
+  """
+  options = {}
+  if make_url(config["SQLALCHEMY_DATABASE_URI"]).get_backend_name() != "sqlite":
+    for key, option in POOL_OPTIONS.items():
+      value = config.get(key)
+      if value is not None:
+        options[option] = value
+
+  options.update(config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+  return options
@@ -0,0 +1,213 @@
+"""Export formats for responses and reports from an nbforms server"""
+
+import datetime as dt
+import io
+import json
+
+from itertools import islice
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+
+from .utils import CSV_CHUNK_SIZE, iter_csv
+
+try:
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+except ImportError:
+  pa = pq = None
+
+
+ARROW_BATCH_SIZE = 10000
+"""the number of rows in each Arrow record batch"""
+
+PARQUET_ROW_GROUP_SIZE = 100000
+"""the number of rows in each Parquet row group"""
+
+PARQUET_COMPRESSION = "zstd"
+"""the codec used to compress Parquet column chunks"""
+
+EXPORT_FORMATS = {
+  "csv": "text/csv",
+  "ndjson": "application/x-ndjson",
+  **({
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+  } if pa is not None else {}),
+}
+"""the supported export formats mapped to their MIME types (Arrow and Parquet require ``pyarrow``)"""
+
+COMPRESSED_FORMATS = {"parquet"}
+"""the export formats that are already compressed, and so should not be compressed again"""
+
+
+def iter_export(rows: Iterable[List[Any]], fmt: str) -> Iterator[bytes]:
+  """
+  Serialize an iterable of rows, the first of which is the header, into chunks of an export format
+  in ``EXPORT_FORMATS``, consuming ``rows`` lazily.
+
+  Unlike CSV, the other formats preserve the types of values (e.g. ``int``, ``bool``, and
+  ``datetime``). Arrow and Parquet columns are typed by the values in the first record batch.
+
+  Args:
+    rows (``Iterable[list[object]]``): the header and data
+    fmt (``str``): the export format
+
+  Returns:
+    ``Iterator[bytes]``: the serialized chunks
+  """
+  if fmt not in EXPORT_FORMATS:
+    raise ValueError(f"Unsupported export format: {fmt}")
+
+  if fmt == "csv":
+    return iter_csv(rows)
+  elif fmt == "ndjson":
+    return iter_ndjson(rows)
+  else:
+    return iter_arrow(rows, fmt)
+
+
+def _json_default(value: Any) -> Any:
+  if isinstance(value, dt.datetime):
+    return value.isoformat()
+  raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def iter_ndjson(rows: Iterable[List[Any]], chunk_size: int = CSV_CHUNK_SIZE) -> Iterator[bytes]:
+  """
+  Convert an iterable of rows, the first of which is the header, into UTF-8-encoded chunks of
+  newline-delimited JSON of about ``chunk_size`` bytes, with one object per row mapping the headers
+  to the row's values. Datetimes are converted to ISO 8601 strings.
+
+  Args:
+    rows (``Iterable[list[object]]``): the header and data
+    chunk_size (``int``): the approximate size of each chunk
+
+  Returns:
+    ``Iterator[bytes]``: the NDJSON chunks
+  """
+  rows = iter(rows)
+  header = next(rows, None)
+  if header is None:
+    return
+
+  sio = io.StringIO()
+  for row in rows:
+    sio.write(json.dumps(dict(zip(header, row)), default=_json_default))
+    sio.write("\n")
+    if sio.tell() >= chunk_size:
+      yield sio.getvalue().encode()
+      sio.seek(0)
+      sio.truncate()
+
+  if sio.tell():
+    yield sio.getvalue().encode()
+
+
+class _Sink(io.RawIOBase):
+  """
+  A writable stream that holds the bytes written to it until they are drained. Unlike a drained
+  ``BytesIO``, its position counts every byte ever written, which Parquet writers rely on.
+  """
+
+  def __init__(self):
+    self._chunks: List[bytes] = []
+    self._position = 0
+
+  def writable(self):
+    return True
+
+  def write(self, data) -> int:
+    self._chunks.append(bytes(data))
+    self._position += len(data)
+    return len(data)
+
+  def tell(self) -> int:
+    return self._position
+
+  def drain(self) -> bytes:
+    """
+    Return and forget the bytes written since the last drain.
+    """
+    data = b"".join(self._chunks)
+    self._chunks = []
+    return data
+
+
+def _record_batches(rows: Iterable[List[Any]], batch_size: int) -> Tuple["pa.Schema", Iterator["pa.RecordBatch"]]:
+  """
+  Convert an iterable of rows, the first of which is the header, into a schema and an iterator over
+  record batches of ``batch_size`` rows. The schema is inferred from the first batch, with columns
+  that are all null typed as strings.
+  """
+  rows = iter(rows)
+  header = next(rows, [])
+
+  def read_batch() -> Optional[List[Tuple]]:
+    batch = list(islice(rows, batch_size))
+    return list(zip(*batch)) if batch else None
+
+  first = read_batch()
+  arrays = [pa.array(c) for c in (first if first is not None else [[] for _ in header])]
+  arrays = [a.cast(pa.string()) if pa.types.is_null(a.type) else a for a in arrays]
+  schema = pa.schema([(h, a.type) for h, a in zip(header, arrays)])
+
+  def generate():
+    if first is None:
+      return
+
+    yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+    while True:
+      columns = read_batch()
+      if columns is None:
+        return
+
+      yield pa.RecordBatch.from_arrays(
+        [pa.array(c, type=f.type) for c, f in zip(columns, schema)], schema=schema)
+
+  return schema, generate()
+
+
+def iter_arrow(rows: Iterable[List[Any]], fmt: str) -> Iterator[bytes]:
+  """
+  Convert an iterable of rows, the first of which is the header, into chunks of an Arrow IPC stream
+  (if ``fmt`` is ``"arrow"``) or a Parquet file (if ``fmt`` is ``"parquet"``). Rows are converted
+  to record batches of ``ARROW_BATCH_SIZE`` rows, or ``PARQUET_ROW_GROUP_SIZE`` rows for Parquet,
+  and the bytes written for each batch are yielded before the next is read.
+
+  Args:
+    rows (``Iterable[list[object]]``): the header and data
+    fmt (``str``): ``"arrow"`` or ``"parquet"``
+
+  Returns:
+    ``Iterator[bytes]``: the serialized chunks
+  """
+  if pa is None:
+    raise ValueError(f"The {fmt} format requires pyarrow")
+
+  batch_size = PARQUET_ROW_GROUP_SIZE if fmt == "parquet" else ARROW_BATCH_SIZE
+  schema, batches = _record_batches(rows, batch_size)
+
+  sink = _Sink()
+  if fmt == "parquet":
+    # IDs and timestamps are mostly increasing, so they are much smaller delta encoded than
+    # dictionary encoded
+    delta = {
+      f.name for f in schema if pa.types.is_integer(f.type) or pa.types.is_timestamp(f.type)
+    }
+    writer = pq.ParquetWriter(
+      sink,
+      schema,
+      compression = PARQUET_COMPRESSION,
+      use_dictionary = [f.name for f in schema if f.name not in delta],
+      column_encoding = {c: "DELTA_BINARY_PACKED" for c in delta},
+    )
+  else:
+    writer = pa.ipc.new_stream(sink, schema)
+
+  for batch in batches:
+    writer.write_batch(batch)
+    data = sink.drain()
+    if data:
+      yield data
+
+  writer.close()
+  yield sink.drain()
@@ -0,0 +1,367 @@
+"""Write-behind ingestion of submissions for an nbforms server"""
+
+import atexit
+import datetime as dt
+import fcntl
+import glob
+import json
+import os
+import queue
+import threading
+import time
+
+from sqlalchemy import insert
+from typing import IO, List, NamedTuple, Optional, Tuple, TYPE_CHECKING, Union
+
+from .models import AttendanceSubmission, db, record_submissions
+
+if TYPE_CHECKING:
+  from flask import Flask
+  from sqlalchemy.orm import Session as SessionType
+
+
+class ResponseSubmission(NamedTuple):
+  """
+  A user's responses to questions in a notebook, waiting to be written to the DB.
+  """
+
+  user_id: int
+  """the ID of the user"""
+
+  notebook_id: int
+  """the ID of the notebook"""
+
+  responses: List[Tuple[str, str, dt.datetime]]
+  """the question identifier, response, and timestamp of each response"""
+
+
+class AttendanceRecord(NamedTuple):
+  """
+  A user's attendance submission for a notebook, waiting to be written to the DB.
+  """
+
+  user_id: int
+  """the ID of the user"""
+
+  notebook_id: int
+  """the ID of the notebook"""
+
+  timestamp: dt.datetime
+  """the timestamp at which the submission was received"""
+
+  was_open: bool
+  """whether the notebook's attendance was open when the submission was received"""
+
+
+Submission = Union[ResponseSubmission, AttendanceRecord]
+
+
+def write_submissions(session: "SessionType", submissions: List[Submission]):
+  """
+  Write a batch of submissions to the DB and commit them in a single transaction.
+  """
+  record_submissions(session, [s for s in submissions if isinstance(s, ResponseSubmission)])
+
+  attendance = [s._asdict() for s in submissions if isinstance(s, AttendanceRecord)]
+  if attendance:
+    session.execute(insert(AttendanceSubmission), attendance)
+
+  session.commit()
+
+
+def dump_submission(s: Submission) -> str:
+  """
+  Serialize a submission to a line of JSON for the spool file.
+  """
+  if isinstance(s, ResponseSubmission):
+    return json.dumps({
+      "user_id": s.user_id,
+      "notebook_id": s.notebook_id,
+      "responses": [[q, r, ts.isoformat()] for q, r, ts in s.responses],
+    })
+
+  return json.dumps({**s._asdict(), "timestamp": s.timestamp.isoformat()})
+
+
+def load_spool(f: IO) -> List[Submission]:
+  """
+  Read the submissions in a spool file that had not been written to the DB, i.e. those after the
+  number of submissions recorded by its last checkpoint.
+  """
+  submissions, written = [], 0
+  for line in f:
+    if not line.strip():
+      continue
+    d = json.loads(line)
+    if "checkpoint" in d:
+      written = d["checkpoint"]
+    else:
+      submissions.append(line)
+
+  return [load_submission(l) for l in submissions[written:]]
+
+
+def load_submission(line: str) -> Submission:
+  """
+  Deserialize a submission from a line of JSON in a spool file.
+  """
+  d = json.loads(line)
+  if "responses" in d:
+    return ResponseSubmission(
+      d["user_id"],
+      d["notebook_id"],
+      [(q, r, dt.datetime.fromisoformat(ts)) for q, r, ts in d["responses"]],
+    )
+
+  return AttendanceRecord(d["user_id"], d["notebook_id"], dt.datetime.fromisoformat(d["timestamp"]), d["was_open"])
+
+
+class WriteBehindQueueFullError(Exception):
+  """
+  An exception raised when a submission is rejected because the write-behind queue is full.
+  """
+
+
+class WriteBehindQueue:
+  """
+  An in-process queue of submissions drained by a background thread that writes them to the DB in
+  batches, so that a burst of submissions shares a few transactions instead of each request
+  committing its own.
+
+  A batch is written once it has ``batch_size`` submissions or its first submission has waited
+  ``batch_ms`` milliseconds. If a spool directory is configured, each submission is also appended
+  to a spool file before it is acknowledged, and spool files left behind by processes that exited
+  without draining their queues are replayed at startup. After each batch is written, a checkpoint
+  with the number of written submissions is appended to the spool so that only unwritten
+  submissions are replayed; the spool is emptied whenever the queue is.
+
+  Each process spools to its own locked file, which is opened by its first submission rather than
+  at startup, so that workers forked from a process that loaded the app (e.g. by gunicorn with
+  ``--preload``) don't share their parent's spool.
+  """
+
+  enabled: bool
+  """whether submissions should be queued instead of written by the request"""
+
+  batch_size: int
+  """the maximum number of submissions written in one transaction"""
+
+  batch_ms: float
+  """the maximum number of milliseconds a submission waits for its batch to fill"""
+
+  retry_after: int
+  """the number of seconds rejected clients should wait before retrying"""
+
+  def __init__(self):
+    self._app: Optional["Flask"] = None
+    self._queue: "queue.Queue[Submission]" = queue.Queue()
+    self._thread: Optional[threading.Thread] = None
+    self._stop = threading.Event()
+    self._spool_dir: Optional[str] = None
+    self._spool: Optional[IO] = None
+    self._spool_pid: Optional[int] = None
+    self._spool_written = 0
+    self._spool_lock = threading.Lock()
+    self.enabled = False
+    self.written, self.failed = 0, 0
+    atexit.register(self.shutdown)
+
+  def init_app(self, app: "Flask"):
+    """
+    Configure the queue from the app's config:
+
+    * ``WRITE_BEHIND``: whether to enable write-behind mode
+    * ``WRITE_BEHIND_MAX_QUEUE``: the maximum number of queued submissions
+    * ``WRITE_BEHIND_BATCH_SIZE``: the maximum number of submissions written in one transaction
+    * ``WRITE_BEHIND_BATCH_MS``: the maximum time a submission waits for its batch to fill
+    * ``WRITE_BEHIND_SPOOL_DIR``: a directory to spool queued submissions to, so that they survive
+      the process crashing (disabled if ``None``)
+    * ``WRITE_BEHIND_RETRY_AFTER``: the value of the ``Retry-After`` header sent when the queue is
+      full
+    """
+    self.shutdown()
+
+    self._app = app
+    self.enabled = app.config["WRITE_BEHIND"]
+    self.batch_size = app.config["WRITE_BEHIND_BATCH_SIZE"]
+    self.batch_ms = app.config["WRITE_BEHIND_BATCH_MS"]
+    self.retry_after = app.config["WRITE_BEHIND_RETRY_AFTER"]
+    self._queue = queue.Queue(app.config["WRITE_BEHIND_MAX_QUEUE"])
+    self._stop.clear()
+    self.written, self.failed = 0, 0
+    app.extensions["nbforms_write_behind"] = self
+
+    spool_dir = app.config["WRITE_BEHIND_SPOOL_DIR"]
+    self._spool_dir = spool_dir if self.enabled and spool_dir else None
+    if self._spool_dir is not None:
+      os.makedirs(self._spool_dir, exist_ok=True)
+      self._replay_spools(self._spool_dir)
+
+  def _replay_spools(self, spool_dir: str):
+    """
+    Write the submissions in any spool files in ``spool_dir`` that are not locked by a running
+    process to the DB, then delete the files.
+    """
+    for path in sorted(glob.glob(os.path.join(spool_dir, "spool-*.jsonl"))):
+      with open(path) as f:
+        try:
+          fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+          continue
+
+        submissions = load_spool(f)
+        with self._app.app_context():
+          for i in range(0, len(submissions), self.batch_size):
+            write_submissions(db.session, submissions[i:i + self.batch_size])
+
+        os.remove(path)
+
+  def _get_spool(self) -> Optional[IO]:
+    """
+    Return this process's spool file, opening and locking it if needed, or ``None`` if spooling is
+    disabled. A spool inherited from the parent process is closed (the parent keeps its lock).
+    Must be called with the spool lock held.
+    """
+    if self._spool_dir is None:
+      return None
+
+    if self._spool is not None and self._spool_pid != os.getpid():
+      self._spool.close()
+      self._spool = None
+
+    if self._spool is None:
+      self._spool = open(os.path.join(self._spool_dir, f"spool-{os.getpid()}.jsonl"), "a+")
+      fcntl.flock(self._spool, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      self._spool_pid = os.getpid()
+      self._spool_written = 0
+
+    return self._spool
+
+  def put(self, submission: Submission):
+    """
+    Queue a submission to be written to the DB, starting the writer thread if needed. Raises a
+    ``WriteBehindQueueFullError`` if the queue is full.
+    """
+    with self._spool_lock:
+      try:
+        self._queue.put_nowait(submission)
+      except queue.Full:
+        raise WriteBehindQueueFullError("write-behind queue is full")
+
+      spool = self._get_spool()
+      if spool is not None:
+        spool.write(dump_submission(submission) + "\n")
+        spool.flush()
+
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._run, name="nbforms-write-behind", daemon=True)
+        self._thread.start()
+
+  def _next_batch(self) -> List[Submission]:
+    """
+    Wait for the next batch of submissions. Returns an empty list if the queue stays empty for a
+    short time.
+    """
+    try:
+      batch = [self._queue.get(timeout=0.1)]
+    except queue.Empty:
+      return []
+
+    deadline = time.monotonic() + self.batch_ms / 1000
+    while len(batch) < self.batch_size:
+      try:
+        batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+      except queue.Empty:
+        break
+
+    return batch
+
+  def _write(self, batch: List[Submission]):
+    """
+    Write a batch of submissions. If the batch fails, each submission is retried on its own so
+    that one bad submission (e.g. for a user that has since been deleted) does not lose the rest.
+    """
+    with self._app.app_context():
+      try:
+        write_submissions(db.session, batch)
+        self.written += len(batch)
+        return
+      except Exception:
+        db.session.rollback()
+
+      for s in batch:
+        try:
+          write_submissions(db.session, [s])
+          self.written += 1
+        except Exception:
+          db.session.rollback()
+          self.failed += 1
+          self._app.logger.exception(f"failed to write queued submission: {s}")
+
+  def _checkpoint(self, n: int):
+    """
+    Record in the spool that ``n`` more of its submissions have been written to the DB.
+    """
+    with self._spool_lock:
+      if self._spool is not None:
+        self._spool_written += n
+        self._spool.write(json.dumps({"checkpoint": self._spool_written}) + "\n")
+        self._spool.flush()
+
+  def _run(self):
+    """
+    Drain the queue until ``shutdown`` is called and the queue is empty.
+    """
+    while True:
+      batch = self._next_batch()
+      if batch:
+        self._write(batch)
+        self._checkpoint(len(batch))
+        for _ in batch:
+          self._queue.task_done()
+
+      with self._spool_lock:
+        if self._queue.empty():
+          # every spooled submission has been written, so the spool can be emptied
+          if self._spool is not None and self._spool.tell():
+            self._spool.seek(0)
+            self._spool.truncate()
+            self._spool_written = 0
+
+          if self._stop.is_set():
+            return
+
+  def flush(self):
+    """
+    Block until every queued submission has been written.
+    """
+    self._queue.join()
+
+  def shutdown(self):
+    """
+    Write every queued submission, stop the writer thread, and close the spool file.
+    """
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+    if self._spool is not None:
+      self._spool.close()
+      if self._spool_pid == os.getpid():
+        os.remove(self._spool.name)
+      self._spool = None
+
+  def stats(self):
+    """
+    Return the queue's current depth and the number of submissions written and failed.
+    """
+    return {
+      "queue_depth": self._queue.qsize(),
+      "max_queue": self._queue.maxsize,
+      "written": self.written,
+      "failed": self.failed,
+    }
+
+
+write_behind = WriteBehindQueue()
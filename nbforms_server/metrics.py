@@ -0,0 +1,417 @@
+"""Request, database, and password hashing metrics for an nbforms server in Prometheus format"""
+
+import atexit
+import bisect
+import glob
+import json
+import math
+import os
+import threading
+import time
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from flask import Flask, Response as FlaskResponse
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+"""the upper bounds in seconds of the buckets of latency histograms"""
+
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+"""the upper bounds of the buckets of the histogram of SQL statements per request"""
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+"""the content type of the Prometheus text exposition format"""
+
+
+class MetricDefinition(NamedTuple):
+  """
+  The definition of a metric.
+  """
+
+  type: str
+  """the Prometheus metric type (``counter``, ``gauge``, or ``histogram``)"""
+
+  help: str
+  """a description of the metric"""
+
+  labels: Tuple[str, ...]
+  """the names of the metric's labels"""
+
+  buckets: Tuple[float, ...] = ()
+  """the upper bounds of a histogram's buckets"""
+
+
+METRICS = {
+  "nbforms_requests_total": MetricDefinition(
+    "counter", "Requests handled.", ("route", "method", "status")),
+  "nbforms_request_duration_seconds": MetricDefinition(
+    "histogram", "Time to handle a request, including streaming the response.",
+    ("route", "method", "status"), LATENCY_BUCKETS),
+  "nbforms_request_sql_statements": MetricDefinition(
+    "histogram", "SQL statements executed per request.", ("route",), STATEMENT_BUCKETS),
+  "nbforms_request_sql_duration_seconds": MetricDefinition(
+    "histogram", "Time spent executing SQL statements per request.", ("route",), LATENCY_BUCKETS),
+  "nbforms_db_commit_duration_seconds": MetricDefinition(
+    "histogram", "Time to flush and commit a DB session.", ("route",), LATENCY_BUCKETS),
+  "nbforms_password_hash_duration_seconds": MetricDefinition(
+    "histogram", "Time to hash or verify a password with argon2.", ("operation",), LATENCY_BUCKETS),
+  "nbforms_password_pool_size": MetricDefinition(
+    "gauge", "Threads hashing passwords.", ()),
+  "nbforms_password_pool_in_flight": MetricDefinition(
+    "gauge", "Password hashing operations running or waiting for a thread.", ()),
+  "nbforms_password_pool_queue_depth": MetricDefinition(
+    "gauge", "Password hashing operations waiting for a thread.", ()),
+  "nbforms_password_pool_rejected_total": MetricDefinition(
+    "counter", "Password hashing operations rejected because the pool was full.", ()),
+  "nbforms_cache_size": MetricDefinition(
+    "gauge", "Entries in an in-process cache.", ("cache",)),
+  "nbforms_cache_hits_total": MetricDefinition(
+    "counter", "Lookups that found an entry in an in-process cache.", ("cache",)),
+  "nbforms_cache_misses_total": MetricDefinition(
+    "counter", "Lookups that did not find an entry in an in-process cache.", ("cache",)),
+}
+"""the metrics collected by the server"""
+
+Values = Dict[Tuple[str, Tuple[str, ...]], List[float]]
+
+
+class RequestTimer:
+  """
+  The timings of the request being handled, accumulated by the SQLAlchemy event listeners and read
+  by the metrics registry and the request profiler. The SQL and duration of each statement are only
+  kept if ``statements`` is set to a list (e.g. by the profiler).
+  """
+
+  __slots__ = (
+    "route", "method", "start", "sql_start", "sql_statements", "sql_seconds", "commit_start",
+    "commit_seconds", "statements",
+  )
+
+  def __init__(self, route: str, method: str):
+    self.route, self.method = route, method
+    self.start = time.perf_counter()
+    self.sql_start = self.commit_start = 0.0
+    self.sql_statements, self.sql_seconds, self.commit_seconds = 0, 0.0, 0.0
+    self.statements: Optional[List[Tuple[str, float]]] = None
+
+
+def get_request_timer() -> Optional[RequestTimer]:
+  """
+  Return the timer of the request being handled, or ``None`` if requests are not being timed.
+  """
+  return g.get("_nbforms_request_timer") if has_app_context() else None
+
+
+def _start_request_timer():
+  rule = request.url_rule
+  g._nbforms_request_timer = RequestTimer(rule.rule if rule is not None else "unmatched", request.method)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  if (timer := get_request_timer()) is not None:
+    timer.sql_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  if (timer := get_request_timer()) is not None:
+    seconds = time.perf_counter() - timer.sql_start
+    timer.sql_statements += 1
+    timer.sql_seconds += seconds
+    if timer.statements is not None:
+      timer.statements.append((statement, seconds))
+
+
+def _before_commit(session):
+  if (timer := get_request_timer()) is not None:
+    timer.commit_start = time.perf_counter()
+
+
+def _after_commit(session):
+  if (timer := get_request_timer()) is not None and timer.commit_start:
+    seconds = time.perf_counter() - timer.commit_start
+    timer.commit_seconds += seconds
+    timer.commit_start = 0.0
+    server_metrics.observe("nbforms_db_commit_duration_seconds", seconds, timer.route)
+
+
+def time_requests(app: "Flask"):
+  """
+  Time the app's requests and their SQL statements and commits with a ``RequestTimer``, if they are
+  not already timed. The metrics registry and the request profiler both read the same timer, so
+  each statement is only timed once.
+  """
+  if app.extensions.get("nbforms_request_timer"):
+    return
+
+  app.extensions["nbforms_request_timer"] = True
+  app.before_request(_start_request_timer)
+
+  sqlalchemy = app.extensions["sqlalchemy"]
+  with app.app_context():
+    event.listen(sqlalchemy.engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sqlalchemy.engine, "after_cursor_execute", _after_cursor_execute)
+
+  # the scoped session is shared by every app, so its listeners are only added once
+  if not event.contains(sqlalchemy.session, "before_commit", _before_commit):
+    event.listen(sqlalchemy.session, "before_commit", _before_commit)
+    event.listen(sqlalchemy.session, "after_commit", _after_commit)
+
+
+def merge_values(values: Iterable[Values]) -> Values:
+  """
+  Sum the values of each series in the metric values of several processes.
+  """
+  merged: Values = {}
+  for v in values:
+    for key, series in v.items():
+      if key in merged:
+        merged[key] = [a + b for a, b in zip(merged[key], series)]
+      else:
+        merged[key] = list(series)
+  return merged
+
+
+def _escape_label(value: str) -> str:
+  return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+  labels = ",".join(f'{n}="{_escape_label(v)}"' for n, v in zip(names, values))
+  return f"{{{labels}}}" if labels else ""
+
+
+def render_metrics(values: Values) -> str:
+  """
+  Render metric values in the Prometheus text exposition format.
+  """
+  lines = []
+  for name, metric in METRICS.items():
+    lines.append(f"# HELP {name} {metric.help}")
+    lines.append(f"# TYPE {name} {metric.type}")
+    for labels in sorted(l for n, l in values if n == name):
+      series = values[(name, labels)]
+      if metric.type in ("counter", "gauge"):
+        lines.append(f"{name}{_format_labels(metric.labels, labels)} {series[0]:.17g}")
+        continue
+
+      cumulative = 0.0
+      for bound, count in zip([*metric.buckets, math.inf], series):
+        cumulative += count
+        le = "+Inf" if bound == math.inf else f"{bound:g}"
+        lines.append(f"{name}_bucket{_format_labels((*metric.labels, 'le'), (*labels, le))} {cumulative:.17g}")
+
+      lines.append(f"{name}_sum{_format_labels(metric.labels, labels)} {series[-1]:.17g}")
+      lines.append(f"{name}_count{_format_labels(metric.labels, labels)} {cumulative:.17g}")
+
+  return "\n".join(lines) + "\n"
+
+
+class Metrics:
+  """
+  A registry of counters and histograms, which records the latency, SQL statements, and commits of
+  every request when enabled.
+
+  Each process keeps its metrics in memory. If a directory is configured, each process also writes
+  its metrics to a file in it at most every ``flush_interval`` seconds (and when it exits), and
+  ``collect`` sums the files of every process, so that any worker of a multi-worker server can
+  report the metrics of all of them. Files of processes that have exited are still counted, so
+  counters never go backwards; the directory should be emptied when the server is restarted.
+
+  Metrics kept by other components (e.g. the size of the password pool) are set by collectors
+  registered with ``add_collector``, which are run before the metrics are read or written. Like
+  the other metrics, their values are summed across processes.
+  """
+
+  enabled: bool
+  """whether metrics are recorded"""
+
+  directory: Optional[str]
+  """the directory that processes write their metrics to, or ``None`` for a single process"""
+
+  flush_interval: float
+  """the minimum number of seconds between writes of this process's metrics to the directory"""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._values: Values = {}
+    self._dirty = False
+    self._last_flush = 0.0
+    self._collectors: Dict[str, Callable[["Metrics"], None]] = {}
+    self.configure(False, None, 1)
+    atexit.register(self.flush)
+
+  def configure(self, enabled: bool, directory: Optional[str], flush_interval: float):
+    """
+    Update the registry's settings and reset its metrics.
+    """
+    with self._lock:
+      self.enabled, self.directory, self.flush_interval = enabled, directory, flush_interval
+      self._values, self._dirty = {}, False
+
+  def init_app(self, app: "Flask"):
+    """
+    Configure the registry from the app's config and, if it is enabled, instrument the app's
+    requests and DB engine and session:
+
+    * ``METRICS``: whether to record metrics
+    * ``METRICS_DIR``: a directory shared by all of the server's processes to aggregate their
+      metrics in (required for a server with more than one worker process)
+    * ``METRICS_FLUSH_INTERVAL``: the minimum number of seconds between writes of a process's
+      metrics to ``METRICS_DIR``
+    """
+    self.configure(app.config["METRICS"], app.config["METRICS_DIR"], app.config["METRICS_FLUSH_INTERVAL"])
+    app.extensions["nbforms_metrics"] = self
+    if not self.enabled:
+      return
+
+    if self.directory:
+      os.makedirs(self.directory, exist_ok=True)
+
+    time_requests(app)
+    app.after_request(self._after_request)
+
+  def _after_request(self, response: "FlaskResponse") -> "FlaskResponse":
+    timer = get_request_timer()
+    if timer is None:
+      return response
+
+    status = response.status_code
+    if response.is_streamed:
+      # streamed responses are still being generated, so the request is recorded once it is closed
+      response.call_on_close(lambda: self._record_request(timer, status))
+    else:
+      self._record_request(timer, status)
+    return response
+
+  def _record_request(self, timer: RequestTimer, status: int):
+    labels = (timer.route, timer.method, str(status))
+    self.inc("nbforms_requests_total", *labels)
+    self.observe("nbforms_request_duration_seconds", time.perf_counter() - timer.start, *labels)
+    self.observe("nbforms_request_sql_statements", timer.sql_statements, timer.route)
+    self.observe("nbforms_request_sql_duration_seconds", timer.sql_seconds, timer.route)
+    if self.directory and time.monotonic() - self._last_flush >= self.flush_interval:
+      self.flush()
+
+  def inc(self, name: str, *labels: str, value: float = 1):
+    """
+    Increment the counter ``name`` with the given label values by ``value``.
+    """
+    if not self.enabled:
+      return
+
+    with self._lock:
+      series = self._values.get((name, labels))
+      if series is None:
+        series = self._values[(name, labels)] = [0.0]
+      series[0] += value
+      self._dirty = True
+
+  def observe(self, name: str, value: float, *labels: str):
+    """
+    Record ``value`` in the histogram ``name`` with the given label values.
+    """
+    if not self.enabled:
+      return
+
+    buckets = METRICS[name].buckets
+    i = bisect.bisect_left(buckets, value)
+    with self._lock:
+      series = self._values.get((name, labels))
+      if series is None:
+        # a count for each bucket, then the +Inf bucket, then the sum
+        series = self._values[(name, labels)] = [0.0] * (len(buckets) + 2)
+      series[i] += 1
+      series[-1] += value
+      self._dirty = True
+
+  def set(self, name: str, value: float, *labels: str):
+    """
+    Set the gauge (or counter kept elsewhere) ``name`` with the given label values to ``value``.
+    """
+    if not self.enabled:
+      return
+
+    with self._lock:
+      series = self._values.get((name, labels))
+      if series is None or series[0] != value:
+        self._values[(name, labels)] = [value]
+        self._dirty = True
+
+  def add_collector(self, name: str, collector: Callable[["Metrics"], None]):
+    """
+    Register a function that sets metrics kept by another component, replacing any collector with
+    the same name.
+    """
+    self._collectors[name] = collector
+
+  def _run_collectors(self):
+    if self.enabled:
+      for collector in list(self._collectors.values()):
+        collector(self)
+
+  def values(self) -> Values:
+    """
+    Return a copy of this process's metric values.
+    """
+    self._run_collectors()
+    with self._lock:
+      return {k: list(v) for k, v in self._values.items()}
+
+  def flush(self):
+    """
+    Write this process's metrics to its file in the metrics directory, if they have changed since
+    they were last written.
+    """
+    if not self.directory:
+      return
+
+    self._run_collectors()
+    with self._lock:
+      if not self._dirty:
+        return
+      values = [[n, list(l), v] for (n, l), v in self._values.items()]
+      self._dirty = False
+      self._last_flush = time.monotonic()
+
+    path = os.path.join(self.directory, f"metrics-{os.getpid()}.json")
+    try:
+      with open(f"{path}.tmp", "w") as f:
+        json.dump(values, f)
+      os.replace(f"{path}.tmp", path)
+    except OSError:
+      # the metrics are written again at the next flush
+      with self._lock:
+        self._dirty = True
+
+  def collect(self) -> Values:
+    """
+    Return the metric values of every process writing to the metrics directory, or of this process
+    if there is no directory.
+    """
+    if not self.directory:
+      return self.values()
+
+    self.flush()
+    values = []
+    for path in glob.glob(os.path.join(self.directory, "metrics-*.json")):
+      try:
+        with open(path) as f:
+          values.append({(n, tuple(l)): v for n, l, v in json.load(f)})
+      except (OSError, ValueError):
+        # the process wrote a file that is not valid or was removed
+        continue
+
+    return merge_values(values)
+
+  def render(self) -> str:
+    """
+    Render the metrics of every process in the Prometheus text exposition format.
+    """
+    return render_metrics(self.collect())
+
+
+server_metrics = Metrics()
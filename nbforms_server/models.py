@@ -4,21 +4,37 @@ import datetime as dt
 import hashlib
 import random
 
+from itertools import groupby
 from argon2 import PasswordHasher
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import ForeignKey, select, Sequence
+from sqlalchemy import delete, event, ForeignKey, func, Index, insert, inspect, select, Sequence, update
 from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import (
   DeclarativeBase,
   Mapped,
   mapped_column,
   relationship,
+  Session as SessionBase,
   sessionmaker,
 )
-from typing import Dict, List, Optional, Tuple, Type, TypeVar, TYPE_CHECKING
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Type, TypeVar, TYPE_CHECKING, Union
+
+from .cache import api_keys, CachedNotebook, CachedUser, notebooks
+from .passwords import password_pool, PasswordPoolFullError
 
 if TYPE_CHECKING:
+  from sqlalchemy.engine import Engine
   from sqlalchemy.orm import Session as SessionType
+  from sqlalchemy.sql import Select
+
+
+def hash_username(username: str) -> str:
+  """
+  Generate a hash of a username, for pseudonymization.
+  """
+  hashed = hashlib.sha256(username.encode()).hexdigest()
+  return hashed[:20]
 
 
 class Base(DeclarativeBase):
@@ -30,6 +46,24 @@ ph = PasswordHasher()
 Session = sessionmaker()
 T = TypeVar("T")
 
+UPSERT_BATCH_SIZE = 500
+"""the maximum number of rows written by a single ``INSERT ... ON CONFLICT`` statement"""
+
+EXPORT_BATCH_SIZE = 1000
+"""the number of responses read from the DB at a time when exporting responses"""
+
+USERS_GENERATION = "users"
+"""the name of the cache generation counter bumped when users' API keys change"""
+
+NOTEBOOKS_GENERATION = "notebooks"
+"""the name of the cache generation counter bumped when notebooks' attendance state changes"""
+
+RESPONSES_GENERATION = "responses"
+"""the name of the cache generation counter bumped when responses are deleted"""
+
+CACHE_GENERATIONS = [USERS_GENERATION, NOTEBOOKS_GENERATION, RESPONSES_GENERATION]
+"""the names of all cache generation counters"""
+
 
 class User(db.Model):
   """
@@ -53,7 +87,10 @@ class User(db.Model):
   """whether this user was created with no auth (meaning it can't be logged into again)"""
 
   responses: Mapped[List["Response"]] = relationship(back_populates="user", cascade="all, delete-orphan")
-  """all responses the user has submitted"""
+  """the latest response the user has submitted to each question"""
+
+  response_history: Mapped[List["ResponseLogEntry"]] = relationship(back_populates="user", cascade="all, delete-orphan")
+  """every response the user has submitted"""
 
   attendance_submissions: Mapped[List["AttendanceSubmission"]] = relationship(back_populates="user", cascade="all, delete-orphan")
   """all of the user's attendance submissions"""
@@ -102,14 +139,13 @@ class User(db.Model):
     """
     Generate a hash of the user's username, for pseudonymization.
     """
-    hashed = hashlib.sha256(self.username.encode()).hexdigest()
-    return hashed[:20]
+    return hash_username(self.username)
 
   def set_password(self, pw: str):
     """
-    Update the user's password.
+    Update the user's password. The password is hashed in the password pool.
     """
-    self.password_hash = ph.hash(pw)
+    self.password_hash = password_pool.run(ph.hash, pw)
 
   def check_password(self, session: "SessionType", pw: str) -> bool:
     """
@@ -117,13 +153,18 @@ class User(db.Model):
 
     If the argon2 parameters have changed since the password hash on this ``User`` was calculated,
     the hash is updated and the changed ``User`` is added to the provided db session.
+
+    The password is verified in the password pool, so a ``PasswordPoolFullError`` is raised if the
+    pool is full.
     """
     try:
-      matches = ph.verify(self.password_hash, pw)
+      matches = password_pool.run(ph.verify, self.password_hash, pw)
+    except PasswordPoolFullError:
+      raise
     except:
       return False
     if matches and ph.check_needs_rehash(self.password_hash):
-      self.password_hash = ph.hash(pw)
+      self.password_hash = password_pool.run(ph.hash, pw)
       session.add(self)
     return matches
 
@@ -134,6 +175,15 @@ class User(db.Model):
     self.api_key = random.randbytes(32).hex()
 
 
+@event.listens_for(User.api_key, "set", active_history=True)
+def _invalidate_api_key(target: User, value: Optional[str], oldvalue: Optional[str], initiator):
+  """
+  Remove a user's old API key from this process's API key cache when it changes.
+  """
+  if isinstance(oldvalue, str) and value != oldvalue:
+    api_keys.invalidate(oldvalue)
+
+
 class Notebook(db.Model):
   """
   A model representing a notebook.
@@ -150,7 +200,10 @@ class Notebook(db.Model):
   """whether attendance on this notebook is currently open"""
 
   responses: Mapped[List["Response"]] = relationship(back_populates="notebook", cascade="all, delete-orphan")
-  """all responses for questions in this notebook"""
+  """the latest response of each user to each question in this notebook"""
+
+  response_history: Mapped[List["ResponseLogEntry"]] = relationship(back_populates="notebook", cascade="all, delete-orphan")
+  """every response submitted for questions in this notebook"""
 
   attendance_submissions: Mapped[List["AttendanceSubmission"]] = relationship(back_populates="notebook", cascade="all, delete-orphan")
   """all attendance submissions for this notebook"""
@@ -185,6 +238,19 @@ class Response(db.Model):
   A model representing a user's response to a question in a notebook.
   """
   __tablename__ = "responses"
+  __table_args__ = (
+    Index(
+      "ix_responses_user_notebook_question",
+      "user_id",
+      "notebook_id",
+      "question_identifier",
+      unique=True,
+    ),
+    Index("ix_responses_notebook_question_user", "notebook_id", "question_identifier", "user_id"),
+    Index("ix_responses_notebook_timestamp", "notebook_id", "timestamp"),
+    # covers the GROUP BY query of ``get_response_stats``
+    Index("ix_responses_notebook_question_response", "notebook_id", "question_identifier", "response"),
+  )
 
   id: Mapped[int] = mapped_column(Sequence("response_id_seq"), primary_key=True)
   """the primary key of the table"""
@@ -211,11 +277,78 @@ class Response(db.Model):
   """the notebook this response belongs to"""
 
 
+class ResponseLogEntry(db.Model):
+  """
+  A model representing one response submitted by a user. Entries are only ever appended, so the
+  log holds the full history of every user's answers; the latest answer to each question is kept
+  in ``Response``.
+  """
+  __tablename__ = "response_log"
+  __table_args__ = (
+    Index("ix_response_log_notebook_user_question", "notebook_id", "user_id", "question_identifier", "id"),
+    Index("ix_response_log_user", "user_id"),
+    Index("ix_response_log_notebook_id", "notebook_id", "id"),
+  )
+
+  id: Mapped[int] = mapped_column(Sequence("response_log_id_seq"), primary_key=True)
+  """the primary key of the table"""
+
+  user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+  """the ID of the user this response belongs to"""
+
+  notebook_id: Mapped[int] = mapped_column(ForeignKey("notebooks.id"))
+  """the ID of the notebook this response belongs to"""
+
+  question_identifier: Mapped[str] = mapped_column()
+  """the identifier of the question this response is for"""
+
+  response: Mapped[str] = mapped_column()
+  """the user's response"""
+
+  timestamp: Mapped[dt.datetime] = mapped_column()
+  """the timestamp at which this response was received"""
+
+  user: Mapped[User] = relationship(back_populates="response_history")
+  """the user this response belongs to"""
+
+  notebook: Mapped[Notebook] = relationship(back_populates="response_history")
+  """the notebook this response belongs to"""
+
+  @staticmethod
+  def header_row() -> List[str]:
+    """
+    Create a list representing the column headers for the rows returned by ``self.to_row()``.
+    """
+    return [
+      "id",
+      "username",
+      "question",
+      "response",
+      "timestamp",
+    ]
+
+  def to_row(self) -> List:
+    """
+    Convert this model into a list of its attributes, suitable for rendering into a CSV.
+    """
+    return [
+      self.id,
+      self.user.username,
+      self.question_identifier,
+      self.response,
+      self.timestamp,
+    ]
+
+
 class AttendanceSubmission(db.Model):
   """
   A model representing a user's attendance submission for a notebook.
   """
   __tablename__ = "attendance_submissions"
+  __table_args__ = (
+    Index("ix_attendance_submissions_notebook_user_timestamp", "notebook_id", "user_id", "timestamp"),
+    Index("ix_attendance_submissions_user", "user_id"),
+  )
 
   id: Mapped[int] = mapped_column(Sequence("attendance_submission_id_seq"), primary_key=True)
   """the primary key of the table"""
@@ -261,11 +394,233 @@ class AttendanceSubmission(db.Model):
       self.user_id,
       self.user.username,
       self.notebook.identifier,
-      str(self.timestamp),
+      self.timestamp,
       self.was_open,
     ]
 
 
+class CacheGeneration(db.Model):
+  """
+  A model representing a counter that is incremented whenever the data held in a process-local
+  cache changes, so that every server process can tell when its cache is stale.
+  """
+  __tablename__ = "cache_generations"
+
+  name: Mapped[str] = mapped_column(primary_key=True)
+  """the name of the cache"""
+
+  generation: Mapped[int] = mapped_column(default=0)
+  """the current generation of the cache"""
+
+
+def get_cache_generation(session: "SessionType", name: str) -> int:
+  """
+  Get the current generation of the cache named ``name``.
+  """
+  return session.scalar(select(CacheGeneration.generation).where(CacheGeneration.name == name)) or 0
+
+
+def bump_cache_generation(session: "SessionType", name: str):
+  """
+  Increment the generation of the cache named ``name`` as part of the session's transaction.
+  """
+  session.connection().execute(
+    update(CacheGeneration)
+      .where(CacheGeneration.name == name)
+      .values(generation=CacheGeneration.generation + 1)
+  )
+
+
+@event.listens_for(SessionBase, "before_flush")
+def _bump_cache_generations(session: "SessionType", flush_context, instances):
+  """
+  Bump the generation of the users cache when a user's API key is changed or a user is deleted,
+  and of the notebooks cache when a notebook's attendance state is changed or a notebook is
+  deleted. The generation of the responses cache is bumped when a user, notebook, or response is
+  deleted.
+  """
+  cached_attrs = {
+    User: ("api_key", USERS_GENERATION),
+    Notebook: ("attendance_open", NOTEBOOKS_GENERATION),
+  }
+
+  names = set()
+  for obj in session.deleted:
+    if type(obj) in cached_attrs:
+      names.add(cached_attrs[type(obj)][1])
+    if isinstance(obj, (User, Notebook, Response, ResponseLogEntry)):
+      names.add(RESPONSES_GENERATION)
+
+  for obj in session.dirty:
+    if type(obj) in cached_attrs:
+      attr, name = cached_attrs[type(obj)]
+      if inspect(obj).attrs[attr].history.has_changes():
+        names.add(name)
+
+  for name in sorted(names):
+    bump_cache_generation(session, name)
+
+
+def find_user_by_api_key(session: "SessionType", api_key: str) -> Optional[CachedUser]:
+  """
+  Find the user with the provided API key, consulting the API key cache before the DB. Returns
+  ``None`` if there is no such user.
+  """
+  generation = api_keys.generation
+  if api_keys.shared:
+    generation = get_cache_generation(session, USERS_GENERATION)
+    api_keys.sync(generation)
+
+  user = api_keys.get(api_key)
+  if user is None:
+    u = session.query(User).filter_by(api_key=api_key).first()
+    if u is None:
+      return None
+
+    user = CachedUser(u.id, u.username, u.no_auth)
+    api_keys.put(api_key, user, generation)
+
+  return user
+
+
+def find_users_by_api_keys(session: "SessionType", keys: Iterable[str]) -> Dict[str, CachedUser]:
+  """
+  Find the users with the provided API keys, consulting the API key cache before the DB. The keys
+  that are not cached are looked up with a single query. Returns a dictionary mapping each key to
+  its user; keys that do not belong to a user are omitted.
+  """
+  generation = api_keys.generation
+  if api_keys.shared:
+    generation = get_cache_generation(session, USERS_GENERATION)
+    api_keys.sync(generation)
+
+  users, missing = {}, []
+  for key in set(keys):
+    user = api_keys.get(key)
+    if user is None:
+      missing.append(key)
+    else:
+      users[key] = user
+
+  if missing:
+    stmt = select(User.id, User.username, User.no_auth, User.api_key).where(User.api_key.in_(missing))
+    for row in session.execute(stmt):
+      user = CachedUser(row.id, row.username, row.no_auth)
+      api_keys.put(row.api_key, user, generation)
+      users[row.api_key] = user
+
+  return users
+
+
+def resolve_notebook(
+  session: "SessionType",
+  identifier: str,
+  *,
+  create: bool = True,
+  fresh: bool = False,
+) -> Optional[CachedNotebook]:
+  """
+  Find the notebook with the provided identifier, consulting the notebook registry before the DB.
+  If the notebook does not exist, it is created if ``create`` is true (otherwise ``None`` is
+  returned).
+
+  Cached notebooks may have a stale ``attendance_open`` value; if ``fresh`` is true, the registry
+  is synced with the shared generation counter first so that the returned value is current.
+
+  Notebooks are created with an ``INSERT ... ON CONFLICT DO NOTHING`` where the dialect supports it,
+  so concurrent requests for a new notebook do not fail on the unique identifier. Newly created
+  notebooks are not cached until a later lookup, since the session's transaction may still be
+  rolled back.
+  """
+  generation = notebooks.generation
+  if fresh:
+    generation = get_cache_generation(session, NOTEBOOKS_GENERATION)
+    notebooks.sync(generation)
+
+  nb = notebooks.get(identifier)
+  if nb is not None:
+    return nb
+
+  stmt = select(Notebook.id, Notebook.attendance_open).where(Notebook.identifier == identifier)
+  row = session.execute(stmt).first()
+  if row is not None:
+    nb = CachedNotebook(row.id, identifier, row.attendance_open or False)
+    notebooks.put(identifier, nb, generation)
+    return nb
+
+  if not create:
+    return None
+
+  insert = _dialect_insert(session)
+  if insert is not None:
+    session.execute(
+      insert(Notebook)
+        .values(identifier=identifier)
+        .on_conflict_do_nothing(index_elements=[Notebook.identifier])
+    )
+  else:
+    session.add(Notebook(identifier=identifier))
+    session.flush()
+
+  row = session.execute(stmt).one()
+  return CachedNotebook(row.id, identifier, row.attendance_open or False)
+
+
+def resolve_notebooks(
+  session: "SessionType",
+  identifiers: Iterable[str],
+  *,
+  create: bool = True,
+) -> Dict[str, CachedNotebook]:
+  """
+  Find the notebooks with the provided identifiers like ``resolve_notebook``, looking up those that
+  are not in the notebook registry with a single query and creating any that do not exist with a
+  single insert if ``create`` is true. Returns a dictionary mapping each identifier to its notebook;
+  identifiers of notebooks that do not exist are omitted if ``create`` is false.
+  """
+  generation = notebooks.generation
+  found, missing = {}, []
+  for identifier in dict.fromkeys(identifiers):
+    nb = notebooks.get(identifier)
+    if nb is None:
+      missing.append(identifier)
+    else:
+      found[identifier] = nb
+
+  def select_notebooks(identifiers):
+    return session.execute(
+      select(Notebook.id, Notebook.identifier, Notebook.attendance_open)
+        .where(Notebook.identifier.in_(identifiers))
+    )
+
+  if missing:
+    for row in select_notebooks(missing):
+      nb = CachedNotebook(row.id, row.identifier, row.attendance_open or False)
+      notebooks.put(row.identifier, nb, generation)
+      found[row.identifier] = nb
+
+  new = [i for i in missing if i not in found]
+  if not new or not create:
+    return found
+
+  insert = _dialect_insert(session)
+  if insert is not None:
+    session.execute(
+      insert(Notebook)
+        .values([{"identifier": i} for i in new])
+        .on_conflict_do_nothing(index_elements=[Notebook.identifier])
+    )
+  else:
+    session.add_all(Notebook(identifier=i) for i in new)
+    session.flush()
+
+  # newly created notebooks are not cached, as in resolve_notebook
+  for row in select_notebooks(new):
+    found[row.identifier] = CachedNotebook(row.id, row.identifier, row.attendance_open or False)
+
+  return found
+
+
 def get_or_create(session: "SessionType", model: Type[T], **kwargs) -> T:
   """
   Find an instance of a model class in the database using the filters in ``kwargs`` or create one
@@ -280,69 +635,481 @@ def get_or_create(session: "SessionType", model: Type[T], **kwargs) -> T:
     return instance
 
 
-def export_responses(
+def _dialect_insert(session: "SessionType"):
+  """
+  Return the dialect-specific ``insert`` construct (which supports ``ON CONFLICT`` clauses) for the
+  database the session is bound to, or ``None`` if the dialect does not support upserts.
+  """
+  return {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+  }.get(session.get_bind().dialect.name)
+
+
+def set_password_hasher(parameters: Dict[str, int]):
+  """
+  Replace the password hasher with one that uses the provided argon2 parameters. Existing hashes
+  made with other parameters are still verified, and are rehashed by ``User.check_password`` on the
+  user's next login.
+  """
+  global ph
+  ph = PasswordHasher(**parameters)
+
+
+def hash_password(pw: str) -> str:
+  """
+  Hash a password with argon2 in the current thread. This is a module-level function so that it can
+  be used with a process pool.
+  """
+  return ph.hash(pw)
+
+
+def upsert_users(session: "SessionType", users: List[Tuple[str, str]]):
+  """
+  Insert users with the provided usernames and password hashes in a single executemany, updating
+  the password hash of any user that already exists.
+  """
+  values = [{"username": u, "password_hash": pw_hash} for u, pw_hash in users]
+  if not values:
+    return
+
+  insert = _dialect_insert(session)
+  if insert is None:
+    existing = {
+      u.username: u for u in session.scalars(
+        select(User).where(User.username.in_([v["username"] for v in values])))
+    }
+    for v in values:
+      if v["username"] in existing:
+        existing[v["username"]].password_hash = v["password_hash"]
+      else:
+        session.add(User(**v))
+    session.flush()
+    return
+
+  stmt = insert(User)
+  stmt = stmt.on_conflict_do_update(
+    index_elements=[User.username],
+    set_={"password_hash": stmt.excluded.password_hash},
+  )
+  session.execute(stmt, values)
+
+
+def upsert_responses(
   session: "SessionType",
-  notebook: Notebook,
+  user_id: int,
+  notebook_id: int,
+  responses: List[Tuple[str, str, dt.datetime]],
+):
+  """
+  Write a user's responses to questions in a notebook to the DB, inserting new rows and updating
+  existing ones. Each entry of ``responses`` is a tuple of the question identifier, the response,
+  and the timestamp of the response; if a question appears more than once, the last entry wins.
+  Existing rows are only updated with responses that are not older than them, so responses written
+  out of order (e.g. by write-behind batches in different processes) keep the latest one.
+
+  Where the dialect supports it, the rows are written with ``INSERT ... ON CONFLICT DO UPDATE``
+  statements against the unique index on ``(user_id, notebook_id, question_identifier)``, so no
+  rows are read before writing. Otherwise, the existing rows are fetched with a single query and
+  updated in place.
+  """
+  _upsert_response_values(session, list({
+    q: {
+      "user_id": user_id,
+      "notebook_id": notebook_id,
+      "question_identifier": q,
+      "response": r,
+      "timestamp": ts,
+    } for q, r, ts in responses
+  }.values()))
+
+
+def _upsert_response_values(session: "SessionType", values: List[Dict[str, Any]]):
+  """
+  Insert or update the ``Response`` rows in ``values``, which must contain at most one row for each
+  user, notebook, and question. Existing rows newer than the values for them are not updated.
+  """
+  if not values:
+    return
+
+  insert = _dialect_insert(session)
+  if insert is None:
+    by_user_and_notebook: Dict[Tuple[int, int], List[Dict[str, Any]]] = {}
+    for v in values:
+      by_user_and_notebook.setdefault((v["user_id"], v["notebook_id"]), []).append(v)
+
+    for (user_id, notebook_id), user_values in by_user_and_notebook.items():
+      existing = {
+        r.question_identifier: r for r in session.scalars(
+          select(Response)
+            .where(Response.user_id == user_id)
+            .where(Response.notebook_id == notebook_id)
+            .where(Response.question_identifier.in_([v["question_identifier"] for v in user_values]))
+        )
+      }
+      for v in user_values:
+        r = existing.get(v["question_identifier"])
+        if r is None:
+          session.add(Response(**v))
+        elif r.timestamp <= v["timestamp"]:
+          r.response, r.timestamp = v["response"], v["timestamp"]
+
+    session.flush()
+    return
+
+  for i in range(0, len(values), UPSERT_BATCH_SIZE):
+    stmt = insert(Response).values(values[i:i + UPSERT_BATCH_SIZE])
+    stmt = stmt.on_conflict_do_update(
+      index_elements=[Response.user_id, Response.notebook_id, Response.question_identifier],
+      set_={"response": stmt.excluded.response, "timestamp": stmt.excluded.timestamp},
+      where=Response.timestamp <= stmt.excluded.timestamp,
+    )
+    session.execute(stmt)
+
+
+class ResponsesVersion(NamedTuple):
+  """
+  A version of a notebook's responses. Responses are only ever added by appending to the response
+  log (which changes ``last_log_id``) or removed by deletions (which bump the responses generation),
+  so the version changes whenever the notebook's responses do.
+
+  This relies on log entries committing in the order of their IDs, as they do in SQLite, where
+  writes are serialized. In other DBs, an entry committed after one with a larger ID does not change
+  the version until the notebook's next append.
+  """
+
+  generation: int
+  """the generation of the responses cache"""
+
+  last_log_id: Optional[int]
+  """the ID of the notebook's latest response log entry"""
+
+
+def get_responses_version(session: "SessionType", notebook_id: int) -> ResponsesVersion:
+  """
+  Get the current version of a notebook's responses. This only reads the last of the notebook's
+  entries in the ``(notebook_id, id)`` index of the response log, so its cost does not grow with the
+  length of the log.
+  """
+  generation = get_cache_generation(session, RESPONSES_GENERATION)
+  last_log_id = session.scalar(
+    select(func.max(ResponseLogEntry.id)).where(ResponseLogEntry.notebook_id == notebook_id))
+  return ResponsesVersion(generation, last_log_id)
+
+
+def count_log_entries(session: "SessionType", notebook_id: int, through_id: Optional[int]) -> int:
+  """
+  Count the notebook's response log entries with IDs up to ``through_id``.
+  """
+  if through_id is None:
+    return 0
+
+  return session.scalar(
+    select(func.count())
+      .where(ResponseLogEntry.notebook_id == notebook_id)
+      .where(ResponseLogEntry.id <= through_id)
+  )
+
+
+def get_latest_response_timestamp(session: "SessionType", notebook_id: int) -> Optional[dt.datetime]:
+  """
+  Get the timestamp of the most recent response to a notebook, or ``None`` if it has no responses.
+  """
+  return session.scalar(select(func.max(Response.timestamp)).where(Response.notebook_id == notebook_id))
+
+
+def append_responses(
+  session: "SessionType",
+  user_id: int,
+  notebook_id: int,
+  responses: List[Tuple[str, str, dt.datetime]],
+):
+  """
+  Append a user's responses to questions in a notebook to the response log with a single
+  executemany. Nothing is read before writing, and every entry of ``responses`` is kept.
+  """
+  if not responses:
+    return
+
+  session.execute(insert(ResponseLogEntry), [
+    {
+      "user_id": user_id,
+      "notebook_id": notebook_id,
+      "question_identifier": q,
+      "response": r,
+      "timestamp": ts,
+    } for q, r, ts in responses
+  ])
+
+
+def record_responses(
+  session: "SessionType",
+  user_id: int,
+  notebook_id: int,
+  responses: List[Tuple[str, str, dt.datetime]],
+):
+  """
+  Record a user's responses to questions in a notebook: append them to the response log and update
+  the latest responses with ``upsert_responses``.
+  """
+  append_responses(session, user_id, notebook_id, responses)
+  upsert_responses(session, user_id, notebook_id, responses)
+
+
+def record_submissions(
+  session: "SessionType",
+  submissions: Iterable[Tuple[int, int, List[Tuple[str, str, dt.datetime]]]],
+):
+  """
+  Record many users' responses to questions in many notebooks like ``record_responses``, where each
+  entry of ``submissions`` is a tuple of a user ID, a notebook ID, and the responses. Every response
+  is appended to the log with a single executemany and the latest responses are upserted together,
+  rather than with statements for each submission. The latest response to each question is the one
+  with the latest timestamp (or the last of those), whatever the order of the submissions.
+  """
+  log, latest = [], {}
+  for user_id, notebook_id, responses in submissions:
+    for q, r, ts in responses:
+      v = {
+        "user_id": user_id,
+        "notebook_id": notebook_id,
+        "question_identifier": q,
+        "response": r,
+        "timestamp": ts,
+      }
+      log.append(v)
+      prev = latest.get((user_id, notebook_id, q))
+      if prev is None or prev["timestamp"] <= ts:
+        latest[(user_id, notebook_id, q)] = v
+
+  if not log:
+    return
+
+  session.execute(insert(ResponseLogEntry), log)
+  _upsert_response_values(session, list(latest.values()))
+
+
+def upgrade_db(bind: "Engine"):
+  """
+  Bring an existing database up to date with the models. ``db.create_all()`` only creates missing
+  tables, so indexes added to existing tables are created here. Before the unique index on
+  responses is created, any duplicate responses are removed, keeping the most recently inserted
+  row. If the response log is empty, it is seeded with the current responses so that databases
+  created before the log existed start with their latest responses as history. The rows for any
+  missing cache generation counters are also inserted.
+  """
+  with bind.begin() as conn:
+    indexes = {ix["name"] for ix in inspect(conn).get_indexes(Response.__tablename__)}
+    if "ix_responses_user_notebook_question" not in indexes:
+      keep = (
+        select(func.max(Response.id))
+          .group_by(Response.user_id, Response.notebook_id, Response.question_identifier)
+      )
+      conn.execute(delete(Response).where(Response.id.not_in(keep)))
+
+    for table in db.metadata.sorted_tables:
+      for index in table.indexes:
+        index.create(conn, checkfirst=True)
+
+    if conn.scalar(select(ResponseLogEntry.id).limit(1)) is None:
+      columns = ["user_id", "notebook_id", "question_identifier", "response", "timestamp"]
+      conn.execute(
+        insert(ResponseLogEntry).from_select(
+          columns,
+          select(*(getattr(Response, c) for c in columns)).order_by(Response.timestamp, Response.id),
+        ),
+      )
+
+    existing = set(conn.scalars(select(CacheGeneration.name)))
+    missing = [{"name": n, "generation": 0} for n in CACHE_GENERATIONS if n not in existing]
+    if missing:
+      conn.execute(insert(CacheGeneration), missing)
+
+
+def export_statement(
+  notebook_id: int,
   req_questions: List[str],
   *,
+  since: Optional[dt.datetime] = None,
+) -> "Select":
+  """
+  Build the query for the columns of the responses exported by ``iter_responses``: each response's
+  user ID, username, question identifier, and response, ordered so that each user's responses are
+  adjacent.
+  """
+  stmt = (
+    select(User.id, User.username, Response.question_identifier, Response.response)
+      .join(User, Response.user_id == User.id)
+      .where(Response.notebook_id == notebook_id)
+      .order_by(User.username)
+      .execution_options(yield_per=EXPORT_BATCH_SIZE)
+  )
+  if req_questions:
+    stmt = stmt.where(Response.question_identifier.in_(req_questions))
+  if since is not None:
+    changed = (
+      select(Response.user_id)
+        .where(Response.notebook_id == notebook_id)
+        .where(Response.timestamp > since)
+    )
+    if req_questions:
+      changed = changed.where(Response.question_identifier.in_(req_questions))
+    stmt = stmt.where(Response.user_id.in_(changed))
+
+  return stmt
+
+
+def iter_user_rows(
+  results: Iterable[Tuple[int, str, str, str]],
+  questions: List[str],
+  *,
   user_hashes: bool = False,
   usernames: bool = False,
-) -> Tuple[List[List[str]], Optional[str]]:
+) -> Iterator[List[str]]:
   """
-  Export responses for questions in the specified notebook to a 2D list. If ``req_questions`` is
-  empty, no question filtering is applied. Usernames or pseudonymized usernames can be included by
-  setting ``usernames`` or ``user_hashes`` to true, resp.
+  Pivot the results of an ``export_statement`` query into one row per user with their response to
+  each of ``questions`` (or ``""``), preceded by their username or pseudonymized username if
+  ``usernames`` or ``user_hashes`` is true, resp.
   """
-  # query for all responses matching the notebook and requested questions
-  stmt = select(Response).where(Response.notebook == notebook)
+  for (_, username), user_responses in groupby(results, key=lambda r: r[:2]):
+    user_res = {q: res for _, _, q, res in user_responses}
+    row = []
+    if user_hashes:
+      row.append(hash_username(username))
+    elif usernames:
+      row.append(username)
+
+    # append the user's response to each question to the row
+    row.extend(user_res.get(q, "") for q in questions)
+
+    yield row
+
+
+def iter_responses(
+  session: "SessionType",
+  notebook: Union[Notebook, CachedNotebook],
+  req_questions: List[str],
+  *,
+  user_hashes: bool = False,
+  usernames: bool = False,
+  since: Optional[dt.datetime] = None,
+) -> Tuple[Optional[Iterator[List[str]]], Optional[str]]:
+  """
+  Export responses for questions in the specified notebook as an iterator over the rows of a 2D
+  list. If ``req_questions`` is empty, no question filtering is applied. Usernames or pseudonymized
+  usernames can be included by setting ``usernames`` or ``user_hashes`` to true, resp. If ``since``
+  is provided, only the rows of users with a response written after it are included (with all of
+  their responses, so that clients can replace their copies of those rows).
+
+  Responses are read from the DB in batches of ``EXPORT_BATCH_SIZE`` as the iterator is consumed,
+  so only one user's responses need to be held in memory at a time (unless ``user_hashes`` is true,
+  in which case all rows are read before the first is yielded so that they can be shuffled). The
+  iterator must therefore be consumed while the session is still usable.
+
+  Returns a tuple of the iterator and an error message; exactly one of these will be ``None``.
+  """
+  # determine the columns up front so that the header row can be yielded first
+  stmt = select(Response.question_identifier).where(Response.notebook_id == notebook.id).distinct()
   if req_questions:
     stmt = stmt.where(Response.question_identifier.in_(req_questions))
 
-  responses = session.scalars(stmt).all()
-  if len(responses) == 0:
-    return [], "no responses found"
-
-  # group responses by user and question
-  questions = set()
-  by_user_and_question: Dict[int, Dict[str, Response]] = {}
-  users_by_username: Dict[str, User] = {}
-  for r in responses:
-    questions.add(r.question_identifier)
-    if r.user_id not in by_user_and_question:
-      by_user_and_question[r.user_id] = {}
-    by_user_and_question[r.user_id][r.question_identifier] = r
-    users_by_username[r.user.username] = r.user
+  questions = set(session.scalars(stmt))
+  if len(questions) == 0:
+    return None, "no responses found"
 
   # ensure there is a column for every requested question
-  for q in req_questions:
-    questions.add(q)
+  questions = sorted(questions.union(req_questions))
 
-  questions = sorted(questions)
+  stmt = export_statement(notebook.id, req_questions, since=since)
 
-  rows = [(["user"] if user_hashes or usernames else []) + questions]
-  for un in sorted(users_by_username.keys()):
-    u = users_by_username[un]
-    row = []
+  def generate():
+    yield (["user"] if user_hashes or usernames else []) + questions
+
+    rows = iter_user_rows(session.execute(stmt), questions, user_hashes=user_hashes, usernames=usernames)
+
+    # if pseudonymization is enabled, randomize the ordering of the returned rows so as not to leak
+    # any information, since by default the rows are sorted by username
     if user_hashes:
-      row.append(u.hash_username())
-    elif usernames:
-      row.append(u.username)
+      shuffled_rows = list(rows)
+      random.shuffle(shuffled_rows)
+      yield from shuffled_rows
 
-    # append the user's response to each question to the row
-    user_res = by_user_and_question[u.id]
-    for q in questions:
-      res = ""
-      if q in user_res:
-        res = user_res[q].response
-      row.append(res)
-
-    rows.append(row)
-
-  # if pseudonymization is enabled, randomize the ordering of the returned rows so as not to leak
-  # any information, since by default the rows are sorted by username
-  if user_hashes:
-    shuffled_rows = rows[1:]
-    random.shuffle(shuffled_rows)
-    rows = [rows[0]] + shuffled_rows
-
-  return rows, None
+    else:
+      yield from rows
+
+  return generate(), None
+
+
+def export_responses(
+  session: "SessionType",
+  notebook: Union[Notebook, CachedNotebook],
+  req_questions: List[str],
+  *,
+  user_hashes: bool = False,
+  usernames: bool = False,
+  since: Optional[dt.datetime] = None,
+) -> Tuple[List[List[str]], Optional[str]]:
+  """
+  Export responses for questions in the specified notebook to a 2D list. If ``req_questions`` is
+  empty, no question filtering is applied. Usernames or pseudonymized usernames can be included by
+  setting ``usernames`` or ``user_hashes`` to true, resp. See ``iter_responses`` for ``since``.
+  """
+  rows, err = iter_responses(
+    session, notebook, req_questions, user_hashes=user_hashes, usernames=usernames, since=since)
+  if err:
+    return [], err
+
+  return list(rows), None
+
+
+def get_response_stats(
+  session: "SessionType",
+  notebook_id: Optional[int],
+  req_questions: List[str],
+  *,
+  max_answers: Optional[int] = None,
+) -> Dict:
+  """
+  Compute aggregate statistics for the responses to questions in a notebook. If ``req_questions``
+  is empty, no question filtering is applied. If ``notebook_id`` is ``None`` (i.e. the notebook
+  does not exist), the statistics are empty.
+
+  The statistics are a JSON-serializable dict with the number of responses and the timestamp of the
+  latest response to the notebook, along with the number of responses to each question and a
+  histogram of ``[answer, count]`` pairs with the number of users who gave each distinct answer,
+  most common first. The histogram is a list rather than a mapping so that its order survives JSON
+  serialization, which sorts keys. If ``max_answers`` is provided, only the most common answers to
+  each question are included in its histogram (``distinct_answers`` always has the number of
+  distinct answers).
+
+  The responses are aggregated with a ``GROUP BY`` query answered from a covering index, so no
+  individual responses are read. The groups are ordered by question, since some databases (e.g.
+  PostgreSQL with a hash aggregate) don't return them in order otherwise.
+  """
+  questions = {q: {"responses": 0, "distinct_answers": 0, "answers": []} for q in req_questions}
+  if notebook_id is None:
+    return {"responses": 0, "last_updated": None, "questions": questions}
+
+  stmt = (
+    select(Response.question_identifier, Response.response, func.count())
+      .where(Response.notebook_id == notebook_id)
+      .group_by(Response.question_identifier, Response.response)
+      .order_by(Response.question_identifier)
+  )
+  if req_questions:
+    stmt = stmt.where(Response.question_identifier.in_(req_questions))
+
+  for q, answers in groupby(session.execute(stmt), key=lambda r: r[0]):
+    answers = sorted(((res, count) for _, res, count in answers), key=lambda a: (-a[1], a[0]))
+    questions[q] = {
+      "responses": sum(count for _, count in answers),
+      "distinct_answers": len(answers),
+      "answers": [list(a) for a in answers[:max_answers]],
+    }
+
+  last_updated = get_latest_response_timestamp(session, notebook_id)
+  return {
+    "responses": sum(s["responses"] for s in questions.values()),
+    "last_updated": last_updated.isoformat() if last_updated is not None else None,
+    "questions": dict(sorted(questions.items())),
+  }
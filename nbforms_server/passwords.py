@@ -0,0 +1,200 @@
+"""Password hashing settings and a bounded worker pool for hashing in an nbforms server"""
+
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Mapping, Optional, TypeVar, TYPE_CHECKING
+
+from .metrics import Metrics, server_metrics
+
+if TYPE_CHECKING:
+  from flask import Flask
+
+
+T = TypeVar("T")
+
+ARGON2_PARAMETERS = ["time_cost", "memory_cost", "parallelism"]
+"""the argon2 parameters that can be set by a profile or overridden individually"""
+
+ARGON2_PROFILES: Dict[str, Dict[str, int]] = {
+  # the OWASP minimum for argon2id, for small VMs where login latency matters most
+  "low": {
+    "time_cost": 2,
+    "memory_cost": 19456,
+    "parallelism": 1,
+  },
+  # argon2-cffi's default (RFC 9106's low-memory recommendation)
+  "default": {
+    "time_cost": 3,
+    "memory_cost": 65536,
+    "parallelism": 4,
+  },
+  # a larger security margin for hosts with memory and cores to spare
+  "high": {
+    "time_cost": 4,
+    "memory_cost": 262144,
+    "parallelism": 4,
+  },
+}
+"""named sets of argon2 parameters, from cheapest to most expensive"""
+
+
+def get_argon2_parameters(config: Mapping[str, Any]) -> Dict[str, int]:
+  """
+  Determine the argon2 parameters to hash passwords with from an app config. The profile is
+  selected with ``ARGON2_PROFILE``, and any parameter can be overridden with a config value named
+  after it (e.g. ``ARGON2_TIME_COST``).
+  """
+  profile = config.get("ARGON2_PROFILE", "default")
+  if profile not in ARGON2_PROFILES:
+    raise ValueError(f"Unknown argon2 profile: {profile}")
+
+  params = dict(ARGON2_PROFILES[profile])
+  for p in ARGON2_PARAMETERS:
+    value = config.get(f"ARGON2_{p.upper()}")
+    if value is not None:
+      params[p] = int(value)
+
+  return params
+
+
+class PasswordPoolFullError(Exception):
+  """
+  An exception raised when a password hashing operation is rejected because the pool's queue is
+  full.
+  """
+
+
+class PasswordPool:
+  """
+  A thread pool that runs argon2 hashing and verification with a cap on the number of concurrent
+  operations and on the number of operations waiting for a thread.
+
+  argon2 releases the GIL while hashing, so threads give real parallelism up to ``size``. Once
+  ``size`` operations are running and ``max_queue`` more are waiting, further operations are
+  rejected with a ``PasswordPoolFullError`` instead of stalling the caller.
+
+  The limits apply to each server process, not to the server as a whole, so they only take effect
+  when a process handles several requests at once: with the ASGI bridge, gunicorn's ``gthread``
+  workers, or Flask's threaded development server. A gunicorn ``sync`` worker handles one request
+  at a time, so it never has more than one operation in flight, and the number of concurrent
+  operations is bounded by the number of workers instead.
+  """
+
+  size: int
+  """the number of threads hashing passwords"""
+
+  max_queue: int
+  """the maximum number of operations waiting for a thread"""
+
+  retry_after: int
+  """the number of seconds rejected clients should wait before retrying"""
+
+  def __init__(self, size: Optional[int] = None, max_queue: int = 64, retry_after: int = 1):
+    self._lock = threading.Lock()
+    self._executor: Optional[ThreadPoolExecutor] = None
+    self.configure(size, max_queue, retry_after)
+
+  def configure(self, size: Optional[int], max_queue: int, retry_after: int):
+    """
+    Update the pool's settings and reset its metrics. If ``size`` is ``None``, one thread is used
+    per CPU (up to 4).
+    """
+    with self._lock:
+      if self._executor is not None:
+        self._executor.shutdown(wait=False)
+        self._executor = None
+
+      self.size = size or min(4, os.cpu_count() or 1)
+      self.max_queue, self.retry_after = max_queue, retry_after
+      self._in_flight, self._running = 0, 0
+      self.completed, self.rejected = 0, 0
+      self.seconds_total, self.seconds_max = 0.0, 0.0
+
+  def init_app(self, app: "Flask"):
+    """
+    Configure the pool from the app's config (the limits are per process):
+
+    * ``PASSWORD_POOL_SIZE``: the number of threads (one per CPU, up to 4, if ``None``)
+    * ``PASSWORD_POOL_MAX_QUEUE``: the maximum number of operations waiting for a thread
+    * ``PASSWORD_POOL_RETRY_AFTER``: the value of the ``Retry-After`` header sent when the pool is
+      full
+    """
+    self.configure(
+      app.config["PASSWORD_POOL_SIZE"],
+      app.config["PASSWORD_POOL_MAX_QUEUE"],
+      app.config["PASSWORD_POOL_RETRY_AFTER"],
+    )
+    app.extensions["nbforms_password_pool"] = self
+    server_metrics.add_collector("password_pool", self.record_metrics)
+
+  def _timed(self, fn: Callable[..., T], *args: Any) -> T:
+    """
+    Call ``fn`` in a pool thread, recording how long it takes.
+    """
+    with self._lock:
+      self._running += 1
+    start = time.perf_counter()
+    try:
+      return fn(*args)
+    finally:
+      elapsed = time.perf_counter() - start
+      with self._lock:
+        self._running -= 1
+        self.completed += 1
+        self.seconds_total += elapsed
+        self.seconds_max = max(self.seconds_max, elapsed)
+      server_metrics.observe("nbforms_password_hash_duration_seconds", elapsed, getattr(fn, "__name__", "other"))
+
+  def run(self, fn: Callable[..., T], *args: Any) -> T:
+    """
+    Call ``fn(*args)`` in the pool and wait for its result. Raises a ``PasswordPoolFullError`` if
+    the pool already has ``size + max_queue`` operations in flight.
+    """
+    with self._lock:
+      if self._in_flight >= self.size + self.max_queue:
+        self.rejected += 1
+        raise PasswordPoolFullError("password hashing queue is full")
+
+      if self._executor is None:
+        self._executor = ThreadPoolExecutor(self.size, thread_name_prefix="nbforms-password")
+
+      self._in_flight += 1
+      executor = self._executor
+
+    try:
+      return executor.submit(self._timed, fn, *args).result()
+    finally:
+      with self._lock:
+        self._in_flight -= 1
+
+  def record_metrics(self, metrics: Metrics):
+    """
+    Set the pool's size, in-flight operations, queue depth, and rejections in ``metrics``.
+    """
+    stats = self.stats()
+    metrics.set("nbforms_password_pool_size", stats["size"])
+    metrics.set("nbforms_password_pool_in_flight", stats["in_flight"])
+    metrics.set("nbforms_password_pool_queue_depth", stats["queue_depth"])
+    metrics.set("nbforms_password_pool_rejected_total", stats["rejected"])
+
+  def stats(self) -> Dict[str, float]:
+    """
+    Return the pool's size, current queue depth, and hashing metrics.
+    """
+    with self._lock:
+      return {
+        "size": self.size,
+        "max_queue": self.max_queue,
+        "in_flight": self._in_flight,
+        "queue_depth": self._in_flight - self._running,
+        "completed": self.completed,
+        "rejected": self.rejected,
+        "seconds_total": self.seconds_total,
+        "seconds_max": self.seconds_max,
+      }
+
+
+password_pool = PasswordPool()
@@ -0,0 +1,266 @@
+"""Incrementally maintained per-notebook response pivots for an nbforms server"""
+
+import datetime as dt
+import hashlib
+import json
+import random
+import threading
+
+from sqlalchemy import select
+from typing import Dict, Iterator, List, Optional, Tuple, TYPE_CHECKING
+
+from .cache import LRUCache
+from .models import (
+  count_log_entries,
+  get_responses_version,
+  hash_username,
+  Response,
+  ResponseLogEntry,
+  ResponsesVersion,
+  User,
+)
+
+if TYPE_CHECKING:
+  from flask import Flask
+  from sqlalchemy.orm import Session as SessionType
+
+
+def _log_ids_ordered(session: "SessionType") -> bool:
+  """
+  Return whether response log entries commit in the order of their IDs in the session's DB, which
+  they do in SQLite, where writes are serialized.
+  """
+  return session.get_bind().dialect.name == "sqlite"
+
+
+class ResponsePivot:
+  """
+  The latest response of every user to every question in a notebook.
+
+  The pivot is kept up to date from the response log: when the notebook's responses version (see
+  ``get_responses_version``) changes, only the log entries appended since the last refresh are
+  read. The pivot is rebuilt from the responses table if responses were deleted or if any entries
+  are missing from the range read (e.g. because a transaction that was assigned a smaller ID
+  committed later, which cannot happen in SQLite), so it always matches the non-cached export.
+
+  Each user's answers are never modified once another thread can read them: refreshes replace
+  them with updated copies, so exports can read a snapshot of the pivot outside of its lock.
+  """
+
+  notebook_id: int
+  """the ID of the notebook"""
+
+  version: Optional[ResponsesVersion]
+  """the version of the notebook's responses the pivot reflects, or ``None`` if it is empty"""
+
+  latest: Optional[dt.datetime]
+  """the timestamp of the most recent response in the pivot, or ``None`` if it is empty"""
+
+  def __init__(self, notebook_id: int):
+    self.notebook_id = notebook_id
+    self.version = None
+    self.latest = None
+    self._lock = threading.Lock()
+    # maps user IDs to usernames and the user's latest response and its timestamp by question
+    self._users: Dict[int, Tuple[str, Dict[str, Tuple[str, dt.datetime]]]] = {}
+    # the number of the notebook's log entries up to the version's last log ID (not counted in SQLite)
+    self._log_count = 0
+
+  def refresh(self, session: "SessionType") -> ResponsesVersion:
+    """
+    Bring the pivot up to date with the DB and return the version it now reflects. If the version
+    has changed, the log entries are counted to check that none are missing, except in SQLite,
+    where entries commit in the order of their IDs (see ``ResponsesVersion``) so none can be.
+    """
+    with self._lock:
+      version = get_responses_version(session, self.notebook_id)
+      if version == self.version:
+        return version
+
+      check_gaps = not _log_ids_ordered(session)
+      old = self.version
+      if (
+        old is not None
+        and old.last_log_id is not None
+        and version.generation == old.generation
+        and version.last_log_id is not None
+        and version.last_log_id > old.last_log_id
+      ):
+        applied = self._apply_log(session, old.last_log_id, version.last_log_id)
+        if not check_gaps:
+          self.version = version
+          return version
+
+        log_count = count_log_entries(session, self.notebook_id, version.last_log_id)
+        if self._log_count + applied == log_count:
+          self._log_count = log_count
+          self.version = version
+          return version
+
+      self._rebuild(session)
+      if check_gaps:
+        self._log_count = count_log_entries(session, self.notebook_id, version.last_log_id)
+      self.version = version
+      return version
+
+  def _apply_log(self, session: "SessionType", after_id: int, through_id: int) -> int:
+    """
+    Apply the notebook's response log entries with IDs in ``(after_id, through_id]`` in order,
+    returning the number of entries applied.
+    """
+    stmt = (
+      select(
+        ResponseLogEntry.user_id,
+        User.username,
+        ResponseLogEntry.question_identifier,
+        ResponseLogEntry.response,
+        ResponseLogEntry.timestamp,
+      )
+        .join(User, ResponseLogEntry.user_id == User.id)
+        .where(ResponseLogEntry.notebook_id == self.notebook_id)
+        .where(ResponseLogEntry.id > after_id)
+        .where(ResponseLogEntry.id <= through_id)
+        .order_by(ResponseLogEntry.id)
+    )
+
+    applied, copied = 0, set()
+    for user_id, username, q, res, ts in session.execute(stmt):
+      # replace each user's answers instead of updating them in place, since ``rows`` reads them
+      # without holding the lock
+      if user_id not in copied:
+        self._users[user_id] = (username, dict(self._users.get(user_id, (username, {}))[1]))
+        copied.add(user_id)
+
+      self._users[user_id][1][q] = (res, ts)
+      if self.latest is None or ts > self.latest:
+        self.latest = ts
+      applied += 1
+
+    return applied
+
+  def _rebuild(self, session: "SessionType"):
+    """
+    Rebuild the pivot from the responses table.
+    """
+    stmt = (
+      select(Response.user_id, User.username, Response.question_identifier, Response.response, Response.timestamp)
+        .join(User, Response.user_id == User.id)
+        .where(Response.notebook_id == self.notebook_id)
+    )
+
+    users, latest = {}, None
+    for user_id, username, q, res, ts in session.execute(stmt):
+      users.setdefault(user_id, (username, {}))[1][q] = (res, ts)
+      if latest is None or ts > latest:
+        latest = ts
+
+    self._users, self.latest = users, latest
+
+  def rows(
+    self,
+    req_questions: List[str],
+    *,
+    user_hashes: bool = False,
+    usernames: bool = False,
+    since: Optional[dt.datetime] = None,
+  ) -> Tuple[Optional[Iterator[List[str]]], Optional[str]]:
+    """
+    Export a snapshot of the pivot as an iterator over the rows of a 2D list in the same format as
+    ``iter_responses`` (including the handling of ``since``). Rows are generated as the iterator is
+    consumed (unless ``user_hashes`` is true, in which case they are all generated first so that
+    they can be shuffled). Returns a tuple of the iterator and an error message; exactly one of
+    these will be ``None``.
+    """
+    with self._lock:
+      users = [
+        (username, answers if not req_questions else {q: answers[q] for q in req_questions if q in answers})
+        for username, answers in self._users.values()
+      ]
+
+    users = sorted((u for u in users if u[1]), key=lambda u: u[0])
+    questions = set(q for _, answers in users for q in answers)
+    if len(questions) == 0:
+      return None, "no responses found"
+
+    questions = sorted(questions.union(req_questions))
+
+    def iter_rows():
+      for username, answers in users:
+        if since is not None and not any(ts > since for _, ts in answers.values()):
+          continue
+
+        row = []
+        if user_hashes:
+          row.append(hash_username(username))
+        elif usernames:
+          row.append(username)
+
+        row.extend(answers[q][0] if q in answers else "" for q in questions)
+        yield row
+
+    def generate():
+      yield (["user"] if user_hashes or usernames else []) + questions
+
+      # shuffle pseudonymized rows as ``iter_responses`` does
+      if user_hashes:
+        shuffled_rows = list(iter_rows())
+        random.shuffle(shuffled_rows)
+        yield from shuffled_rows
+
+      else:
+        yield from iter_rows()
+
+    return generate(), None
+
+
+def responses_etag(
+  notebook_id: int,
+  version: ResponsesVersion,
+  req_questions: List[str],
+  *,
+  user_hashes: bool = False,
+  usernames: bool = False,
+  since: Optional[dt.datetime] = None,
+) -> str:
+  """
+  Create an ETag for an export of a notebook's responses at ``version`` with the provided options.
+  """
+  key = json.dumps([
+    notebook_id,
+    *version,
+    sorted(req_questions),
+    user_hashes,
+    usernames,
+    since.isoformat() if since is not None else None,
+  ])
+  return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+class PivotCache(LRUCache[int, ResponsePivot]):
+  """
+  A cache mapping notebook IDs to their response pivots.
+  """
+
+  def init_app(self, app: "Flask"):
+    """
+    Configure the cache from the app's config:
+
+    * ``RESPONSE_PIVOT_CACHE_SIZE``: the maximum number of cached notebook pivots (0 disables the
+      cache)
+    """
+    self.configure(app.config["RESPONSE_PIVOT_CACHE_SIZE"], None, False)
+    app.extensions["nbforms_response_pivots"] = self
+
+  def get_pivot(self, notebook_id: int) -> ResponsePivot:
+    """
+    Return the pivot for a notebook, creating an empty one if it is not cached.
+    """
+    pivot = self.get(notebook_id)
+    if pivot is None:
+      pivot = ResponsePivot(notebook_id)
+      self.put(notebook_id, pivot)
+
+    return pivot
+
+
+response_pivots = PivotCache()
@@ -0,0 +1,270 @@
+"""Opt-in request profiling and a slow-request log for an nbforms server"""
+
+import cProfile
+import datetime as dt
+import hmac
+import io
+import json
+import os
+import pstats
+import threading
+import time
+
+from flask import g, has_app_context, request
+from typing import Any, Dict, List, Optional, TYPE_CHECKING
+
+from .metrics import get_request_timer, RequestTimer, time_requests
+
+if TYPE_CHECKING:
+  from flask import Flask, Response as FlaskResponse
+
+
+PROFILE_HEADER = "X-Nbforms-Profile"
+"""the request header that asks for a request to be profiled; its value must be ``PROFILE_TOKEN``"""
+
+MAX_LOGGED_STATEMENTS = 20
+"""the number of a request's slowest SQL statements included in its slow-request log record"""
+
+MAX_STATEMENT_LENGTH = 500
+"""the number of characters of each SQL statement included in a slow-request log record"""
+
+TOP_FUNCTIONS = 15
+"""the number of functions with the most cumulative time included in a profiled request's record"""
+
+
+class RequestProfile:
+  """
+  The profile of the request being handled, and the timer that times its SQL statements and commits.
+  """
+
+  __slots__ = ("timer", "handler_end", "fields", "profiler")
+
+  def __init__(self, timer: RequestTimer, profiler: Optional[cProfile.Profile]):
+    self.timer, self.profiler = timer, profiler
+    self.handler_end = 0.0
+    self.fields: Dict[str, Any] = {}
+
+
+def _current_profile() -> Optional[RequestProfile]:
+  return g.get("_nbforms_profile") if has_app_context() else None
+
+
+def _top_functions(profiler: cProfile.Profile, n: int) -> List[Dict[str, Any]]:
+  """
+  Return the ``n`` functions with the most cumulative time in a profile.
+  """
+  stats = pstats.Stats(profiler, stream=io.StringIO())
+  rows = sorted(stats.stats.items(), key=lambda kv: kv[1][3], reverse=True)[:n]
+  return [
+    {
+      "function": f"{os.path.basename(file)}:{line}({fn})",
+      "calls": nc,
+      "total_ms": round(tt * 1000, 3),
+      "cumulative_ms": round(ct * 1000, 3),
+    } for (file, line, fn), (_, nc, tt, ct, _) in rows
+  ]
+
+
+class RequestProfiler:
+  """
+  Records the timings of requests and writes those that are slow or profiled to a log of JSON
+  records, one per line.
+
+  Every request's SQL statements and commits are timed while the slow-request log is enabled. A
+  request is also profiled with ``cProfile`` if profiling is enabled for every request or if it has
+  a ``X-Nbforms-Profile`` header with the profile token; its profile is written to the profile
+  directory and its most expensive functions are added to its record, which is logged whether or
+  not it is slow. Only the handler is profiled, not the streaming of a streamed response, which
+  may run in other threads. If nothing is enabled, the app is not instrumented at all.
+  """
+
+  enabled: bool
+  """whether any requests are timed"""
+
+  profile_all: bool
+  """whether every request is profiled"""
+
+  token: Optional[str]
+  """the value of the profile header that asks for a request to be profiled"""
+
+  log_path: Optional[str]
+  """the path of the slow-request log, or ``None`` if slow requests are not logged"""
+
+  slow_ms: float
+  """the number of milliseconds after which a request is logged as slow"""
+
+  profile_dir: str
+  """the directory that profiles are written to"""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._count = 0
+    self.configure(False, None, None, 1000, "profiles")
+
+  def configure(
+    self,
+    profile_all: bool,
+    token: Optional[str],
+    log_path: Optional[str],
+    slow_ms: float,
+    profile_dir: str,
+  ):
+    """
+    Update the profiler's settings.
+    """
+    self.profile_all, self.token, self.log_path = profile_all, token, log_path
+    self.slow_ms, self.profile_dir = slow_ms, profile_dir
+    self.enabled = bool(profile_all or token or log_path)
+
+  def init_app(self, app: "Flask"):
+    """
+    Configure the profiler from the app's config and, if anything is enabled, instrument the app's
+    requests and DB engine and session:
+
+    * ``PROFILE_REQUESTS``: whether to profile every request
+    * ``PROFILE_TOKEN``: a secret that profiles a request when sent in the ``X-Nbforms-Profile``
+      header (disabled if ``None``)
+    * ``PROFILE_DIR``: the directory to write profiles to (defaults to ``profiles`` in the app's
+      instance folder)
+    * ``SLOW_REQUEST_LOG``: the path of the slow-request log (disabled if ``None``)
+    * ``SLOW_REQUEST_MS``: the number of milliseconds after which a request is logged as slow
+    """
+    self.configure(
+      app.config["PROFILE_REQUESTS"],
+      app.config["PROFILE_TOKEN"],
+      app.config["SLOW_REQUEST_LOG"],
+      app.config["SLOW_REQUEST_MS"],
+      app.config["PROFILE_DIR"] or os.path.join(app.instance_path, "profiles"),
+    )
+    app.extensions["nbforms_request_profiler"] = self
+    if not self.enabled:
+      return
+
+    # the SQL statements and commits are timed by the request timer shared with the metrics registry
+    time_requests(app)
+    app.before_request(self._before_request)
+    app.after_request(self._after_request)
+
+  def _should_profile(self) -> bool:
+    if self.profile_all:
+      return True
+    header = request.headers.get(PROFILE_HEADER)
+    return bool(self.token and header and hmac.compare_digest(header, self.token))
+
+  def _before_request(self):
+    timer = get_request_timer()
+    if not self.enabled or timer is None:
+      return
+
+    profiler = None
+    if self._should_profile():
+      profiler = cProfile.Profile()
+      try:
+        profiler.enable()
+      except ValueError:
+        # another profiler is already running in this thread
+        profiler = None
+
+    timer.statements = []
+    g._nbforms_profile = RequestProfile(timer, profiler)
+
+  def _after_request(self, response: "FlaskResponse") -> "FlaskResponse":
+    profile = g.get("_nbforms_profile")
+    if profile is None:
+      return response
+
+    profile.handler_end = time.perf_counter()
+
+    # cProfile hooks the thread that enabled it, and the rest of a streamed response may be produced
+    # (and closed) in other threads (e.g. by the ASGI bridge), so profiling stops with the handler
+    if profile.profiler is not None:
+      profile.profiler.disable()
+
+    body = request.get_json(silent=True)
+    if isinstance(body, dict) and isinstance(body.get("notebook"), str):
+      profile.fields.setdefault("notebook", body["notebook"])
+
+    status = response.status_code
+    if response.is_streamed:
+      # streamed responses are still being generated, so the request is finished once it is closed
+      response.call_on_close(lambda: self._finish(profile, status))
+    else:
+      self._finish(profile, status)
+    return response
+
+  def annotate(self, **fields: Any):
+    """
+    Add fields (e.g. the number of responses submitted) to the record of the request being handled,
+    if it is being timed.
+    """
+    if self.enabled and (profile := _current_profile()) is not None:
+      profile.fields.update(fields)
+
+  def _finish(self, profile: RequestProfile, status: int):
+    timer, end = profile.timer, time.perf_counter()
+    duration_ms = (end - timer.start) * 1000
+    if profile.profiler is None and (duration_ms < self.slow_ms or not self.log_path):
+      return
+
+    record = {
+      "timestamp": dt.datetime.now().isoformat(),
+      "route": timer.route,
+      "method": timer.method,
+      "status": status,
+      "notebook": None,
+      "responses": None,
+      **profile.fields,
+      "duration_ms": round(duration_ms, 3),
+      "phases": {
+        "handler_ms": round((profile.handler_end - timer.start) * 1000, 3),
+        "stream_ms": round((end - profile.handler_end) * 1000, 3),
+        "sql_ms": round(timer.sql_seconds * 1000, 3),
+        "commit_ms": round(timer.commit_seconds * 1000, 3),
+      },
+      "sql_statements": timer.sql_statements,
+      "slowest_sql": [
+        {"statement": s[:MAX_STATEMENT_LENGTH], "ms": round(t * 1000, 3)}
+        for s, t in sorted(timer.statements, key=lambda st: st[1], reverse=True)[:MAX_LOGGED_STATEMENTS]
+      ],
+    }
+
+    if profile.profiler is not None:
+      record["profile"] = self._write_profile(profile.profiler, timer.route)
+      record["top_functions"] = _top_functions(profile.profiler, TOP_FUNCTIONS)
+
+    if self.log_path:
+      line = json.dumps(record) + "\n"
+      with self._lock, open(self.log_path, "a") as f:
+        f.write(line)
+
+  def _write_profile(self, profiler: cProfile.Profile, route: str) -> str:
+    """
+    Write a profile to the profile directory, returning its path.
+    """
+    with self._lock:
+      self._count += 1
+      count = self._count
+
+    os.makedirs(self.profile_dir, exist_ok=True)
+    slug = route.strip("/").replace("/", "_") or "index"
+    path = os.path.join(
+      self.profile_dir, f"{dt.datetime.now():%Y%m%dT%H%M%S}-{slug}-{os.getpid()}-{count}.prof")
+    profiler.dump_stats(path)
+    return path
+
+
+def load_slow_requests(lines: List[str]) -> List[Dict[str, Any]]:
+  """
+  Parse the records of a slow-request log, skipping any lines that are not valid JSON (e.g. one
+  that was being written when the log was read).
+  """
+  records = []
+  for line in lines:
+    try:
+      records.append(json.loads(line))
+    except ValueError:
+      continue
+  return records
+
+
+request_profiler = RequestProfiler()
@@ -0,0 +1,252 @@
+"""Online snapshots of an nbforms server's SQLite database"""
+
+import os
+import sqlite3
+import time
+
+from typing import Callable, Dict, NamedTuple, Optional, TYPE_CHECKING
+
+from .models import CacheGeneration
+
+if TYPE_CHECKING:
+  from sqlalchemy.engine import Engine
+
+
+SNAPSHOT_STEP_PAGES = 1024
+"""the default number of pages copied in each step of a backup"""
+
+MAX_BACKUP_RESTARTS = 10
+"""the number of times a backup can be restarted by concurrent writes before it is abandoned"""
+
+
+class BackupProgress(NamedTuple):
+  """
+  The progress of a backup after a step.
+  """
+
+  copied: int
+  """the number of pages copied so far"""
+
+  total: int
+  """the number of pages in the source database"""
+
+  page_size: int
+  """the size of each page in bytes"""
+
+  seconds: float
+  """the number of seconds since the backup started"""
+
+
+class BackupStats(NamedTuple):
+  """
+  Statistics about a completed backup.
+  """
+
+  pages: int
+  """the number of pages copied"""
+
+  page_size: int
+  """the size of each page in bytes"""
+
+  steps: int
+  """the number of steps the backup took"""
+
+  restarts: int
+  """the number of times the backup was restarted because the source database was written to"""
+
+  seconds: float
+  """the duration of the backup in seconds"""
+
+  max_step_seconds: float
+  """the duration of the longest step in seconds, during which the source was locked"""
+
+  @property
+  def bytes(self) -> int:
+    """
+    The size of the copied database in bytes.
+    """
+    return self.pages * self.page_size
+
+  @property
+  def throughput(self) -> float:
+    """
+    The number of bytes copied per second.
+    """
+    return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+
+def get_sqlite_path(engine: "Engine") -> str:
+  """
+  Get the path of the SQLite database file that ``engine`` is connected to. Raises a ``ValueError``
+  if the database is not a SQLite file.
+  """
+  if engine.dialect.name != "sqlite" or engine.url.database in (None, "", ":memory:"):
+    raise ValueError("Snapshots are only supported for SQLite database files")
+  return engine.url.database
+
+
+def backup_database(
+  src: sqlite3.Connection,
+  dst: sqlite3.Connection,
+  *,
+  pages: int = SNAPSHOT_STEP_PAGES,
+  pause: float = 0,
+  progress: Optional[Callable[[BackupProgress], None]] = None,
+) -> BackupStats:
+  """
+  Copy the database of ``src`` into that of ``dst`` with SQLite's online backup API, ``pages``
+  pages at a time, pausing for ``pause`` seconds between steps. ``progress`` is called after each
+  step.
+
+  If the source is in WAL mode, a read transaction is held on it for the whole backup, so the copy
+  is of a consistent snapshot and writers on other connections are never blocked. Otherwise, the
+  source is only locked during each step, but SQLite restarts the backup whenever another
+  connection writes to it; after ``MAX_BACKUP_RESTARTS`` restarts, a ``RuntimeError`` is raised.
+  """
+  page_size = src.execute("PRAGMA page_size").fetchone()[0]
+  wal = src.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal"
+
+  steps, restarts, max_step = 0, 0, 0.0
+  last_remaining = None
+  start = last = time.perf_counter()
+
+  def on_step(status, remaining, total):
+    nonlocal steps, restarts, max_step, last_remaining, last
+    now = time.perf_counter()
+    steps += 1
+    max_step = max(max_step, now - last)
+    if last_remaining is not None and remaining > last_remaining:
+      restarts += 1
+      if restarts > MAX_BACKUP_RESTARTS:
+        raise RuntimeError(
+          f"Backup restarted {restarts} times because the database was written to; use WAL mode "
+          "(e.g. the 'safe' or 'fast' SQLite profile) to back it up while it is in use")
+
+    last_remaining = remaining
+    if progress is not None:
+      progress(BackupProgress(total - remaining, total, page_size, now - start))
+    if pause and remaining:
+      time.sleep(pause)
+    last = time.perf_counter()
+
+  in_transaction = src.in_transaction
+  if wal and not in_transaction:
+    # a read transaction pins the snapshot that every step copies from
+    src.execute("BEGIN")
+    src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+
+  try:
+    src.backup(dst, pages=pages, progress=on_step)
+  finally:
+    if wal and not in_transaction:
+      src.execute("COMMIT")
+
+  total = dst.execute("PRAGMA page_count").fetchone()[0]
+  return BackupStats(total, page_size, steps, restarts, time.perf_counter() - start, max_step)
+
+
+def create_snapshot(
+  db_path: str,
+  dest: str,
+  *,
+  pages: int = SNAPSHOT_STEP_PAGES,
+  pause: float = 0,
+  progress: Optional[Callable[[BackupProgress], None]] = None,
+) -> BackupStats:
+  """
+  Write a consistent copy of the SQLite database at ``db_path`` to ``dest`` while it is in use
+  (see ``backup_database``). The copy is written to a temporary file next to ``dest`` that is
+  renamed once it is complete, so ``dest`` is never left partially written.
+  """
+  tmp = f"{dest}.tmp"
+  if os.path.exists(tmp):
+    os.remove(tmp)
+
+  src = sqlite3.connect(db_path, isolation_level=None)
+  dst = sqlite3.connect(tmp)
+  try:
+    stats = backup_database(src, dst, pages=pages, pause=pause, progress=progress)
+  except BaseException:
+    dst.close()
+    os.remove(tmp)
+    raise
+  finally:
+    src.close()
+
+  dst.close()
+  os.replace(tmp, dest)
+  return stats
+
+
+def restore_snapshot(
+  snapshot: str,
+  db_path: str,
+  *,
+  pages: int = SNAPSHOT_STEP_PAGES,
+  progress: Optional[Callable[[BackupProgress], None]] = None,
+) -> BackupStats:
+  """
+  Replace the contents of the SQLite database at ``db_path`` with the snapshot at ``snapshot``.
+  Raises a ``ValueError`` if the snapshot fails SQLite's integrity check.
+
+  The server must be stopped first: its processes cache user and notebook IDs (and, unless
+  ``API_KEY_CACHE_SHARED`` is enabled, API keys) without checking the DB, and a restore can change
+  them. This is enforced for databases in WAL mode (as with the ``safe`` and ``fast`` SQLite
+  profiles), which SQLite can only switch out of WAL mode when no other connection has them open:
+  the database is switched to a rollback journal before the restore, and a ``RuntimeError`` is
+  raised if it is in use. Afterwards, every cache generation is set past both its value before the
+  restore and its value in the snapshot.
+  """
+  src = sqlite3.connect(f"file:{snapshot}?mode=ro", uri=True, isolation_level=None)
+  dst = sqlite3.connect(db_path, isolation_level=None, timeout=30)
+  try:
+    check = src.execute("PRAGMA quick_check").fetchone()[0]
+    if check != "ok":
+      raise ValueError(f"Snapshot failed integrity check: {check}")
+
+    _leave_wal_mode(dst)
+    generations = _get_cache_generations(dst)
+    stats = backup_database(src, dst, pages=pages, progress=progress)
+
+    table = CacheGeneration.__tablename__
+    for name, generation in generations.items():
+      dst.execute(
+        f"UPDATE {table} SET generation = MAX(generation, ?) + 1 WHERE name = ?", (generation, name))
+
+  finally:
+    src.close()
+    dst.close()
+
+  return stats
+
+
+def _leave_wal_mode(conn: sqlite3.Connection):
+  """
+  Switch a SQLite database in WAL mode to a rollback journal, raising a ``RuntimeError`` if it is
+  open in another connection. The busy timeout is suspended, since idle connections keep their
+  locks.
+  """
+  if conn.execute("PRAGMA journal_mode").fetchone()[0].lower() != "wal":
+    return
+
+  timeout = conn.execute("PRAGMA busy_timeout").fetchone()[0]
+  conn.execute("PRAGMA busy_timeout = 0")
+  try:
+    mode = conn.execute("PRAGMA journal_mode = DELETE").fetchone()[0]
+  except sqlite3.OperationalError:
+    mode = "wal"
+  finally:
+    conn.execute(f"PRAGMA busy_timeout = {int(timeout)}")
+
+  if mode.lower() == "wal":
+    raise RuntimeError("The database is in use; stop the server before restoring a snapshot")
+
+
+def _get_cache_generations(conn: sqlite3.Connection) -> Dict[str, int]:
+  """
+  Read the cache generations from a SQLite database, if it has the table for them.
+  """
+  table = CacheGeneration.__tablename__
+  if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is None:
+    return {}
+  return dict(conn.execute(f"SELECT name, generation FROM {table}"))
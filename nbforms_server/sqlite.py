@@ -0,0 +1,74 @@
+"""SQLite connection tuning for an nbforms server"""
+
+import re
+
+from sqlalchemy import event
+from typing import Any, Dict, Mapping, TYPE_CHECKING, Union
+
+if TYPE_CHECKING:
+  from sqlalchemy.engine import Engine
+
+
+PRAGMAS = ["journal_mode", "busy_timeout", "synchronous", "cache_size", "mmap_size", "temp_store"]
+"""the pragmas that can be set by a profile or overridden individually"""
+
+SQLITE_PROFILES: Dict[str, Dict[str, Union[int, str]]] = {
+  # SQLite's defaults (a rollback journal with a full fsync on every commit)
+  "default": {},
+  # allow readers and a writer to run concurrently and wait for locks instead of failing
+  "safe": {
+    "journal_mode": "WAL",
+    "busy_timeout": 5000,
+    "synchronous": "FULL",
+  },
+  # additionally, only fsync at WAL checkpoints and keep more of the DB in memory
+  "fast": {
+    "journal_mode": "WAL",
+    "busy_timeout": 5000,
+    "synchronous": "NORMAL",
+    "cache_size": -64000,
+    "mmap_size": 268435456,
+    "temp_store": "MEMORY",
+  },
+}
+"""named sets of pragmas applied to every new SQLite connection"""
+
+
+def get_sqlite_pragmas(config: Mapping[str, Any]) -> Dict[str, Union[int, str]]:
+  """
+  Determine the pragmas to apply to SQLite connections from an app config. The profile is selected
+  with ``SQLITE_PROFILE``, and any pragma can be overridden with a config value named after it
+  (e.g. ``SQLITE_BUSY_TIMEOUT``).
+  """
+  profile = config.get("SQLITE_PROFILE", "default")
+  if profile not in SQLITE_PROFILES:
+    raise ValueError(f"Unknown SQLite profile: {profile}")
+
+  pragmas = dict(SQLITE_PROFILES[profile])
+  for p in PRAGMAS:
+    value = config.get(f"SQLITE_{p.upper()}")
+    if value is not None:
+      pragmas[p] = value
+
+  for p, value in pragmas.items():
+    if not re.fullmatch(r"-?\w+", str(value)):
+      raise ValueError(f"Invalid value for SQLite pragma {p}: {value}")
+
+  return pragmas
+
+
+def configure_sqlite(engine: "Engine", pragmas: Mapping[str, Union[int, str]]):
+  """
+  Apply ``pragmas`` to every new connection made by ``engine``. This is a no-op for engines that
+  are not connected to a SQLite database. It must be called before the engine makes its first
+  connection.
+  """
+  if engine.dialect.name != "sqlite" or not pragmas:
+    return
+
+  @event.listens_for(engine, "connect")
+  def set_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for p, value in pragmas.items():
+      cursor.execute(f"PRAGMA {p} = {value}")
+    cursor.close()
@@ -2,16 +2,34 @@
 
 import csv
 import os
+import zlib
 
 from io import StringIO
-from typing import List, TYPE_CHECKING
+from typing import Iterable, Iterator, List, Optional, TYPE_CHECKING
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
 
 if TYPE_CHECKING:
   from flask import Flask
 
 
+CSV_CHUNK_SIZE = 64 * 1024
+"""the approximate size in bytes of the chunks yielded by ``iter_csv``"""
+
 DB_FILENAME = "nbforms_server.db"
 
+GZIP_LEVEL = 6
+"""the compression level used for gzip"""
+
+ZSTD_LEVEL = 3
+"""the compression level used for zstd"""
+
+CONTENT_ENCODINGS = (["zstd"] if zstandard is not None else []) + ["gzip"]
+"""the supported content encodings in order of preference (zstd requires ``zstandard``)"""
+
 
 def get_db_path(app: "Flask") -> str:
   """
@@ -34,3 +52,70 @@ def to_csv(l: List[List[str]]) -> str:
   w = csv.writer(sio, dialect=csv.unix_dialect, quoting=csv.QUOTE_MINIMAL)
   w.writerows(l)
   return sio.getvalue()
+
+
+def iter_csv(rows: Iterable[List[str]], chunk_size: int = CSV_CHUNK_SIZE) -> Iterator[bytes]:
+  """
+  Convert an iterable of lists of strings into UTF-8-encoded CSV chunks of about ``chunk_size``
+  bytes, consuming ``rows`` lazily.
+
+  Args:
+    rows (``Iterable[list[str]]``): the data
+    chunk_size (``int``): the approximate size of each chunk
+
+  Returns:
+    ``Iterator[bytes]``: the CSV chunks
+  """
+  sio = StringIO()
+  w = csv.writer(sio, dialect=csv.unix_dialect, quoting=csv.QUOTE_MINIMAL)
+  for row in rows:
+    w.writerow(row)
+    if sio.tell() >= chunk_size:
+      yield sio.getvalue().encode()
+      sio.seek(0)
+      sio.truncate()
+
+  if sio.tell():
+    yield sio.getvalue().encode()
+
+
+def negotiate_encoding(accept_encodings) -> Optional[str]:
+  """
+  Choose the content encoding to compress a response with from the request's ``Accept-Encoding``
+  header, or ``None`` if the response should not be compressed.
+
+  Args:
+    accept_encodings (``werkzeug.datastructures.Accept``): the parsed header
+
+  Returns:
+    ``str | None``: the content encoding
+  """
+  return accept_encodings.best_match(CONTENT_ENCODINGS)
+
+
+def compress_chunks(chunks: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+  """
+  Compress an iterable of bytes with a content encoding in ``CONTENT_ENCODINGS``, consuming
+  ``chunks`` lazily. Only non-empty compressed chunks are yielded.
+
+  Args:
+    chunks (``Iterable[bytes]``): the data
+    encoding (``str``): the content encoding
+
+  Returns:
+    ``Iterator[bytes]``: the compressed chunks
+  """
+  if encoding not in CONTENT_ENCODINGS:
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+  if encoding == "zstd":
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+  else:
+    compressor = zlib.compressobj(GZIP_LEVEL, wbits=31)
+
+  for chunk in chunks:
+    out = compressor.compress(chunk)
+    if out:
+      yield out
+
+  yield compressor.flush()
@@ -1,6 +1,9 @@
 import datetime as dt
+import gzip
+import os
 import pytest
 
+from sqlalchemy import make_url
 from unittest import mock
 
 from nbforms_server import create_app
@@ -9,10 +12,15 @@ from nbforms_server.models import (
   db,
   Notebook,
   Response,
+  ResponseLogEntry,
   User,
 )
 
 
+TEST_DATABASE_URI = os.environ.get("NBFORMS_TEST_DATABASE_URL", "sqlite:///:memory:")
+"""the database to run the tests against; it must be empty, and is emptied after each test"""
+
+
 @pytest.fixture
 def app():
   """
@@ -22,9 +30,40 @@ def app():
   with mock.patch("nbforms_server.os"):
     app = create_app({
       "TESTING": True, 
-      "SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:",
+      "SQLALCHEMY_DATABASE_URI": TEST_DATABASE_URI,
     })
-  return app
+
+  yield app
+
+  # an in-memory SQLite DB is discarded along with its engine, but a server DB must be emptied
+  if make_url(TEST_DATABASE_URI).get_backend_name() != "sqlite":
+    with app.app_context():
+      db.session.remove()
+      db.drop_all()
+      db.engine.dispose()
+
+
+@pytest.fixture
+def sqlite_only():
+  """
+  A fixture that skips a test unless the tests are running against SQLite.
+  """
+  if make_url(TEST_DATABASE_URI).get_backend_name() != "sqlite":
+    pytest.skip("requires SQLite")
+
+
+@pytest.fixture(params=(True, False), ids=("dialect_insert", "portable_insert"))
+def dialect_insert(request):
+  """
+  A fixture that runs a test both with the dialect's ``INSERT ... ON CONFLICT`` and with the
+  fallback used by dialects without it (by patching ``nbforms_server.models._dialect_insert``). Its
+  value is whether the dialect's insert is used.
+  """
+  if request.param:
+    yield True
+  else:
+    with mock.patch("nbforms_server.models._dialect_insert", return_value=None):
+      yield False
 
 
 @pytest.fixture(autouse=True)
@@ -80,7 +119,8 @@ def seed_data(app):
 @pytest.fixture
 def seed_responses(app, seed_data):
   """
-  A fixture that seeds the database with users, notebooks, and responses.
+  A fixture that seeds the database with users, notebooks, and responses. Each response is also
+  recorded in the response log.
   """
   users, notebooks = seed_data
   responses = [
@@ -95,8 +135,18 @@ def seed_responses(app, seed_data):
     Response(user=users[2], notebook=notebooks[1], question_identifier="bb2", response="jarjar coruscant bb2", timestamp=make_timestamp(20)),
   ]
 
+  log_entries = [
+    ResponseLogEntry(
+      user=r.user,
+      notebook=r.notebook,
+      question_identifier=r.question_identifier,
+      response=r.response,
+      timestamp=r.timestamp,
+    ) for r in responses
+  ]
+
   with app.app_context():
-    for e in responses:
+    for e in [*responses, *log_entries]:
       db.session.add(e)
     db.session.commit()
 
@@ -135,3 +185,18 @@ def set_api_keys(app):
       db.session.commit()
 
   return do_set
+
+
+@pytest.fixture
+def decompress():
+  """
+  A fixture that provides a function to decompress data. The function takes the data and the
+  content encoding it was compressed with, and skips the test if zstd is needed but ``zstandard``
+  is not installed.
+  """
+  def do_decompress(data, encoding):
+    if encoding == "zstd":
+      return pytest.importorskip("zstandard").ZstdDecompressor().decompressobj().decompress(data)
+    return gzip.decompress(data)
+
+  return do_decompress
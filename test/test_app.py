@@ -5,11 +5,22 @@ import json
 import os
 import pytest
 
+from sqlalchemy import event
 from textwrap import dedent
 from unittest import mock
 
 from nbforms_server import create_app
-from nbforms_server.models import AttendanceSubmission, db, Notebook, Response, User
+from nbforms_server.cache import response_stats
+from nbforms_server.metrics import server_metrics
+from nbforms_server.models import (
+  AttendanceSubmission,
+  db,
+  Notebook,
+  record_responses,
+  Response,
+  ResponseLogEntry,
+  User,
+)
 
 
 count = 0
@@ -381,6 +392,112 @@ def test_submit_update_old_responses(mocked_dt, app, client, seed_responses, set
       assert getattr(r, k) == v, f"wrong value for attribute '{k}' in response {i}"
 
 
+def post_batch(client, body, **kwargs):
+  return client.post("/submit/batch", data=json.dumps(body), content_type="application/json", **kwargs)
+
+
+@mock.patch("nbforms_server.dt")
+def test_submit_batch(mocked_dt, app, client, seed_responses, set_api_keys):
+  """Test the ``/submit/batch`` route."""
+  set_api_keys({"obi-wan": "deadbeef"})
+  mocked_dt.datetime.now.side_effect = make_dt
+
+  statements = []
+  def record(conn, cursor, statement, *args):
+    statements.append(statement)
+
+  with app.app_context():
+    event.listen(db.engine, "before_cursor_execute", record)
+  try:
+    res = post_batch(client, {
+      "api_key": "deadbeef",
+      "submissions": [
+        {"notebook": "naboo", "responses": [{"identifier": "r2d2", "response": "obi-wan naboo r2d2 2"}]},
+        {"notebook": "mustafar", "responses": [{"identifier": "bb8", "response": "obi-wan mustafar bb8"}]},
+        {"notebook": "naboo"},
+        {"notebook": "naboo", "responses": [{"response": "no identifier"}]},
+        "tatooine",
+        {"notebook": "coruscant", "responses": [{"identifier": "c3p0", "response": "obi-wan coruscant c3p0 2"}]},
+      ],
+    })
+  finally:
+    with app.app_context():
+      event.remove(db.engine, "before_cursor_execute", record)
+
+  assert res.status_code == 200, res.data.decode()
+  assert res.get_json() == {
+    "results": [
+      {"status": 200},
+      {"status": 200},
+      {"status": 400, "error": "no responses specified"},
+      {"status": 400, "error": "invalid response: {'response': 'no identifier'}"},
+      {"status": 400, "error": "invalid submission: tatooine"},
+      {"status": 200},
+    ],
+  }
+
+  # the users and notebooks are looked up with one query each (and the new notebook is created)
+  assert sum("FROM users" in s for s in statements) == 1
+  assert sum("FROM notebooks" in s for s in statements) == 2
+  assert sum(s.startswith("INSERT INTO response_log") for s in statements) == 1
+
+  with app.app_context():
+    responses = db.session.query(Response).filter_by(user_id=2).order_by(Response.id).all()
+    assert [(r.notebook.identifier, r.question_identifier, r.response, r.timestamp) for r in responses] == [
+      ("naboo", "c3p0", "obi-wan naboo c3p0", dt.datetime(2024, 2, 11, 13, 23, 57)),
+      ("naboo", "r2d2", "obi-wan naboo r2d2 2", make_dt(1)),
+      ("coruscant", "c3p0", "obi-wan coruscant c3p0 2", make_dt(1)),
+      ("mustafar", "bb8", "obi-wan mustafar bb8", make_dt(1)),
+    ]
+    assert db.session.query(ResponseLogEntry).count() == 12
+
+
+@pytest.mark.parametrize(("token", "header", "want_code"), (
+  (None, None, 403),
+  ("s3cret", None, 403),
+  ("s3cret", "wrong", 403),
+  (None, "s3cret", 403),
+  ("s3cret", "s3cret", 200),
+))
+def test_submit_batch_relay(app, client, seed_data, set_api_keys, token, header, want_code):
+  """Test that per-submission API keys are only accepted from a relay with the relay token."""
+  set_api_keys({"anakin": "abc123", "obi-wan": "deadbeef"})
+  app.config["SUBMIT_RELAY_TOKEN"] = token
+
+  res = post_batch(client, {
+    "submissions": [
+      {"api_key": "abc123", "notebook": "naboo", "responses": [{"identifier": "q1", "response": "a"}]},
+      {"api_key": "deadbeef", "notebook": "naboo", "responses": [{"identifier": "q1", "response": "b"}]},
+      {"api_key": "notdeadbeef", "notebook": "naboo", "responses": [{"identifier": "q1", "response": "c"}]},
+    ],
+  }, headers={"X-Nbforms-Relay-Token": header} if header else {})
+
+  assert res.status_code == want_code, res.data.decode()
+  with app.app_context():
+    responses = db.session.query(Response).order_by(Response.id).all()
+
+  if want_code != 200:
+    assert res.data.decode() == "per-submission API keys require a relay token"
+    assert responses == []
+    return
+
+  assert res.get_json()["results"] == [{"status": 200}, {"status": 200}, {"status": 400, "error": "no such user"}]
+  assert [(r.user_id, r.response) for r in responses] == [(1, "a"), (2, "b")]
+
+
+@pytest.mark.parametrize(("body", "want_code", "want_body"), (
+  ({}, 400, "no submissions specified"),
+  ({"api_key": "deadbeef", "submissions": {"notebook": "naboo"}}, 400, "no submissions specified"),
+  ({"api_key": "deadbeef", "submissions": [{"notebook": "naboo"}] * 3}, 413, "too many submissions"),
+))
+def test_submit_batch_invalid(app, client, seed_data, body, want_code, want_body):
+  """Test that ``/submit/batch`` rejects invalid batches."""
+  app.config["SUBMIT_BATCH_MAX_SIZE"] = 2
+  res = post_batch(client, body)
+  assert res.status_code == want_code
+  assert res.data.decode() == want_body
+
+
 @pytest.mark.parametrize(("body", "want_code", "want_body", "want_submissions"), (
   # open
   (
@@ -591,8 +708,9 @@ def test_attendance_multiple_submissions(mocked_dt, app, client, seed_attendance
   # no notebook
   ("", None, None, 400, "no notebook specified")
 ))
+@mock.patch("nbforms_server.pivot.random")
 @mock.patch("nbforms_server.models.random")
-def test_data(mocked_random, client, seed_responses, notebook, questions, user_hashes, want_code, want_body):
+def test_data(mocked_random, mocked_pivot_random, client, seed_responses, notebook, questions, user_hashes, want_code, want_body):
   """Test the ``/data`` route."""
   body = {"notebook": notebook}
   if questions is not None:
@@ -607,7 +725,265 @@ def test_data(mocked_random, client, seed_responses, notebook, questions, user_h
   )
 
   assert res.status_code == want_code
+  # streamed responses have no content length
+  assert ("Content-Length" in res.headers) == (want_code != 200)
   assert res.data.decode() == want_body
 
   # check that output rows were (or in this case would have been) shuffled
-  if user_hashes: mocked_random.shuffle.assert_called()
+  if user_hashes: mocked_pivot_random.shuffle.assert_called()
+
+
+@pytest.mark.parametrize(("accept_encoding", "compression", "want_encoding"), (
+  ("gzip, deflate", True, "gzip"),
+  ("gzip, zstd", True, "zstd"),
+  ("gzip", False, None),
+  (None, True, None),
+))
+def test_data_compression(app, client, seed_responses, decompress, accept_encoding, compression, want_encoding):
+  """Test that ``/data`` compresses the CSV with the encoding negotiated with the client."""
+  if want_encoding == "zstd":
+    pytest.importorskip("zstandard")
+
+  app.config["DATA_COMPRESSION"] = compression
+
+  def get_data(headers):
+    return client.get(
+      "/data",
+      data = json.dumps({"notebook": "naboo"}),
+      content_type = "application/json",
+      headers = headers,
+    )
+
+  plain = get_data({})
+  res = get_data({"Accept-Encoding": accept_encoding} if accept_encoding else {})
+  assert res.status_code == 200
+  assert res.content_encoding == want_encoding
+  assert ("Accept-Encoding" in res.vary) == compression
+  if want_encoding:
+    assert decompress(res.data, want_encoding) == plain.data
+    assert res.get_etag()[0] == f"{plain.get_etag()[0]}-{want_encoding}"
+  else:
+    assert res.data == plain.data
+
+  res = get_data({"Accept-Encoding": accept_encoding or "", "If-None-Match": f'"{res.get_etag()[0]}"'})
+  assert res.status_code == 304
+
+
+@pytest.mark.parametrize(("fmt", "accept_encoding", "want_code", "want_mimetype", "want_encoding"), (
+  ("ndjson", None, 200, "application/x-ndjson", None),
+  ("ndjson", "gzip", 200, "application/x-ndjson", "gzip"),
+  ("arrow", "gzip", 200, "application/vnd.apache.arrow.stream", "gzip"),
+  # Parquet files are already compressed
+  ("parquet", "gzip", 200, "application/vnd.apache.parquet", None),
+  ("xlsx", None, 400, None, None),
+))
+def test_data_format(client, seed_responses, decompress, fmt, accept_encoding, want_code, want_mimetype, want_encoding):
+  """Test the ``format`` parameter of the ``/data`` route."""
+  if fmt in {"arrow", "parquet"}:
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+
+  res = client.get(
+    "/data",
+    data = json.dumps({"notebook": "naboo", "questions": ["r2d2"], "format": fmt}),
+    content_type = "application/json",
+    headers = {"Accept-Encoding": accept_encoding} if accept_encoding else {},
+  )
+
+  assert res.status_code == want_code
+  if want_code != 200:
+    assert res.data.decode() == f"unsupported format: {fmt}"
+    return
+
+  assert res.mimetype == want_mimetype
+  assert res.content_encoding == want_encoding
+  assert res.get_etag()[0].endswith(f"-{fmt}" + (f"-{want_encoding}" if want_encoding else ""))
+
+  data = decompress(res.data, want_encoding) if want_encoding else res.data
+  want_rows = [{"r2d2": "anakin naboo r2d2"}, {"r2d2": "obi-wan naboo r2d2"}]
+  if fmt == "ndjson":
+    assert [json.loads(l) for l in data.decode().splitlines()] == want_rows
+  else:
+    table = pq.read_table(pa.BufferReader(data)) if fmt == "parquet" else pa.ipc.open_stream(data).read_all()
+    assert table.to_pylist() == want_rows
+
+
+@pytest.mark.parametrize(("since", "want_code", "want_body"), (
+  (
+    "2024-02-11T15:30:00",
+    200,
+    dedent("""\
+      c3p0,r2d2
+      anakin naboo c3p0,anakin naboo r2d2
+      obi-wan naboo c3p0,obi-wan naboo r2d2
+    """),
+  ),
+  ("2024-02-12T00:00:00", 200, "c3p0,r2d2\n"),
+  ("yesterday", 400, "invalid since timestamp: yesterday"),
+))
+def test_data_since(client, seed_responses, since, want_code, want_body):
+  """Test the ``since`` parameter of the ``/data`` route."""
+  res = client.get(
+    "/data",
+    data = json.dumps({"notebook": "naboo", "since": since}),
+    content_type = "application/json",
+  )
+
+  assert res.status_code == want_code
+  assert res.data.decode() == want_body
+  if want_code == 200:
+    assert res.headers["X-Latest-Timestamp"] == "2024-02-11T17:23:57"
+
+
+@mock.patch("nbforms_server.dt", wraps=dt)
+def test_data_since_window(mocked_dt, app, client, seed_responses):
+  """Test that ``X-Latest-Timestamp`` lags by ``DATA_SINCE_WINDOW`` to cover late commits."""
+  mocked_dt.datetime.now.return_value = dt.datetime(2024, 2, 11, 17, 24, 27)
+
+  res = client.get("/data", data=json.dumps({"notebook": "naboo"}), content_type="application/json")
+  assert res.status_code == 200
+  assert "jarjar naboo r2d2" not in res.data.decode()
+  assert res.headers["X-Latest-Timestamp"] == "2024-02-11T17:23:27"
+
+  # a response received before the export but committed after it
+  with app.app_context():
+    record_responses(db.session, 3, 1, [("r2d2", "jarjar naboo r2d2", dt.datetime(2024, 2, 11, 17, 23, 30))])
+    db.session.commit()
+
+  res = client.get(
+    "/data",
+    data = json.dumps({"notebook": "naboo", "since": res.headers["X-Latest-Timestamp"]}),
+    content_type = "application/json",
+  )
+  assert res.status_code == 200
+  assert res.data.decode() == dedent("""\
+    c3p0,r2d2
+    jarjar naboo c3p0,jarjar naboo r2d2
+    obi-wan naboo c3p0,obi-wan naboo r2d2
+  """)
+
+
+@pytest.mark.parametrize(("body", "want_code", "want_body"), (
+  (
+    {"notebook": "coruscant"},
+    200,
+    {
+      "responses": 3,
+      "last_updated": "2024-02-11T20:23:57",
+      "questions": {
+        "bb2": {"responses": 1, "distinct_answers": 1, "answers": [["jarjar coruscant bb2", 1]]},
+        "c3p0": {
+          "responses": 2,
+          "distinct_answers": 2,
+          "answers": [["anakin coruscant c3p0", 1], ["obi-wan coruscant c3p0", 1]],
+        },
+      },
+    },
+  ),
+  (
+    {"notebook": "coruscant", "questions": ["c3p0"], "max_answers": 1},
+    200,
+    {
+      "responses": 2,
+      "last_updated": "2024-02-11T20:23:57",
+      "questions": {"c3p0": {"responses": 2, "distinct_answers": 2, "answers": [["anakin coruscant c3p0", 1]]}},
+    },
+  ),
+  # nonexistent notebook
+  (
+    {"notebook": "mustafar", "questions": ["c3p0"]},
+    200,
+    {"responses": 0, "last_updated": None, "questions": {"c3p0": {"responses": 0, "distinct_answers": 0, "answers": []}}},
+  ),
+  ({"notebook": "naboo", "max_answers": -1}, 400, "invalid max_answers: -1"),
+  ({"notebook": "naboo", "max_answers": "1"}, 400, "invalid max_answers: 1"),
+  ({}, 400, "no notebook specified"),
+))
+def test_stats(client, seed_responses, body, want_code, want_body):
+  """Test the ``/stats`` route."""
+  res = client.get("/stats", data=json.dumps(body), content_type="application/json")
+
+  assert res.status_code == want_code
+  if want_code == 200:
+    assert res.get_json() == want_body
+  else:
+    assert res.data.decode() == want_body
+
+
+def test_stats_answer_order(client, seed_data, set_api_keys):
+  """Test that ``/stats`` sends each histogram most common answer first."""
+  set_api_keys({"anakin": "a", "obi-wan": "b", "jarjar": "c", "leia": "d", "noauth_han": "e"})
+  for key, answer in [("a", "zebra"), ("b", "apple"), ("c", "zebra"), ("d", "mango"), ("e", "zebra")]:
+    res = client.post("/submit", data=json.dumps({
+      "api_key": key,
+      "notebook": "naboo",
+      "responses": [{"identifier": "q1", "response": answer}],
+    }), content_type="application/json")
+    assert res.status_code == 200
+
+  res = client.get("/stats", data=json.dumps({"notebook": "naboo"}), content_type="application/json")
+  assert res.status_code == 200
+  assert '"answers":[["zebra",3],["apple",1],["mango",1]]' in res.data.decode().replace(" ", "").replace("\n", "")
+
+
+@pytest.mark.parametrize("ttl", (0, 60))
+def test_stats_cache(app, client, seed_responses, set_api_keys, ttl):
+  """Test that ``/stats`` only serves cached statistics if ``STATS_CACHE_TTL`` is set."""
+  app.config["STATS_CACHE_TTL"] = ttl
+  response_stats.init_app(app)
+  set_api_keys({"leia": "abc123"})
+
+  def get_responses():
+    res = client.get("/stats", data=json.dumps({"notebook": "naboo"}), content_type="application/json")
+    assert res.status_code == 200
+    return res.get_json()["responses"]
+
+  assert get_responses() == 6
+
+  res = client.post("/submit", data=json.dumps({
+    "api_key": "abc123",
+    "notebook": "naboo",
+    "responses": [{"identifier": "r2d2", "response": "leia naboo r2d2"}],
+  }), content_type="application/json")
+  assert res.status_code == 200
+
+  assert get_responses() == (6 if ttl else 7)
+
+
+def test_metrics(app, client, seed_responses, set_api_keys):
+  """Test that ``/metrics`` reports the requests handled and their SQL statements and commits."""
+  set_api_keys({"leia": "abc123"})
+
+  res = client.post("/submit", data=json.dumps({
+    "api_key": "abc123",
+    "notebook": "naboo",
+    "responses": [{"identifier": "r2d2", "response": "leia naboo r2d2"}],
+  }), content_type="application/json")
+  assert res.status_code == 200
+
+  # streamed responses are recorded once they are closed
+  with client.get("/data", data=json.dumps({"notebook": "naboo"}), content_type="application/json") as res:
+    assert res.status_code == 200
+    res.get_data()
+
+  res = client.get("/metrics")
+  assert res.status_code == 200
+  assert res.content_type == "text/plain; version=0.0.4; charset=utf-8"
+
+  lines = res.get_data(as_text=True).splitlines()
+  assert 'nbforms_requests_total{route="/submit",method="POST",status="200"} 1' in lines
+  assert 'nbforms_requests_total{route="/data",method="GET",status="200"} 1' in lines
+  assert 'nbforms_request_duration_seconds_count{route="/submit",method="POST",status="200"} 1' in lines
+  assert 'nbforms_db_commit_duration_seconds_count{route="/submit"} 1' in lines
+  assert 'nbforms_request_sql_statements_count{route="/data"} 1' in lines
+  assert 'nbforms_request_sql_statements_bucket{route="/data",le="0"} 0' in lines
+
+  # the API key was looked up once, and the notebook once before it was cached
+  assert 'nbforms_cache_size{cache="api_keys"} 1' in lines
+  assert 'nbforms_cache_misses_total{cache="api_keys"} 1' in lines
+  assert 'nbforms_cache_hits_total{cache="api_keys"} 0' in lines
+  assert 'nbforms_cache_size{cache="notebooks"} 1' in lines
+
+  app.config["METRICS"] = False
+  server_metrics.init_app(app)
+  assert client.get("/metrics").status_code == 404
@@ -0,0 +1,151 @@
+"""Tests for ``nbforms_server.bridge``"""
+
+import asyncio
+import json
+import pytest
+
+from unittest import mock
+
+from nbforms_server.bridge import AsgiApp, make_environ
+from nbforms_server.passwords import password_pool
+
+
+def call_asgi(asgi_app, scope, messages):
+  """
+  Call an ASGI app with ``scope``, feeding it ``messages`` and returning the messages it sends.
+  """
+  received = list(messages)
+  sent = []
+
+  async def receive():
+    return received.pop(0)
+
+  async def send(message):
+    sent.append(message)
+
+  asyncio.run(asgi_app(scope, receive, send))
+  return sent
+
+
+def make_scope(method, path, query_string=b"", headers=()):
+  return {
+    "type": "http",
+    "http_version": "1.1",
+    "method": method,
+    "scheme": "http",
+    "path": path,
+    "root_path": "",
+    "query_string": query_string,
+    "headers": list(headers),
+    "server": ("testserver", 8000),
+    "client": ("127.0.0.1", 54321),
+  }
+
+
+def request(asgi_app, method, path, body=None, query_string=b""):
+  """
+  Make a request to an ASGI app, returning the status, headers, and body. The body is sent in two
+  chunks to exercise reading a body over several messages.
+  """
+  data = json.dumps(body).encode() if body is not None else b""
+  headers = [(b"content-type", b"application/json"), (b"content-length", str(len(data)).encode())]
+  sent = call_asgi(asgi_app, make_scope(method, path, query_string, headers), [
+    {"type": "http.request", "body": data[:5], "more_body": True},
+    {"type": "http.request", "body": data[5:], "more_body": False},
+  ])
+
+  assert sent[0]["type"] == "http.response.start"
+  assert all(m["type"] == "http.response.body" for m in sent[1:])
+  assert sent[-1]["more_body"] is False
+  return sent[0]["status"], dict(sent[0]["headers"]), b"".join(m["body"] for m in sent[1:])
+
+
+def test_make_environ():
+  """Test ``nbforms_server.bridge.make_environ``."""
+  scope = make_scope("GET", "/data", b"notebook=naboo", [
+    (b"content-type", b"application/json"),
+    (b"accept", b"text/csv"),
+    (b"accept", b"text/plain"),
+  ])
+  environ = make_environ(scope, b"{}")
+
+  assert environ["REQUEST_METHOD"] == "GET"
+  assert environ["PATH_INFO"] == "/data"
+  assert environ["QUERY_STRING"] == "notebook=naboo"
+  assert environ["CONTENT_TYPE"] == "application/json"
+  assert environ["CONTENT_LENGTH"] == "2"
+  assert environ["HTTP_ACCEPT"] == "text/csv,text/plain"
+  assert (environ["SERVER_NAME"], environ["SERVER_PORT"]) == ("testserver", "8000")
+  assert environ["REMOTE_ADDR"] == "127.0.0.1"
+  assert environ["wsgi.input"].read() == b"{}"
+
+
+def test_requests(app, seed_data):
+  """Test that ``AsgiApp`` serves the same API as the Flask app."""
+  asgi_app = AsgiApp(app)
+
+  status, _, api_key = request(asgi_app, "POST", "/auth", {"username": "anakin", "password": "skywalker"})
+  assert status == 200
+
+  status, _, body = request(asgi_app, "POST", "/submit", {
+    "api_key": api_key.decode(),
+    "notebook": "naboo",
+    "responses": [{"identifier": "q1", "response": "a"}, {"identifier": "q2", "response": "b"}],
+  })
+  assert (status, body) == (200, b"ok")
+
+  status, headers, body = request(asgi_app, "GET", "/data", {"notebook": "naboo"})
+  assert status == 200
+  assert headers[b"content-type"] == b"text/csv; charset=utf-8"
+  assert body.decode().splitlines() == ["q1,q2", "a,b"]
+
+  status, _, body = request(asgi_app, "POST", "/submit", {"api_key": "nope", "notebook": "naboo", "responses": [{}]})
+  assert (status, body) == (400, b"no such user")
+
+  status, _, _ = request(asgi_app, "GET", "/nonexistent")
+  assert status == 404
+
+
+@pytest.mark.parametrize(("threads", "max_queue", "want_exc"), (
+  (32, 16, None),
+  (8, 4, None),
+  (8, 5, ValueError("The password pool allows 8 operations in flight")),
+  (4, 16, ValueError("The password pool allows 19 operations in flight")),
+))
+def test_password_pool_threads(app, threads, max_queue, want_exc):
+  """Test that ``AsgiApp`` rejects password pools that could occupy all of its threads."""
+  app.config.update({"ASGI_THREADS": threads, "PASSWORD_POOL_SIZE": 3, "PASSWORD_POOL_MAX_QUEUE": max_queue})
+  password_pool.init_app(app)
+  if want_exc is not None:
+    with pytest.raises(type(want_exc), match=str(want_exc)):
+      AsgiApp(app)
+  else:
+    AsgiApp(app)
+
+
+def test_disconnect(app):
+  """Test that ``AsgiApp`` doesn't handle a request if the client disconnects before sending it."""
+  asgi_app = AsgiApp(app)
+  with mock.patch.object(app, "wsgi_app") as mocked_wsgi_app:
+    sent = call_asgi(asgi_app, make_scope("POST", "/submit"), [{"type": "http.disconnect"}])
+
+  assert sent == []
+  mocked_wsgi_app.assert_not_called()
+
+
+@mock.patch("nbforms_server.bridge.write_behind")
+def test_lifespan(mocked_write_behind, app):
+  """Test that ``AsgiApp`` handles the lifespan protocol and drains the write-behind queue."""
+  sent = call_asgi(AsgiApp(app), {"type": "lifespan"}, [
+    {"type": "lifespan.startup"},
+    {"type": "lifespan.shutdown"},
+  ])
+
+  assert sent == [{"type": "lifespan.startup.complete"}, {"type": "lifespan.shutdown.complete"}]
+  mocked_write_behind.shutdown.assert_called_once()
+
+
+def test_unsupported_scope(app):
+  """Test that ``AsgiApp`` rejects unsupported scope types."""
+  with pytest.raises(ValueError, match="Unsupported ASGI scope type: websocket"):
+    call_asgi(AsgiApp(app), {"type": "websocket"}, [])
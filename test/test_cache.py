@@ -0,0 +1,207 @@
+"""Tests for ``nbforms_server.cache``"""
+
+import json
+import pytest
+
+from sqlalchemy import select
+from unittest import mock
+
+from nbforms_server.cache import api_keys, CachedNotebook, CachedUser, LRUCache, notebooks
+from nbforms_server.models import (
+  bump_cache_generation,
+  db,
+  find_user_by_api_key,
+  find_users_by_api_keys,
+  get_cache_generation,
+  Notebook,
+  NOTEBOOKS_GENERATION,
+  resolve_notebook,
+  resolve_notebooks,
+  User,
+  USERS_GENERATION,
+)
+
+
+def test_lru_cache():
+  """Test the LRU behavior of ``nbforms_server.cache.LRUCache``."""
+  cache = LRUCache(maxsize=2)
+  cache.put("a", 1)
+  cache.put("b", 2)
+  assert cache.get("a") == 1
+
+  # "b" is now the least recently used entry
+  cache.put("c", 3)
+  assert cache.get("b") is None
+  assert cache.get("a") == 1
+  assert cache.get("c") == 3
+  assert cache.stats() == {"size": 2, "maxsize": 2, "hits": 3, "misses": 1}
+
+  cache.invalidate("a")
+  assert cache.get("a") is None
+
+  cache.clear()
+  assert len(cache) == 0
+  assert cache.stats() == {"size": 0, "maxsize": 2, "hits": 0, "misses": 0}
+
+
+@mock.patch("nbforms_server.cache.time")
+def test_lru_cache_ttl(mocked_time):
+  """Test that entries in ``nbforms_server.cache.LRUCache`` expire."""
+  mocked_time.monotonic.return_value = 100
+  cache = LRUCache(ttl=10)
+  cache.put("a", 1)
+
+  mocked_time.monotonic.return_value = 109
+  assert cache.get("a") == 1
+
+  mocked_time.monotonic.return_value = 110
+  assert cache.get("a") is None
+  assert len(cache) == 0
+
+
+def test_lru_cache_disabled():
+  """Test that an ``nbforms_server.cache.LRUCache`` with a max size of 0 caches nothing."""
+  cache = LRUCache(maxsize=0)
+  cache.put("a", 1)
+  assert cache.get("a") is None
+
+
+def test_lru_cache_sync():
+  """Test the generation handling of ``nbforms_server.cache.LRUCache``."""
+  cache = LRUCache()
+  cache.sync(1)
+  cache.put("a", 1, 1)
+  cache.sync(1)
+  assert cache.get("a") == 1
+
+  cache.sync(2)
+  assert cache.get("a") is None
+
+  # values read under an old generation are discarded
+  cache.put("a", 1, 1)
+  assert cache.get("a") is None
+
+
+@pytest.mark.parametrize("shared", (False, True))
+def test_find_user_by_api_key(app, seed_data, set_api_keys, shared):
+  """Test ``nbforms_server.models.find_user_by_api_key``."""
+  set_api_keys({"obi-wan": "deadbeef"})
+  api_keys.shared = shared
+
+  with app.app_context():
+    assert find_user_by_api_key(db.session, "deadbeef") == CachedUser(2, "obi-wan", None)
+    assert find_user_by_api_key(db.session, "notdeadbeef") is None
+
+    # change the key behind the cache's back; the cached user should still be returned
+    db.session.execute(User.__table__.update().values(api_key=None))
+    assert find_user_by_api_key(db.session, "deadbeef") == CachedUser(2, "obi-wan", None)
+    assert api_keys.stats()["hits"] == 1
+
+    # bumping the generation (as another process would) should only invalidate the shared cache
+    bump_cache_generation(db.session, USERS_GENERATION)
+    assert find_user_by_api_key(db.session, "deadbeef") == (None if shared else CachedUser(2, "obi-wan", None))
+
+
+def test_find_users_by_api_keys(app, seed_data, set_api_keys):
+  """Test ``nbforms_server.models.find_users_by_api_keys``."""
+  set_api_keys({"anakin": "abc123", "obi-wan": "deadbeef"})
+
+  with app.app_context():
+    assert find_user_by_api_key(db.session, "deadbeef") == CachedUser(2, "obi-wan", None)
+    assert find_users_by_api_keys(db.session, ["abc123", "deadbeef", "notdeadbeef", "abc123"]) == {
+      "abc123": CachedUser(1, "anakin", None),
+      "deadbeef": CachedUser(2, "obi-wan", None),
+    }
+    assert api_keys.stats()["hits"] == 1
+
+    # the users that were looked up are now cached
+    assert find_user_by_api_key(db.session, "abc123") == CachedUser(1, "anakin", None)
+    assert api_keys.stats()["hits"] == 2
+
+
+@mock.patch("nbforms_server.models.random")
+def test_auth_invalidates_api_key(mocked_random, app, client, seed_data, set_api_keys):
+  """Test that rotating a user's API key with ``/auth`` invalidates the old one."""
+  set_api_keys({"anakin": "deadbeef"})
+  mocked_random.randbytes.return_value = b"\xfe\xed\xbe\xef"
+
+  with app.app_context():
+    assert find_user_by_api_key(db.session, "deadbeef") is not None
+    generation = get_cache_generation(db.session, USERS_GENERATION)
+
+  res = client.post(
+    "/auth",
+    data = json.dumps({"username": "anakin", "password": "skywalker"}),
+    content_type = "application/json",
+  )
+  assert res.status_code == 200
+
+  with app.app_context():
+    assert find_user_by_api_key(db.session, "deadbeef") is None
+    assert find_user_by_api_key(db.session, "feedbeef") == CachedUser(1, "anakin", None)
+    assert get_cache_generation(db.session, USERS_GENERATION) == generation + 1
+
+  res = client.post(
+    "/submit",
+    data = json.dumps({"api_key": "deadbeef", "notebook": "naboo", "responses": [{"identifier": "q1"}]}),
+    content_type = "application/json",
+  )
+  assert res.status_code == 400
+  assert res.data.decode() == "no such user"
+
+
+def test_resolve_notebook(app, seed_data):
+  """Test ``nbforms_server.models.resolve_notebook``."""
+  with app.app_context():
+    assert resolve_notebook(db.session, "coruscant") == CachedNotebook(2, "coruscant", True)
+    assert resolve_notebook(db.session, "coruscant") == CachedNotebook(2, "coruscant", True)
+    assert notebooks.stats()["hits"] == 1
+
+    assert resolve_notebook(db.session, "mustafar", create=False) is None
+    assert resolve_notebook(db.session, "mustafar") == CachedNotebook(4, "mustafar", False)
+    db.session.commit()
+
+    # newly created notebooks are only cached once they have been read back from the DB
+    assert "mustafar" not in notebooks._entries
+    assert resolve_notebook(db.session, "mustafar") == CachedNotebook(4, "mustafar", False)
+    assert "mustafar" in notebooks._entries
+
+
+def test_resolve_notebooks(app, seed_data, dialect_insert):
+  """Test ``nbforms_server.models.resolve_notebooks``."""
+  with app.app_context():
+    assert resolve_notebook(db.session, "naboo") == CachedNotebook(1, "naboo", False)
+    assert resolve_notebooks(db.session, ["coruscant", "mustafar"], create=False) == {
+      "coruscant": CachedNotebook(2, "coruscant", True),
+    }
+
+    assert resolve_notebooks(db.session, ["naboo", "coruscant", "mustafar", "endor", "mustafar"]) == {
+      "naboo": CachedNotebook(1, "naboo", False),
+      "coruscant": CachedNotebook(2, "coruscant", True),
+      "mustafar": CachedNotebook(4, "mustafar", False),
+      "endor": CachedNotebook(5, "endor", False),
+    }
+    db.session.commit()
+
+    assert sorted(db.session.scalars(select(Notebook.identifier))) == ["coruscant", "endor", "mustafar", "naboo", "tatooine"]
+    assert "coruscant" in notebooks._entries
+    assert "mustafar" not in notebooks._entries
+
+
+def test_resolve_notebook_fresh(app, seed_data):
+  """Test that ``nbforms_server.models.resolve_notebook`` picks up attendance state changes."""
+  with app.app_context():
+    assert resolve_notebook(db.session, "coruscant", fresh=True).attendance_open is True
+    generation = get_cache_generation(db.session, NOTEBOOKS_GENERATION)
+
+    # close attendance the way the CLI does
+    nb = db.session.query(Notebook).filter_by(identifier="coruscant").first()
+    nb.attendance_open = False
+    db.session.add(nb)
+    db.session.commit()
+
+    assert get_cache_generation(db.session, NOTEBOOKS_GENERATION) == generation + 1
+
+    # the stale entry is still used when freshness isn't required
+    assert resolve_notebook(db.session, "coruscant").attendance_open is True
+    assert resolve_notebook(db.session, "coruscant", fresh=True).attendance_open is False
@@ -2,15 +2,29 @@
 
 import click
 import datetime as dt
+import json
 import pytest
 import runpy
 import sys
 
 from click.testing import CliRunner, Result
+from concurrent.futures import ProcessPoolExecutor
 from textwrap import dedent
 from unittest import mock
 
-from nbforms_server.models import AttendanceSubmission, db, Notebook, Response, User
+from nbforms_server import create_app
+from nbforms_server.models import (
+  AttendanceSubmission,
+  db,
+  get_cache_generation,
+  Notebook,
+  record_responses,
+  Response,
+  RESPONSES_GENERATION,
+  ResponseLogEntry,
+  User,
+  USERS_GENERATION,
+)
 
 
 def assert_cli_result(result: Result, expect_error, want_stdout=None, want_exc=None):
@@ -130,6 +144,7 @@ class TestClear:
 
     with app.app_context():
       assert len(db.session.query(Response).all()) == (0 if want_clear else 9)
+      assert len(db.session.query(ResponseLogEntry).all()) == (0 if want_clear else 9)
       assert len(db.session.query(AttendanceSubmission).all()) == (0 if want_clear else 4)
 
   @pytest.mark.parametrize(("username", "force", "confirm", "want_clear", "want_exc"), (
@@ -156,19 +171,25 @@ class TestClear:
     """Test the ``clear user`` command."""
     with app.app_context():
       seed_usernames = [u.username for u in db.session.query(User).all()]
+      generation = get_cache_generation(db.session, USERS_GENERATION)
 
     res = run_cli(["clear", "user", username] + (["--force"] if force else []), input=confirm)
     assert_cli_result(res, username not in seed_usernames, None, want_exc)
 
     if username in seed_usernames:
       with app.app_context():
-        res, sub = (
+        res, log, sub = (
           db.session.query(Response).join(User).filter(User.username == username).all(),
+          db.session.query(ResponseLogEntry).join(User).filter(User.username == username).all(),
           db.session.query(AttendanceSubmission).join(User).filter(User.username == username).all(),
         )
         assert len(res) == (0 if want_clear else 3)
+        assert len(log) == (0 if want_clear else 3)
         assert len(sub) == (0 if want_clear else 1)
 
+        # check that API key caches in other processes were invalidated
+        assert get_cache_generation(db.session, USERS_GENERATION) == generation + want_clear
+
   @pytest.mark.parametrize(("notebook", "force", "confirm", "want_clear", "want_exc"), (
     ("naboo", False, "", False, None),
     ("naboo", False, "n", False, None),
@@ -199,11 +220,13 @@ class TestClear:
 
     if notebook in seed_notebooks:
       with app.app_context():
-        res, sub = (
+        res, log, sub = (
           db.session.query(Response).join(Notebook).filter(Notebook.identifier == notebook).all(),
+          db.session.query(ResponseLogEntry).join(Notebook).filter(Notebook.identifier == notebook).all(),
           db.session.query(AttendanceSubmission).join(Notebook).filter(Notebook.identifier == notebook).all(),
         )
         assert len(res) == (0 if want_clear else 6)
+        assert len(log) == (0 if want_clear else 6)
         assert len(sub) == (0 if want_clear else 4)
 
 
@@ -285,6 +308,94 @@ class TestReports:
       with open(dest) as f:
         assert f.read() == want_csv
 
+  @pytest.mark.parametrize("encoding", ("gzip", "zstd"))
+  def test_responses_compress(self, run_cli, seed_responses, decompress, encoding):
+    """Test the ``--compress`` option of the ``reports responses`` command."""
+    if encoding == "zstd":
+      pytest.importorskip("zstandard")
+
+    res = run_cli(["reports", "responses", "naboo", "out.csv", "--compress", encoding])
+    assert_cli_result(res, False, "", None)
+
+    with open("out.csv", "rb") as f:
+      assert decompress(f.read(), encoding).decode() == dedent("""\
+        user,c3p0,r2d2
+        anakin,anakin naboo c3p0,anakin naboo r2d2
+        jarjar,jarjar naboo c3p0,
+        leia,leia naboo c3p0,
+        obi-wan,obi-wan naboo c3p0,obi-wan naboo r2d2
+      """)
+
+  @pytest.mark.parametrize(("args", "want_csv"), (
+    (
+      ["naboo", "out.csv"],
+      dedent(f"""\
+        id,username,question,response,timestamp
+        1,anakin,c3p0,anakin naboo c3p0,{dt.datetime(2024, 2, 11, 12, 23, 57)}
+        10,anakin,c3p0,anakin naboo c3p0 2,{dt.datetime(2024, 2, 20, 1, 0)}
+        5,anakin,r2d2,anakin naboo r2d2,{dt.datetime(2024, 2, 11, 16, 23, 57)}
+        3,jarjar,c3p0,jarjar naboo c3p0,{dt.datetime(2024, 2, 11, 14, 23, 57)}
+        4,leia,c3p0,leia naboo c3p0,{dt.datetime(2024, 2, 11, 15, 23, 57)}
+        2,obi-wan,c3p0,obi-wan naboo c3p0,{dt.datetime(2024, 2, 11, 13, 23, 57)}
+        6,obi-wan,r2d2,obi-wan naboo r2d2,{dt.datetime(2024, 2, 11, 17, 23, 57)}
+      """),
+    ),
+    (
+      ["naboo", "out.csv", "--user", "anakin"],
+      dedent(f"""\
+        id,username,question,response,timestamp
+        1,anakin,c3p0,anakin naboo c3p0,{dt.datetime(2024, 2, 11, 12, 23, 57)}
+        10,anakin,c3p0,anakin naboo c3p0 2,{dt.datetime(2024, 2, 20, 1, 0)}
+        5,anakin,r2d2,anakin naboo r2d2,{dt.datetime(2024, 2, 11, 16, 23, 57)}
+      """),
+    ),
+  ))
+  def test_history(self, app, run_cli, seed_responses, args, want_csv):
+    """Test the ``reports history`` command."""
+    with app.app_context():
+      record_responses(db.session, 1, 1, [("c3p0", "anakin naboo c3p0 2", dt.datetime(2024, 2, 20, 1, 0))])
+      db.session.commit()
+
+    res = run_cli(["reports", "history", *args])
+    assert_cli_result(res, False, "", None)
+
+    with open("out.csv") as f:
+      assert f.read() == want_csv
+
+  @pytest.mark.parametrize(("args", "want_csv"), (
+    (
+      ["naboo", "out.csv"],
+      dedent("""\
+        question,responses,answer,count
+        c3p0,4,anakin naboo c3p0,1
+        c3p0,4,jarjar naboo c3p0,1
+        c3p0,4,leia naboo c3p0,1
+        c3p0,4,obi-wan naboo c3p0,1
+        r2d2,3,anakin naboo r2d2,2
+        r2d2,3,obi-wan naboo r2d2,1
+      """),
+    ),
+    (
+      ["naboo", "out.csv", "--max-answers", "1"],
+      dedent("""\
+        question,responses,answer,count
+        c3p0,4,anakin naboo c3p0,1
+        r2d2,3,anakin naboo r2d2,2
+      """),
+    ),
+  ))
+  def test_stats(self, app, run_cli, seed_responses, args, want_csv):
+    """Test the ``reports stats`` command."""
+    with app.app_context():
+      record_responses(db.session, 3, 1, [("r2d2", "anakin naboo r2d2", dt.datetime(2024, 2, 20, 1, 0))])
+      db.session.commit()
+
+    res = run_cli(["reports", "stats", *args])
+    assert_cli_result(res, False, "", None)
+
+    with open("out.csv") as f:
+      assert f.read() == want_csv
+
   @pytest.mark.parametrize(("notebook", "dest", "want_error", "want_csv_stdout", "want_exc"), (
     # no notebook should error
     ("", None, True, None, None),
@@ -312,6 +423,151 @@ class TestReports:
       with open(dest) as f:
         assert f.read() == want_csv
 
+  @pytest.mark.parametrize("fmt", ("ndjson", "parquet"))
+  def test_attendance_format(self, run_cli, seed_attendance_submissions, fmt):
+    """Test the ``--format`` option of the ``reports attendance`` command."""
+    if fmt == "parquet":
+      pq = pytest.importorskip("pyarrow.parquet")
+
+    res = run_cli(["reports", "attendance", "naboo", "out", "--format", fmt])
+    assert_cli_result(res, False, "", None)
+
+    if fmt == "ndjson":
+      with open("out") as f:
+        rows = [json.loads(l) for l in f]
+      timestamp = "2024-02-11T12:23:57"
+    else:
+      rows = pq.read_table("out").to_pylist()
+      timestamp = dt.datetime(2024, 2, 11, 12, 23, 57)
+
+    assert len(rows) == 4
+    assert rows[0] == {
+      "id": 1,
+      "user id": 1,
+      "username": "anakin",
+      "notebook": "naboo",
+      "timestamp": timestamp,
+      "was_open": False,
+    }
+
+
+class TestSnapshot:
+  """Tests for the ``snapshot`` group."""
+
+  @pytest.fixture
+  def file_app(self, tmp_path):
+    """
+    A fixture that provides an app backed by a SQLite database file and used by the CLI.
+    """
+    with mock.patch("nbforms_server.os"):
+      app = create_app({"TESTING": True, "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'nbforms.db'}"})
+
+    with mock.patch("nbforms_server.__main__.create_app", return_value=app):
+      yield app
+
+  def test_create_restore(self, file_app, run_cli):
+    """Test taking a snapshot with ``snapshot create`` and restoring it with ``snapshot restore``."""
+    with file_app.app_context():
+      db.session.add(Notebook(identifier="naboo"))
+      db.session.commit()
+
+    res = run_cli(["snapshot", "create", "snapshot.db"])
+    assert_cli_result(res, False, "Wrote snapshot to snapshot.db\n", None)
+    assert "MB/s" in res.stderr
+
+    # an existing snapshot is only overwritten with --force
+    res = run_cli(["snapshot", "create", "snapshot.db"])
+    assert_cli_result(res, True, None, ValueError("snapshot.db already exists; use --force to overwrite it"))
+    assert_cli_result(run_cli(["snapshot", "create", "snapshot.db", "--force"]), False)
+
+    with file_app.app_context():
+      db.session.add(Notebook(identifier="tatooine"))
+      db.session.commit()
+      generation = get_cache_generation(db.session, RESPONSES_GENERATION)
+
+    res = run_cli(["snapshot", "restore", "snapshot.db"], input="n")
+    assert_cli_result(res, False)
+    assert res.stdout.endswith("snapshot restore aborted\n")
+    with file_app.app_context():
+      assert db.session.query(Notebook).count() == 2
+
+    res = run_cli(["snapshot", "restore", "snapshot.db", "--force"])
+    assert_cli_result(res, False, "Restored snapshot from snapshot.db\n", None)
+    with file_app.app_context():
+      assert [nb.identifier for nb in db.session.query(Notebook).all()] == ["naboo"]
+      assert get_cache_generation(db.session, RESPONSES_GENERATION) > generation
+
+  def test_in_memory(self, run_cli):
+    """Test that the ``snapshot`` commands reject in-memory databases."""
+    res = run_cli(["snapshot", "create", "snapshot.db"])
+    assert_cli_result(res, True, None, ValueError("Snapshots are only supported for SQLite database files"))
+
+
+class TestProfile:
+  """Tests for the ``profile`` group."""
+
+  def test_summarize(self, run_cli):
+    """Test the ``profile summarize`` command."""
+    def record(route, duration, notebook, statement):
+      return json.dumps({
+        "timestamp": "2024-02-20T12:00:00",
+        "route": route,
+        "method": "GET",
+        "status": 200,
+        "notebook": notebook,
+        "responses": 10,
+        "duration_ms": duration,
+        "phases": {"handler_ms": duration / 2, "stream_ms": duration / 2, "sql_ms": duration / 4, "commit_ms": 0},
+        "sql_statements": 1,
+        "slowest_sql": [{"statement": statement, "ms": duration / 4}],
+      })
+
+    with open("slow.jsonl", "w") as f:
+      f.write("\n".join([
+        record("/data", 2000, "naboo", "SELECT 1"),
+        record("/data", 4000, "tatooine", "SELECT 2"),
+        record("/stats", 1500, "naboo", "SELECT 1"),
+      ]))
+
+    res = run_cli(["profile", "summarize", "slow.jsonl", "--top", "2"])
+    assert_cli_result(res, False)
+    lines = res.stdout.splitlines()
+    assert lines[1].split() == ["/data", "GET", "2", "2000.0", "4000.0", "4000.0", "750.0", "0.0", "1500.0"]
+    assert lines[2].split() == ["/stats", "GET", "1", "1500.0", "1500.0", "1500.0", "375.0", "0.0", "750.0"]
+    assert "notebook=tatooine" in lines[5]
+    assert "notebook=naboo" in lines[6]
+    assert len([l for l in lines if l.startswith("  ") and "notebook=" in l]) == 2
+    assert lines[-2].split() == ["1000.0ms", "1x", "SELECT", "2"]
+    assert lines[-1].split() == ["875.0ms", "2x", "SELECT", "1"]
+
+    res = run_cli(["profile", "summarize", "slow.jsonl", "--route", "/auth"])
+    assert_cli_result(res, False, "No slow requests\n", None)
+
+
+@pytest.mark.parametrize(("target_ms", "want_recommendation"), (
+  (1000, "Recommended profile: high"),
+  (250, "Recommended profile: default"),
+  (150, "Recommended profile: low"),
+  (50, "No profile hashes within 50ms on this host; use 'low' and consider a larger host"),
+))
+@mock.patch("nbforms_server.__main__.PasswordHasher")
+@mock.patch("nbforms_server.__main__.time")
+def test_passwords_benchmark(mocked_time, mocked_ph, run_cli, target_ms, want_recommendation):
+  """Test the ``passwords benchmark`` command."""
+  # hashes with the low, default, and high profiles take 0.1s, 0.2s, and 0.9s resp.
+  mocked_time.perf_counter.side_effect = [0, 0.1, 0, 0.2, 0, 0.9]
+
+  res = run_cli(["passwords", "benchmark", "--repeat", "1", "--target-ms", str(target_ms)])
+  assert_cli_result(res, False, dedent(f"""\
+    profile    time_cost memory_cost parallelism median ms
+    low                2       19456           1     100.0
+    default            3       65536           4     200.0
+    high               4      262144           4     900.0
+    {want_recommendation}
+  """))
+
+  assert mocked_ph.call_count == 3
+
 
 @pytest.mark.parametrize(("csv", "want_error", "want_exc"), (
   # no csv file should error
@@ -367,3 +623,42 @@ def test_seed(mocked_ph, app, run_cli, csv, want_error, want_exc):
       for i, (u, wu) in enumerate(zip(users, want_users)):
         for k, v in wu.items():
           assert getattr(u, k) == v, f"wrong value for attribute '{k}' in user {i}"
+
+
+@mock.patch("nbforms_server.models.ph")
+def test_seed_upsert(mocked_ph, app, run_cli, seed_data):
+  """Test that the ``seed`` command updates the passwords of existing users."""
+  mocked_ph.hash.side_effect = lambda pw: f"{pw} (but hashed)"
+
+  with open("users.csv", "w+") as f:
+    f.write("username,password\nanakin,vader\nahsoka,tano\n")
+
+  res = run_cli(["seed", "users.csv", "--batch-size", "1"])
+  assert_cli_result(res, False, "Successfully import 2 users\n", None)
+  assert "users/s" in res.stderr
+
+  with app.app_context():
+    users = {u.username: u.password_hash for u in db.session.query(User).all()}
+
+  assert len(users) == 6
+  assert users["anakin"] == "vader (but hashed)"
+  assert users["ahsoka"] == "tano (but hashed)"
+
+
+@mock.patch("nbforms_server.__main__.MIN_PARALLEL_SEED_ROWS", 2)
+def test_seed_parallel(app, run_cli):
+  """Test that the ``seed`` command hashes passwords in a process pool."""
+  with open("users.csv", "w+") as f:
+    f.write("username,password\nanakin,skywalker\nobi-wan,kenobi\njarjar,binks\n")
+
+  with mock.patch("nbforms_server.__main__.ProcessPoolExecutor", wraps=ProcessPoolExecutor) as mocked_executor:
+    res = run_cli(["seed", "users.csv", "--jobs", "2"])
+
+  assert_cli_result(res, False, "Successfully import 3 users\n", None)
+  mocked_executor.assert_called_once()
+  assert mocked_executor.call_args.args == (2,)
+
+  with app.app_context():
+    for username, password in [("anakin", "skywalker"), ("obi-wan", "kenobi"), ("jarjar", "binks")]:
+      u = db.session.query(User).filter_by(username=username).first()
+      assert u.check_password(db.session, password)
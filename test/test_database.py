@@ -0,0 +1,53 @@
+"""Tests for ``nbforms_server.database``"""
+
+import pytest
+
+from nbforms_server import create_app
+from nbforms_server.database import get_engine_options
+from nbforms_server.models import db
+
+
+POOL_CONFIG = {
+  "DATABASE_POOL_SIZE": 10,
+  "DATABASE_MAX_OVERFLOW": 20,
+  "DATABASE_POOL_TIMEOUT": 30,
+  "DATABASE_POOL_RECYCLE": None,
+  "DATABASE_POOL_PRE_PING": True,
+}
+
+
+@pytest.mark.parametrize(("config", "want_options"), (
+  # pool options are not set for SQLite
+  ({"SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:", **POOL_CONFIG}, {}),
+  (
+    {"SQLALCHEMY_DATABASE_URI": "postgresql+psycopg2://nbforms@localhost/nbforms", **POOL_CONFIG},
+    {"pool_size": 10, "max_overflow": 20, "pool_timeout": 30, "pool_pre_ping": True},
+  ),
+  # explicit engine options take precedence
+  (
+    {
+      "SQLALCHEMY_DATABASE_URI": "postgresql://nbforms@localhost/nbforms",
+      "SQLALCHEMY_ENGINE_OPTIONS": {"pool_size": 2, "echo": True},
+      **POOL_CONFIG,
+    },
+    {"pool_size": 2, "max_overflow": 20, "pool_timeout": 30, "pool_pre_ping": True, "echo": True},
+  ),
+  (
+    {"SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:", "SQLALCHEMY_ENGINE_OPTIONS": {"echo": True}},
+    {"echo": True},
+  ),
+))
+def test_get_engine_options(config, want_options):
+  """Test ``nbforms_server.database.get_engine_options``."""
+  assert get_engine_options(config) == want_options
+
+
+def test_create_app_engine_options(tmp_path):
+  """Test that ``create_app`` passes the engine options to Flask-SQLAlchemy."""
+  app = create_app({
+    "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'test.db'}",
+    "SQLALCHEMY_ENGINE_OPTIONS": {"pool_size": 3},
+  })
+  assert app.config["SQLALCHEMY_ENGINE_OPTIONS"] == {"pool_size": 3}
+  with app.app_context():
+    assert db.engine.pool.size() == 3
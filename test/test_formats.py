@@ -0,0 +1,80 @@
+"""Tests for ``nbforms_server.formats``"""
+
+import datetime as dt
+import io
+import json
+import pytest
+
+from unittest import mock
+
+from nbforms_server.formats import iter_export, iter_ndjson
+from nbforms_server.utils import to_csv
+
+
+ROWS = [
+  ["id", "username", "timestamp", "was_open", "notes"],
+  [1, "anakin", dt.datetime(2024, 2, 11, 12, 23, 57), False, None],
+  [2, "obi-wan", dt.datetime(2024, 2, 11, 13, 23, 57), True, None],
+  [3, "leia", dt.datetime(2024, 2, 11, 14, 23, 57), True, None],
+]
+
+
+def read_table(data, fmt):
+  """
+  Read an Arrow or Parquet export into a list of row dicts and a list of column types.
+  """
+  pa = pytest.importorskip("pyarrow")
+  if fmt == "parquet":
+    table = pytest.importorskip("pyarrow.parquet").read_table(io.BytesIO(data))
+  else:
+    table = pa.ipc.open_stream(data).read_all()
+  return table.to_pylist(), [str(t) for t in table.schema.types]
+
+
+def test_iter_export_csv():
+  """Test that ``nbforms_server.formats.iter_export`` produces the same CSV as ``to_csv``."""
+  assert b"".join(iter_export(iter(ROWS), "csv")).decode() == to_csv(ROWS)
+
+
+@pytest.mark.parametrize("chunk_size", (1, 1024))
+def test_iter_ndjson(chunk_size):
+  """Test ``nbforms_server.formats.iter_ndjson``."""
+  chunks = list(iter_ndjson(iter(ROWS), chunk_size))
+
+  assert len(chunks) == (3 if chunk_size == 1 else 1)
+  assert [json.loads(l) for l in b"".join(chunks).decode().splitlines()] == [
+    {"id": 1, "username": "anakin", "timestamp": "2024-02-11T12:23:57", "was_open": False, "notes": None},
+    {"id": 2, "username": "obi-wan", "timestamp": "2024-02-11T13:23:57", "was_open": True, "notes": None},
+    {"id": 3, "username": "leia", "timestamp": "2024-02-11T14:23:57", "was_open": True, "notes": None},
+  ]
+
+
+@pytest.mark.parametrize("fmt", ("arrow", "parquet"))
+@pytest.mark.parametrize("batch_size", (2, 1000))
+def test_iter_export_arrow(fmt, batch_size):
+  """Test that Arrow and Parquet exports preserve the values and types of each column."""
+  pytest.importorskip("pyarrow")
+  with mock.patch("nbforms_server.formats.ARROW_BATCH_SIZE", batch_size), \
+      mock.patch("nbforms_server.formats.PARQUET_ROW_GROUP_SIZE", batch_size):
+    chunks = list(iter_export(iter(ROWS), fmt))
+
+  assert all(chunks)
+  rows, types = read_table(b"".join(chunks), fmt)
+  assert rows == [dict(zip(ROWS[0], r)) for r in ROWS[1:]]
+  assert types == ["int64", "string", "timestamp[us]", "bool", "string"]
+
+
+@pytest.mark.parametrize("fmt", ("ndjson", "arrow", "parquet"))
+def test_iter_export_empty(fmt):
+  """Test exports with a header but no rows."""
+  data = b"".join(iter_export(iter([["a", "b"]]), fmt))
+  if fmt == "ndjson":
+    assert data == b""
+  else:
+    assert read_table(data, fmt) == ([], ["string", "string"])
+
+
+def test_iter_export_unsupported():
+  """Test that ``nbforms_server.formats.iter_export`` rejects unsupported formats."""
+  with pytest.raises(ValueError, match="Unsupported export format: xlsx"):
+    iter_export(iter(ROWS), "xlsx")
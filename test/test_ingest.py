@@ -0,0 +1,249 @@
+"""Tests for ``nbforms_server.ingest``"""
+
+import datetime as dt
+import json
+import os
+import pytest
+
+from unittest import mock
+
+from nbforms_server.ingest import (
+  AttendanceRecord,
+  dump_submission,
+  load_spool,
+  load_submission,
+  ResponseSubmission,
+  write_behind,
+  write_submissions,
+  WriteBehindQueue,
+  WriteBehindQueueFullError,
+)
+from nbforms_server.models import AttendanceSubmission, db, Notebook, Response, ResponseLogEntry, User
+
+
+@pytest.fixture
+def enable_write_behind(app, tmp_path):
+  """
+  A fixture that enables write-behind mode on the testing app, spooling to a temporary directory.
+  """
+  app.config.update({"WRITE_BEHIND": True, "WRITE_BEHIND_SPOOL_DIR": str(tmp_path)})
+  write_behind.init_app(app)
+  yield
+  write_behind.shutdown()
+
+
+def get_response_rows(app):
+  with app.app_context():
+    return sorted(
+      (r.user.username, r.notebook.identifier, r.question_identifier, r.response)
+      for r in db.session.query(Response).all())
+
+
+@pytest.mark.parametrize("submission", (
+  ResponseSubmission(1, 2, [("q1", "a", dt.datetime(2024, 2, 20, 1)), ("q2", "b", dt.datetime(2024, 2, 20, 2))]),
+  AttendanceRecord(1, 2, dt.datetime(2024, 2, 20, 3), True),
+))
+def test_dump_load_submission(submission):
+  """Test that ``dump_submission`` and ``load_submission`` round-trip submissions."""
+  line = dump_submission(submission)
+  assert "\n" not in line
+  assert load_submission(line) == submission
+
+
+def test_submit(app, client, seed_data, set_api_keys, enable_write_behind, tmp_path):
+  """Test that ``/submit`` and ``/attendance`` queue submissions in write-behind mode."""
+  set_api_keys({"anakin": "abc123", "obi-wan": "def456"})
+  for key, response in [("abc123", "a"), ("def456", "b"), ("abc123", "c")]:
+    res = client.post("/submit", data=json.dumps({
+      "api_key": key,
+      "notebook": "endor",
+      "responses": [{"identifier": "q1", "response": response}],
+    }), content_type="application/json")
+    assert res.status_code == 200
+
+  res = client.post("/attendance", data=json.dumps({"api_key": "def456", "notebook": "coruscant"}), content_type="application/json")
+  assert res.status_code == 200
+
+  write_behind.flush()
+  assert get_response_rows(app) == [
+    ("anakin", "endor", "q1", "c"),
+    ("obi-wan", "endor", "q1", "b"),
+  ]
+  with app.app_context():
+    assert [e.response for e in db.session.query(ResponseLogEntry).order_by(ResponseLogEntry.id)] == ["a", "b", "c"]
+    subms = db.session.query(AttendanceSubmission).all()
+    assert [(s.user.username, s.notebook.identifier, s.was_open) for s in subms] == [("obi-wan", "coruscant", True)]
+
+  stats = write_behind.stats()
+  assert (stats["queue_depth"], stats["written"], stats["failed"]) == (0, 4, 0)
+
+  write_behind.shutdown()
+  assert os.listdir(tmp_path) == []
+
+
+def test_submit_queue_full(app, client, seed_data, set_api_keys, enable_write_behind):
+  """Test that ``/submit`` asks clients to retry when the write-behind queue is full."""
+  set_api_keys({"anakin": "abc123"})
+  write_behind.retry_after = 3
+  with mock.patch.object(write_behind, "put", side_effect=WriteBehindQueueFullError()):
+    res = client.post("/submit", data=json.dumps({
+      "api_key": "abc123",
+      "notebook": "naboo",
+      "responses": [{"identifier": "q1", "response": "a"}],
+    }), content_type="application/json")
+
+  assert res.status_code == 503
+  assert res.headers["Retry-After"] == "3"
+  assert res.data.decode() == "server busy"
+
+
+def test_submit_batch(app, client, seed_data, set_api_keys, enable_write_behind):
+  """Test that ``/submit/batch`` queues submissions in write-behind mode."""
+  set_api_keys({"anakin": "abc123"})
+  body = json.dumps({
+    "api_key": "abc123",
+    "submissions": [
+      {"notebook": "naboo", "responses": [{"identifier": "q1", "response": "a"}]},
+      {"notebook": "endor", "responses": [{"identifier": "q1", "response": "b"}]},
+    ],
+  })
+
+  res = client.post("/submit/batch", data=body, content_type="application/json")
+  assert res.status_code == 200
+  assert res.get_json() == {"results": [{"status": 200}, {"status": 200}]}
+
+  write_behind.flush()
+  assert get_response_rows(app) == [("anakin", "endor", "q1", "b"), ("anakin", "naboo", "q1", "a")]
+
+  # once the queue fills up, the remaining submissions are rejected
+  with mock.patch.object(write_behind, "put", side_effect=[None, WriteBehindQueueFullError()]):
+    res = client.post("/submit/batch", data=body, content_type="application/json")
+  assert res.status_code == 200
+  assert res.get_json() == {"results": [{"status": 200}, {"status": 503, "error": "server busy"}]}
+
+  # if nothing could be queued, the client is asked to retry
+  with mock.patch.object(write_behind, "put", side_effect=WriteBehindQueueFullError()):
+    res = client.post("/submit/batch", data=body, content_type="application/json")
+  assert res.status_code == 503
+  assert res.data.decode() == "server busy"
+
+
+def test_put_full(app):
+  """Test that ``WriteBehindQueue.put`` raises an error once the queue is full."""
+  app.config.update({"WRITE_BEHIND": True, "WRITE_BEHIND_MAX_QUEUE": 2})
+  q = WriteBehindQueue()
+  q.init_app(app)
+
+  # don't start the writer, so that nothing is drained from the queue
+  with mock.patch("nbforms_server.ingest.threading.Thread"):
+    q.put(AttendanceRecord(1, 1, dt.datetime.now(), True))
+    q.put(AttendanceRecord(1, 1, dt.datetime.now(), True))
+    with pytest.raises(WriteBehindQueueFullError):
+      q.put(AttendanceRecord(1, 1, dt.datetime.now(), True))
+
+  assert q.stats()["queue_depth"] == 2
+
+
+def test_spool_per_process(app, tmp_path):
+  """
+  Test that each process spools to its own file, opened by its first submission, so that workers
+  forked after the app is loaded don't share a spool.
+  """
+  app.config.update({"WRITE_BEHIND": True, "WRITE_BEHIND_SPOOL_DIR": str(tmp_path)})
+  q = WriteBehindQueue()
+  q.init_app(app)
+  assert os.listdir(tmp_path) == []
+
+  def read_spool(pid):
+    return [load_submission(l) for l in (tmp_path / f"spool-{pid}.jsonl").read_text().splitlines()]
+
+  parent, child = os.getpid(), os.getpid() + 1
+  submissions = [AttendanceRecord(i, 1, dt.datetime(2024, 2, 20, i), True) for i in range(1, 4)]
+
+  # don't start the writer, so that the spools aren't emptied
+  with mock.patch("nbforms_server.ingest.threading.Thread"):
+    q.put(submissions[0])
+    with mock.patch("nbforms_server.ingest.os.getpid", return_value=child):
+      q.put(submissions[1])
+      q.put(submissions[2])
+      assert read_spool(child) == submissions[1:]
+      q.shutdown()
+
+  # the parent's spool is left to be replayed, while the child's is removed when it shuts down
+  assert read_spool(parent) == submissions[:1]
+  assert os.listdir(tmp_path) == [f"spool-{parent}.jsonl"]
+
+
+def test_replay_spools(app, seed_data, tmp_path):
+  """Test that spool files left behind by another process are written to the DB at startup."""
+  with app.app_context():
+    user_id = db.session.query(User).filter_by(username="leia").one().id
+    notebook_id = db.session.query(Notebook).filter_by(identifier="tatooine").one().id
+
+  spool = tmp_path / "spool-1.jsonl"
+  spool.write_text("\n".join([
+    dump_submission(ResponseSubmission(user_id, notebook_id, [("q1", "a", dt.datetime(2024, 2, 20, 1))])),
+    dump_submission(ResponseSubmission(user_id, notebook_id, [("q1", "b", dt.datetime(2024, 2, 20, 2))])),
+  ]) + "\n")
+
+  app.config.update({"WRITE_BEHIND": True, "WRITE_BEHIND_SPOOL_DIR": str(tmp_path)})
+  write_behind.init_app(app)
+  try:
+    assert not spool.exists()
+    assert get_response_rows(app) == [("leia", "tatooine", "q1", "b")]
+  finally:
+    write_behind.shutdown()
+
+
+def test_replay_spools_checkpoint(app, seed_data, tmp_path):
+  """
+  Test that the submissions before a spool's last checkpoint, which were written before the process
+  exited, are not replayed.
+  """
+  app.config.update({"WRITE_BEHIND": True, "WRITE_BEHIND_SPOOL_DIR": str(tmp_path)})
+  q = WriteBehindQueue()
+  q.init_app(app)
+  submissions = [AttendanceRecord(i, 1, dt.datetime(2024, 2, 20, i), True) for i in range(1, 5)]
+
+  # write the first batches by hand, then "crash" before the rest are written
+  with mock.patch("nbforms_server.ingest.threading.Thread"):
+    for s in submissions:
+      q.put(s)
+    for batch in [submissions[:1], submissions[1:3]]:
+      q._write(batch)
+      q._checkpoint(len(batch))
+
+  q._spool.seek(0)
+  assert load_spool(q._spool) == submissions[3:]
+  q._spool.close()
+  q._spool = None
+
+  write_behind.init_app(app)
+  try:
+    assert os.listdir(tmp_path) == []
+    with app.app_context():
+      assert sorted(s.user_id for s in db.session.query(AttendanceSubmission).all()) == [1, 2, 3, 4]
+  finally:
+    write_behind.shutdown()
+
+
+def test_write_batch_failure(app, seed_data, enable_write_behind):
+  """Test that a failed batch is retried one submission at a time."""
+  submissions = [AttendanceRecord(i, 1, dt.datetime(2024, 2, 20, i), True) for i in range(1, 4)]
+
+  def write(session, batch):
+    if submissions[1] in batch:
+      raise ValueError("oops")
+    write_submissions(session, batch)
+
+  with mock.patch("nbforms_server.ingest.write_submissions", side_effect=write), \
+      mock.patch.object(write_behind, "batch_ms", 1000):
+    for s in submissions:
+      write_behind.put(s)
+    write_behind.flush()
+
+  with app.app_context():
+    assert sorted(s.user_id for s in db.session.query(AttendanceSubmission).all()) == [1, 3]
+
+  stats = write_behind.stats()
+  assert (stats["written"], stats["failed"]) == (2, 1)
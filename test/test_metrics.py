@@ -0,0 +1,136 @@
+"""Tests for ``nbforms_server.metrics``"""
+
+import os
+import pytest
+
+from textwrap import dedent
+from unittest import mock
+
+from nbforms_server.metrics import MetricDefinition, Metrics, merge_values, render_metrics
+
+
+@pytest.fixture
+def metrics():
+  """
+  A fixture that provides an enabled ``Metrics`` registry with two simple metrics.
+  """
+  definitions = {
+    "test_total": MetricDefinition("counter", "A counter.", ("kind",)),
+    "test_seconds": MetricDefinition("histogram", "A histogram.", ("kind",), (0.1, 1)),
+  }
+  with pytest.MonkeyPatch.context() as mp:
+    mp.setattr("nbforms_server.metrics.METRICS", definitions)
+    m = Metrics()
+    m.configure(True, None, 1)
+    yield m
+
+
+def test_inc_observe(metrics):
+  """Test recording counters and histograms."""
+  metrics.inc("test_total", "a")
+  metrics.inc("test_total", "a", value=2)
+  metrics.inc("test_total", "b")
+  for v in [0.05, 0.1, 0.5, 2]:
+    metrics.observe("test_seconds", v, "a")
+
+  assert metrics.values() == {
+    ("test_total", ("a",)): [3],
+    ("test_total", ("b",)): [1],
+    # the buckets are <= 0.1, <= 1, and +Inf, followed by the sum
+    ("test_seconds", ("a",)): [2, 1, 1, 2.65],
+  }
+
+  # nothing is recorded while disabled
+  metrics.enabled = False
+  metrics.inc("test_total", "a")
+  metrics.observe("test_seconds", 1, "a")
+  assert metrics.values()[("test_total", ("a",))] == [3]
+  assert metrics.values()[("test_seconds", ("a",))] == [2, 1, 1, 2.65]
+
+
+def test_render(metrics):
+  """Test rendering metrics in the Prometheus text format."""
+  metrics.inc("test_total", 'say "hi"')
+  metrics.observe("test_seconds", 0.5, "a")
+  metrics.observe("test_seconds", 0.25, "a")
+
+  assert render_metrics(metrics.values()) == dedent("""\
+    # HELP test_total A counter.
+    # TYPE test_total counter
+    test_total{kind="say \\"hi\\""} 1
+    # HELP test_seconds A histogram.
+    # TYPE test_seconds histogram
+    test_seconds_bucket{kind="a",le="0.1"} 0
+    test_seconds_bucket{kind="a",le="1"} 2
+    test_seconds_bucket{kind="a",le="+Inf"} 2
+    test_seconds_sum{kind="a"} 0.75
+    test_seconds_count{kind="a"} 2
+  """)
+
+
+def test_render_large_values(metrics):
+  """Test that counts above 1e6 are rendered exactly rather than in scientific notation."""
+  metrics.inc("test_total", "a", value=1_234_567)
+  for _ in range(1_234_567):
+    metrics.observe("test_seconds", 0.5, "a")
+
+  lines = render_metrics(metrics.values()).splitlines()
+  assert 'test_total{kind="a"} 1234567' in lines
+  assert 'test_seconds_bucket{kind="a",le="1"} 1234567' in lines
+  assert 'test_seconds_sum{kind="a"} 617283.5' in lines
+  assert 'test_seconds_count{kind="a"} 1234567' in lines
+
+
+@mock.patch.dict("nbforms_server.metrics.METRICS", {"test_size": MetricDefinition("gauge", "A gauge.", ())})
+def test_collectors(metrics):
+  """Test that collectors set gauges before the metrics are read."""
+  size = 3
+  metrics.add_collector("test", lambda m: m.set("test_size", size))
+  assert metrics.values() == {("test_size", ()): [3]}
+
+  size = 5
+  assert metrics.values() == {("test_size", ()): [5]}
+  assert render_metrics(metrics.values()).splitlines()[-3:] == [
+    "# HELP test_size A gauge.",
+    "# TYPE test_size gauge",
+    "test_size 5",
+  ]
+
+  # a collector with the same name replaces the old one
+  metrics.add_collector("test", lambda m: m.set("test_size", 1))
+  assert metrics.values() == {("test_size", ()): [1]}
+
+
+def test_merge_values():
+  """Test ``merge_values``."""
+  assert merge_values([
+    {("c", ("a",)): [1], ("h", ()): [1, 0, 0.5]},
+    {("c", ("a",)): [2], ("c", ("b",)): [4]},
+    {("h", ()): [0, 1, 3]},
+  ]) == {
+    ("c", ("a",)): [3],
+    ("c", ("b",)): [4],
+    ("h", ()): [1, 1, 3.5],
+  }
+
+
+def test_collect(metrics, tmp_path):
+  """Test that ``collect`` sums the metrics of every process writing to the metrics directory."""
+  metrics.configure(True, str(tmp_path), 1)
+  metrics.inc("test_total", "a", value=2)
+  metrics.observe("test_seconds", 0.5, "a")
+
+  # another process that has written its metrics
+  other = tmp_path / "metrics-1.json"
+  other.write_text('[["test_total", ["a"], [5]], ["test_total", ["b"], [1]]]')
+
+  assert metrics.collect() == {
+    ("test_total", ("a",)): [7],
+    ("test_total", ("b",)): [1],
+    ("test_seconds", ("a",)): [0, 1, 0, 0.5],
+  }
+  assert (tmp_path / f"metrics-{os.getpid()}.json").exists()
+
+  # files that are not valid are ignored
+  other.write_text("[[")
+  assert metrics.collect()[("test_total", ("a",))] == [2]
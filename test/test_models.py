@@ -0,0 +1,437 @@
+"""Tests for ``nbforms_server.models``"""
+
+import datetime as dt
+import pytest
+
+from sqlalchemy import delete, event, func, inspect, select, text
+from unittest import mock
+
+from nbforms_server.models import (
+  AttendanceSubmission,
+  db,
+  export_responses,
+  get_response_stats,
+  iter_responses,
+  Notebook,
+  record_responses,
+  record_submissions,
+  Response,
+  ResponseLogEntry,
+  upgrade_db,
+  upsert_responses,
+)
+
+
+def make_timestamp(hour):
+  return dt.datetime(2024, 2, 20, hour, 13, 14)
+
+
+def get_responses(app):
+  """
+  Return a list of ``(user_id, notebook_id, question_identifier, response, timestamp)`` tuples for
+  every response in the database.
+  """
+  with app.app_context():
+    return [
+      (r.user_id, r.notebook_id, r.question_identifier, r.response, r.timestamp)
+      for r in db.session.query(Response).order_by(Response.id).all()
+    ]
+
+
+def test_upsert_responses(app, seed_responses, dialect_insert):
+  """Test ``nbforms_server.models.upsert_responses``."""
+  with app.app_context():
+    upsert_responses(db.session, 2, 1, [
+      ("r2d2", "obi-wan naboo r2d2 2", make_timestamp(1)),
+      ("bb8", "obi-wan naboo bb8", make_timestamp(2)),
+      ("bb8", "obi-wan naboo bb8 2", make_timestamp(3)),
+    ])
+    db.session.commit()
+
+  responses = get_responses(app)
+  assert len(responses) == 10
+  assert (2, 1, "r2d2", "obi-wan naboo r2d2 2", make_timestamp(1)) in responses
+  assert (2, 1, "bb8", "obi-wan naboo bb8 2", make_timestamp(3)) in responses
+
+  # check that other users' responses were not touched
+  assert (1, 1, "r2d2", "anakin naboo r2d2", dt.datetime(2024, 2, 11, 16, 23, 57)) in responses
+
+
+def get_log_entries(app):
+  """
+  Return a list of ``(user_id, notebook_id, question_identifier, response, timestamp)`` tuples for
+  every entry in the response log.
+  """
+  with app.app_context():
+    return [
+      (e.user_id, e.notebook_id, e.question_identifier, e.response, e.timestamp)
+      for e in db.session.query(ResponseLogEntry).order_by(ResponseLogEntry.id).all()
+    ]
+
+
+def test_record_responses(app, seed_responses):
+  """Test ``nbforms_server.models.record_responses``."""
+  with app.app_context():
+    record_responses(db.session, 2, 1, [
+      ("r2d2", "obi-wan naboo r2d2 2", make_timestamp(1)),
+      ("bb8", "obi-wan naboo bb8", make_timestamp(2)),
+      ("bb8", "obi-wan naboo bb8 2", make_timestamp(3)),
+    ])
+    db.session.commit()
+
+  # every response is appended to the log
+  assert get_log_entries(app)[9:] == [
+    (2, 1, "r2d2", "obi-wan naboo r2d2 2", make_timestamp(1)),
+    (2, 1, "bb8", "obi-wan naboo bb8", make_timestamp(2)),
+    (2, 1, "bb8", "obi-wan naboo bb8 2", make_timestamp(3)),
+  ]
+
+  # only the latest response to each question is kept
+  responses = get_responses(app)
+  assert len(responses) == 10
+  assert (2, 1, "r2d2", "obi-wan naboo r2d2 2", make_timestamp(1)) in responses
+  assert (2, 1, "bb8", "obi-wan naboo bb8 2", make_timestamp(3)) in responses
+
+
+def test_record_submissions(app, seed_responses, dialect_insert):
+  """Test ``nbforms_server.models.record_submissions``."""
+  with app.app_context():
+    record_submissions(db.session, [
+      (2, 1, [("r2d2", "obi-wan naboo r2d2 2", make_timestamp(1))]),
+      (3, 2, [("bb8", "jarjar coruscant bb8", make_timestamp(2))]),
+      (2, 1, [("r2d2", "obi-wan naboo r2d2 3", make_timestamp(3))]),
+      (4, 1, []),
+    ])
+    db.session.commit()
+
+  # every response is appended to the log
+  assert get_log_entries(app)[9:] == [
+    (2, 1, "r2d2", "obi-wan naboo r2d2 2", make_timestamp(1)),
+    (3, 2, "bb8", "jarjar coruscant bb8", make_timestamp(2)),
+    (2, 1, "r2d2", "obi-wan naboo r2d2 3", make_timestamp(3)),
+  ]
+
+  # only the latest response to each question is kept
+  responses = get_responses(app)
+  assert len(responses) == 10
+  assert (2, 1, "r2d2", "obi-wan naboo r2d2 3", make_timestamp(3)) in responses
+  assert (3, 2, "bb8", "jarjar coruscant bb8", make_timestamp(2)) in responses
+
+
+def test_record_submissions_out_of_order(app, seed_data, dialect_insert):
+  """
+  Test that ``nbforms_server.models.record_submissions`` keeps the latest response when responses
+  are written out of order, in separate transactions or in the same batch.
+  """
+  with app.app_context():
+    record_submissions(db.session, [(1, 1, [("q1", "new", make_timestamp(11))])])
+    db.session.commit()
+    record_submissions(db.session, [(1, 1, [("q1", "old", make_timestamp(10))])])
+    db.session.commit()
+
+    record_submissions(db.session, [
+      (1, 1, [("q2", "new", make_timestamp(11))]),
+      (1, 1, [("q2", "old", make_timestamp(10))]),
+    ])
+    db.session.commit()
+
+  assert get_responses(app) == [
+    (1, 1, "q1", "new", make_timestamp(11)),
+    (1, 1, "q2", "new", make_timestamp(11)),
+  ]
+
+  # the log keeps every response in the order they were written
+  assert [e[2:4] for e in get_log_entries(app)] == [("q1", "new"), ("q1", "old"), ("q2", "new"), ("q2", "old")]
+
+
+def test_upsert_responses_batches(app, seed_data):
+  """Test that ``nbforms_server.models.upsert_responses`` splits large writes into batches."""
+  with mock.patch("nbforms_server.models.UPSERT_BATCH_SIZE", 2):
+    with app.app_context():
+      upsert_responses(db.session, 1, 1, [(f"q{i}", str(i), make_timestamp(i)) for i in range(5)])
+      db.session.commit()
+
+  assert [r[2:4] for r in get_responses(app)] == [(f"q{i}", str(i)) for i in range(5)]
+
+
+def test_upsert_responses_empty(app, seed_data):
+  """Test that ``nbforms_server.models.upsert_responses`` is a no-op for no responses."""
+  with app.app_context():
+    upsert_responses(db.session, 1, 1, [])
+    db.session.commit()
+
+  assert get_responses(app) == []
+
+
+def explain(session, stmt):
+  """
+  Return the ``EXPLAIN QUERY PLAN`` output for a statement as a single string.
+  """
+  sql = stmt.compile(session.get_bind(), compile_kwargs={"literal_binds": True})
+  return "\n".join(r[-1] for r in session.execute(text(f"EXPLAIN QUERY PLAN {sql}")))
+
+
+@pytest.mark.parametrize(("stmt", "want_index"), (
+  # export_responses
+  (
+    select(Response).where(Response.notebook_id == 1).where(Response.question_identifier.in_(["q1", "q2"])),
+    ("ix_responses_notebook_question_user", "ix_responses_notebook_question_response"),
+  ),
+  # upserts in submit
+  (
+    select(Response)
+      .where(Response.user_id == 1)
+      .where(Response.notebook_id == 1)
+      .where(Response.question_identifier == "q1"),
+    "ix_responses_user_notebook_question",
+  ),
+  # clear user
+  (delete(Response).where(Response.user_id == 1), "ix_responses_user_notebook_question"),
+  (delete(AttendanceSubmission).where(AttendanceSubmission.user_id == 1), "ix_attendance_submissions_user"),
+  # clear notebook
+  (
+    delete(Response).where(Response.notebook_id == 1),
+    ("ix_responses_notebook_question_user", "ix_responses_notebook_timestamp", "ix_responses_notebook_question_response"),
+  ),
+  (
+    delete(AttendanceSubmission).where(AttendanceSubmission.notebook_id == 1),
+    "ix_attendance_submissions_notebook_user_timestamp",
+  ),
+  # users with responses since a timestamp
+  (
+    select(Response.user_id).where(Response.notebook_id == 1).where(Response.timestamp > dt.datetime(2024, 1, 1)),
+    "ix_responses_notebook_timestamp",
+  ),
+  # response stats
+  (
+    select(Response.question_identifier, Response.response, func.count())
+      .where(Response.notebook_id == 1)
+      .group_by(Response.question_identifier, Response.response),
+    "ix_responses_notebook_question_response",
+  ),
+  # reports history
+  (
+    select(ResponseLogEntry)
+      .where(ResponseLogEntry.notebook_id == 1)
+      .order_by(ResponseLogEntry.user_id, ResponseLogEntry.question_identifier, ResponseLogEntry.id),
+    "ix_response_log_notebook_user_question",
+  ),
+  (delete(ResponseLogEntry).where(ResponseLogEntry.user_id == 1), "ix_response_log_user"),
+  (delete(ResponseLogEntry).where(ResponseLogEntry.notebook_id == 1), "ix_response_log_notebook_id"),
+  # attendance submissions for a notebook, grouped by user
+  (
+    select(AttendanceSubmission)
+      .where(AttendanceSubmission.notebook_id == 1)
+      .order_by(AttendanceSubmission.user_id, AttendanceSubmission.timestamp),
+    "ix_attendance_submissions_notebook_user_timestamp",
+  ),
+))
+def test_query_plans(app, sqlite_only, stmt, want_index):
+  """
+  Test that hot queries are answered using indexes instead of full table scans. ``want_index`` can
+  be a tuple of equally good indexes, since SQLite's choice between them is arbitrary.
+  """
+  with app.app_context():
+    plan = explain(db.session, stmt)
+
+  want_indexes = want_index if isinstance(want_index, tuple) else (want_index,)
+  assert any(f"INDEX {i}" in plan for i in want_indexes), plan
+  assert "USE TEMP B-TREE" not in plan, plan
+
+
+def test_upgrade_db(app, seed_responses, sqlite_only):
+  """Test that ``nbforms_server.models.upgrade_db`` de-duplicates responses and creates indexes."""
+  with app.app_context():
+    with db.engine.begin() as conn:
+      conn.execute(text("DROP INDEX ix_responses_user_notebook_question"))
+      conn.execute(text(
+        "INSERT INTO responses (user_id, notebook_id, question_identifier, response, timestamp) "
+        "VALUES (1, 1, 'c3p0', 'anakin naboo c3p0 2', '2024-02-20 01:13:14.000000')"
+      ))
+
+    upgrade_db(db.engine)
+
+    indexes = {ix["name"] for ix in inspect(db.engine).get_indexes("responses")}
+
+  assert "ix_responses_user_notebook_question" in indexes
+
+  responses = get_responses(app)
+  assert len(responses) == 9
+  assert (1, 1, "c3p0", "anakin naboo c3p0 2", make_timestamp(1)) in responses
+
+
+def test_upgrade_db_seeds_response_log(app, seed_responses):
+  """Test that ``nbforms_server.models.upgrade_db`` seeds an empty response log from the responses."""
+  with app.app_context():
+    db.session.query(ResponseLogEntry).delete()
+    db.session.commit()
+
+    upgrade_db(db.engine)
+
+  assert get_log_entries(app) == sorted(get_responses(app), key=lambda r: r[4])
+
+  # the log is not seeded again once it has entries
+  with app.app_context():
+    upgrade_db(db.engine)
+
+  assert len(get_log_entries(app)) == 9
+
+
+def test_upgrade_db_creates_indexes(app):
+  """Test that ``nbforms_server.models.upgrade_db`` adds indexes to tables created without them."""
+  with app.app_context():
+    with db.engine.begin() as conn:
+      for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+          conn.execute(text(f"DROP INDEX {index.name}"))
+
+    upgrade_db(db.engine)
+
+    for table in db.metadata.sorted_tables:
+      indexes = {ix["name"] for ix in inspect(db.engine).get_indexes(table.name)}
+      assert indexes == {ix.name for ix in table.indexes}
+
+
+@pytest.mark.parametrize("usernames", (False, True))
+def test_iter_responses_batches(app, seed_responses, usernames):
+  """Test that ``nbforms_server.models.iter_responses`` reads responses in batches lazily."""
+  with app.app_context():
+    nb = db.session.query(Notebook).filter_by(identifier="naboo").first()
+    want_rows, _ = export_responses(db.session, nb, [], usernames=usernames)
+
+    with mock.patch("nbforms_server.models.EXPORT_BATCH_SIZE", 1):
+      rows, err = iter_responses(db.session, nb, [], usernames=usernames)
+      assert err is None
+
+      # the header is available before any responses are read
+      assert next(rows) == want_rows[0]
+      assert list(rows) == want_rows[1:]
+
+  assert len(want_rows) == 5
+  if usernames:
+    assert [r[0] for r in want_rows] == ["user", "anakin", "jarjar", "leia", "obi-wan"]
+
+
+@pytest.mark.parametrize(("req_questions", "since", "want_rows"), (
+  (
+    [],
+    dt.datetime(2024, 2, 11, 15, 30),
+    [
+      ["user", "c3p0", "r2d2"],
+      ["anakin", "anakin naboo c3p0", "anakin naboo r2d2"],
+      ["obi-wan", "obi-wan naboo c3p0", "obi-wan naboo r2d2"],
+    ],
+  ),
+  (["c3p0"], dt.datetime(2024, 2, 11, 14, 30), [["user", "c3p0"], ["leia", "leia naboo c3p0"]]),
+  ([], dt.datetime(2024, 2, 12), [["user", "c3p0", "r2d2"]]),
+))
+def test_iter_responses_since(app, seed_responses, req_questions, since, want_rows):
+  """Test that ``nbforms_server.models.iter_responses`` only includes users with newer responses."""
+  with app.app_context():
+    nb = db.session.query(Notebook).filter_by(identifier="naboo").first()
+    rows, err = iter_responses(db.session, nb, req_questions, usernames=True, since=since)
+    assert err is None
+    assert list(rows) == want_rows
+
+
+@pytest.mark.parametrize(("notebook", "req_questions", "max_answers", "want_questions"), (
+  (
+    "naboo",
+    [],
+    None,
+    {
+      "c3p0": {
+        "responses": 4,
+        "distinct_answers": 4,
+        "answers": [
+          ["anakin naboo c3p0", 1],
+          ["jarjar naboo c3p0", 1],
+          ["leia naboo c3p0", 1],
+          ["obi-wan naboo c3p0", 1],
+        ],
+      },
+      "r2d2": {
+        "responses": 4,
+        "distinct_answers": 2,
+        "answers": [["obi-wan naboo r2d2", 3], ["anakin naboo r2d2", 1]],
+      },
+    },
+  ),
+  (
+    "naboo",
+    ["r2d2", "q1"],
+    1,
+    {
+      "q1": {"responses": 0, "distinct_answers": 0, "answers": []},
+      "r2d2": {"responses": 4, "distinct_answers": 2, "answers": [["obi-wan naboo r2d2", 3]]},
+    },
+  ),
+  (None, ["q1"], None, {"q1": {"responses": 0, "distinct_answers": 0, "answers": []}}),
+))
+def test_get_response_stats(app, seed_responses, notebook, req_questions, max_answers, want_questions):
+  """Test ``nbforms_server.models.get_response_stats``."""
+  with app.app_context():
+    for user_id in [3, 4]:
+      record_responses(db.session, user_id, 1, [("r2d2", "obi-wan naboo r2d2", make_timestamp(1))])
+    db.session.commit()
+
+    notebook_id = db.session.query(Notebook).filter_by(identifier=notebook).one().id if notebook else None
+    stats = get_response_stats(db.session, notebook_id, req_questions, max_answers=max_answers)
+
+  if notebook:
+    want_responses = sum(q["responses"] for q in want_questions.values())
+    assert stats == {"responses": want_responses, "last_updated": "2024-02-20T01:13:14", "questions": want_questions}
+  else:
+    assert stats == {"responses": 0, "last_updated": None, "questions": want_questions}
+  assert list(stats["questions"]) == sorted(want_questions)
+
+
+def test_get_response_stats_unordered(app, seed_responses):
+  """
+  Test that ``nbforms_server.models.get_response_stats`` doesn't rely on the database returning the
+  groups of its ``GROUP BY`` query in order.
+  """
+  with app.app_context():
+    execute = db.session.execute
+
+    def execute_unordered(stmt, *args, **kwargs):
+      # interleave the groups of unordered aggregates, as a hash aggregate may
+      rows = execute(stmt, *args, **kwargs).all()
+      if "GROUP BY" in str(stmt) and "ORDER BY" not in str(stmt):
+        rows = rows[::2] + rows[1::2]
+      return rows
+
+    want_stats = get_response_stats(db.session, 1, [])
+    with mock.patch.object(db.session, "execute", side_effect=execute_unordered):
+      stats = get_response_stats(db.session, 1, [])
+
+  assert {q: s["responses"] for q, s in stats["questions"].items()} == {"c3p0": 4, "r2d2": 2}
+  assert stats == want_stats
+
+
+def test_iter_responses_no_responses(app, seed_responses):
+  """Test ``nbforms_server.models.iter_responses`` for notebooks or questions with no responses."""
+  with app.app_context():
+    nb = db.session.query(Notebook).filter_by(identifier="tatooine").first()
+    assert iter_responses(db.session, nb, []) == (None, "no responses found")
+
+    nb = db.session.query(Notebook).filter_by(identifier="naboo").first()
+    assert iter_responses(db.session, nb, ["bb8"]) == (None, "no responses found")
+
+
+def test_iter_responses_queries(app, seed_responses):
+  """Test that ``nbforms_server.models.iter_responses`` does not lazy-load users."""
+  statements = []
+  def record(conn, cursor, statement, *args):
+    statements.append(statement)
+
+  with app.app_context():
+    nb = db.session.query(Notebook).filter_by(identifier="naboo").first()
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+      rows, _ = export_responses(db.session, nb, [], user_hashes=True)
+    finally:
+      event.remove(db.engine, "before_cursor_execute", record)
+
+  assert len(rows) == 5
+  assert len(statements) == 2, statements
@@ -0,0 +1,191 @@
+"""Tests for ``nbforms_server.passwords``"""
+
+import json
+import pytest
+import threading
+
+from unittest import mock
+
+from argon2 import PasswordHasher
+
+from nbforms_server.bridge import AsgiApp
+from nbforms_server.models import db, User
+from nbforms_server.passwords import (
+  ARGON2_PROFILES,
+  get_argon2_parameters,
+  password_pool,
+  PasswordPool,
+  PasswordPoolFullError,
+)
+
+from .test_bridge import request
+
+
+def test_run():
+  """Test ``nbforms_server.passwords.PasswordPool.run``."""
+  pool = PasswordPool(2)
+  assert pool.run(lambda a, b: a + b, 1, 2) == 3
+
+  with pytest.raises(ValueError, match="oops"):
+    pool.run(mock.Mock(side_effect=ValueError("oops")))
+
+  stats = pool.stats()
+  assert stats["size"] == 2
+  assert stats["in_flight"] == 0
+  assert stats["queue_depth"] == 0
+  assert stats["completed"] == 2
+  assert stats["rejected"] == 0
+  assert stats["seconds_total"] >= stats["seconds_max"] > 0
+
+
+def test_run_full():
+  """Test that ``nbforms_server.passwords.PasswordPool.run`` rejects work when the pool is full."""
+  pool = PasswordPool(1, max_queue=1)
+  started, release = threading.Event(), threading.Event()
+
+  def block():
+    started.set()
+    release.wait()
+    return "done"
+
+  results = []
+  threads = [threading.Thread(target=lambda: results.append(pool.run(block))) for _ in range(2)]
+  threads[0].start()
+  started.wait()
+  threads[1].start()
+
+  # wait for the second operation to be queued behind the first
+  while pool.stats()["in_flight"] < 2:
+    pass
+
+  assert pool.stats()["queue_depth"] == 1
+  with pytest.raises(PasswordPoolFullError):
+    pool.run(block)
+
+  release.set()
+  for t in threads:
+    t.join()
+
+  assert results == ["done", "done"]
+  assert pool.stats()["rejected"] == 1
+  assert pool.stats()["in_flight"] == 0
+
+
+def test_init_app(app):
+  """Test that ``nbforms_server.passwords.PasswordPool.init_app`` configures the pool."""
+  app.config.update({"PASSWORD_POOL_SIZE": 3, "PASSWORD_POOL_MAX_QUEUE": 5, "PASSWORD_POOL_RETRY_AFTER": 7})
+  password_pool.init_app(app)
+  assert (password_pool.size, password_pool.max_queue, password_pool.retry_after) == (3, 5, 7)
+  assert app.extensions["nbforms_password_pool"] is password_pool
+
+
+@mock.patch("nbforms_server.models.password_pool")
+def test_auth_pool_full(mocked_pool, app, client, seed_data):
+  """Test that ``/auth`` asks clients to retry when the password pool is full."""
+  mocked_pool.run.side_effect = PasswordPoolFullError()
+  password_pool.retry_after = 2
+
+  res = client.post(
+    "/auth",
+    data = json.dumps({"username": "anakin", "password": "skywalker"}),
+    content_type = "application/json",
+  )
+
+  assert res.status_code == 503
+  assert res.headers["Retry-After"] == "2"
+  assert res.data.decode() == "server busy"
+
+
+def test_auth_pool_full_asgi(app, seed_data):
+  """
+  Test that the password pool limits the hashing done by concurrent requests to one process, as
+  when serving with ``AsgiApp``.
+  """
+  app.config.update({"PASSWORD_POOL_SIZE": 1, "PASSWORD_POOL_MAX_QUEUE": 0})
+  password_pool.init_app(app)
+  asgi_app = AsgiApp(app)
+  started, release = threading.Event(), threading.Event()
+
+  def verify(*args):
+    started.set()
+    release.wait()
+    return True
+
+  results = []
+  body = {"username": "anakin", "password": "skywalker"}
+  with mock.patch("nbforms_server.models.ph") as mocked_ph:
+    mocked_ph.verify.side_effect = verify
+    mocked_ph.check_needs_rehash.return_value = False
+    thread = threading.Thread(target=lambda: results.append(request(asgi_app, "POST", "/auth", body)))
+    thread.start()
+    started.wait()
+
+    status, _, data = request(asgi_app, "POST", "/auth", body)
+    assert (status, data) == (503, b"server busy")
+
+    status, _, data = request(asgi_app, "GET", "/metrics")
+    assert status == 200
+    lines = data.decode().splitlines()
+    assert "nbforms_password_pool_size 1" in lines
+    assert "nbforms_password_pool_in_flight 1" in lines
+    assert "nbforms_password_pool_queue_depth 0" in lines
+    assert "nbforms_password_pool_rejected_total 1" in lines
+
+    release.set()
+    thread.join()
+
+  assert results[0][0] == 200
+  assert password_pool.stats()["rejected"] == 1
+
+
+@pytest.mark.parametrize(("config", "want_params", "want_exc"), (
+  ({}, ARGON2_PROFILES["default"], None),
+  ({"ARGON2_PROFILE": "low"}, ARGON2_PROFILES["low"], None),
+  (
+    {"ARGON2_PROFILE": "high", "ARGON2_MEMORY_COST": "131072"},
+    {"time_cost": 4, "memory_cost": 131072, "parallelism": 4},
+    None,
+  ),
+  ({"ARGON2_PROFILE": "extreme"}, None, ValueError("Unknown argon2 profile: extreme")),
+))
+def test_get_argon2_parameters(config, want_params, want_exc):
+  """Test ``nbforms_server.passwords.get_argon2_parameters``."""
+  if want_exc is not None:
+    with pytest.raises(type(want_exc), match=str(want_exc)):
+      get_argon2_parameters(config)
+
+  else:
+    assert get_argon2_parameters(config) == want_params
+
+
+def test_default_profile_matches_argon2():
+  """Test that the ``default`` argon2 profile matches argon2-cffi's defaults."""
+  ph = PasswordHasher()
+  assert ARGON2_PROFILES["default"] == {
+    "time_cost": ph.time_cost,
+    "memory_cost": ph.memory_cost,
+    "parallelism": ph.parallelism,
+  }
+
+
+def test_auth_rehash_on_profile_change(app, client):
+  """Test that passwords hashed with another argon2 profile are rehashed on login."""
+  old_hash = PasswordHasher(**ARGON2_PROFILES["low"]).hash("tano")
+  with app.app_context():
+    db.session.add(User(username="ahsoka", password_hash=old_hash))
+    db.session.commit()
+
+  res = client.post(
+    "/auth",
+    data = json.dumps({"username": "ahsoka", "password": "tano"}),
+    content_type = "application/json",
+  )
+  assert res.status_code == 200
+
+  with app.app_context():
+    new_hash = db.session.query(User).filter_by(username="ahsoka").first().password_hash
+
+  ph = PasswordHasher()
+  assert new_hash != old_hash
+  assert ph.verify(new_hash, "tano")
+  assert not ph.check_needs_rehash(new_hash)
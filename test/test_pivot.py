@@ -0,0 +1,271 @@
+"""Tests for ``nbforms_server.pivot``"""
+
+import datetime as dt
+import json
+import pytest
+import random
+import sys
+import threading
+import time
+
+from unittest import mock
+
+from nbforms_server.models import (
+  bump_cache_generation,
+  count_log_entries,
+  db,
+  export_responses,
+  get_latest_response_timestamp,
+  Notebook,
+  record_responses,
+  Response,
+  ResponseLogEntry,
+  RESPONSES_GENERATION,
+  User,
+)
+from nbforms_server.pivot import _log_ids_ordered, response_pivots, ResponsePivot
+
+
+EXPORT_OPTIONS = [
+  ([], False, None),
+  ([], True, None),
+  (["q1"], True, None),
+  (["q0", "q3", "q9"], False, None),
+  ([], True, dt.datetime(2024, 2, 20, 1, 25)),
+  (["q2"], True, dt.datetime(2024, 2, 20, 1, 40)),
+]
+
+
+def assert_consistent(session, pivot, notebook):
+  """
+  Assert that ``pivot`` produces the same rows as the non-cached export for every set of options.
+  """
+  pivot.refresh(session)
+  assert pivot.latest == get_latest_response_timestamp(session, notebook.id)
+  for req_questions, usernames, since in EXPORT_OPTIONS:
+    rows, err = pivot.rows(req_questions, usernames=usernames, since=since)
+    want = export_responses(session, notebook, req_questions, usernames=usernames, since=since)
+    assert (list(rows or []), err) == want
+
+
+def test_consistency(app, seed_data):
+  """Test that response pivots stay consistent with the non-cached export."""
+  rng = random.Random(42)
+  with app.app_context():
+    users = db.session.query(User).all()
+    nb = db.session.query(Notebook).filter_by(identifier="naboo").one()
+    other = db.session.query(Notebook).filter_by(identifier="tatooine").one()
+    pivot = ResponsePivot(nb.id)
+
+    for i in range(50):
+      action = rng.random()
+      user = rng.choice(users)
+      if action < 0.8:
+        record_responses(db.session, user.id, rng.choice([nb.id, other.id]), [
+          (f"q{rng.randrange(5)}", f"{user.username} {i} {j}", dt.datetime(2024, 2, 20, 1, i, j))
+          for j in range(rng.randrange(1, 4))
+        ])
+      elif action < 0.9:
+        # clear user
+        db.session.query(Response).filter_by(user_id=user.id).delete()
+        db.session.query(ResponseLogEntry).filter_by(user_id=user.id).delete()
+        bump_cache_generation(db.session, RESPONSES_GENERATION)
+      else:
+        # clear notebook
+        db.session.query(Response).filter_by(notebook_id=nb.id).delete()
+        db.session.query(ResponseLogEntry).filter_by(notebook_id=nb.id).delete()
+        bump_cache_generation(db.session, RESPONSES_GENERATION)
+
+      db.session.commit()
+      assert_consistent(db.session, pivot, nb)
+
+
+@pytest.mark.parametrize("ordered", (True, False))
+def test_refresh_incremental(app, seed_responses, ordered):
+  """Test that ``ResponsePivot.refresh`` only reads new log entries when responses are added."""
+  with app.app_context(), \
+      mock.patch("nbforms_server.pivot._log_ids_ordered", return_value=ordered):
+    nb = db.session.query(Notebook).filter_by(identifier="naboo").one()
+    pivot = ResponsePivot(nb.id)
+    pivot.refresh(db.session)
+
+    record_responses(db.session, 3, nb.id, [("r2d2", "jarjar naboo r2d2", dt.datetime(2024, 2, 20, 1))])
+    db.session.commit()
+
+    with mock.patch.object(pivot, "_rebuild", wraps=pivot._rebuild) as mocked_rebuild, \
+        mock.patch.object(pivot, "_apply_log", wraps=pivot._apply_log) as mocked_apply_log, \
+        mock.patch("nbforms_server.pivot.count_log_entries", wraps=count_log_entries) as mocked_count:
+      version = pivot.refresh(db.session)
+      assert pivot.refresh(db.session) == version
+
+    mocked_rebuild.assert_not_called()
+    mocked_apply_log.assert_called_once_with(db.session, 6, 10)
+
+    # the log is only counted when the version changes, and never if its IDs commit in order
+    if ordered:
+      mocked_count.assert_not_called()
+    else:
+      mocked_count.assert_called_once_with(db.session, nb.id, 10)
+    assert_consistent(db.session, pivot, nb)
+
+
+def test_log_ids_ordered(app):
+  """Test that ``nbforms_server.pivot._log_ids_ordered`` only trusts SQLite's log ID order."""
+  with app.app_context():
+    assert _log_ids_ordered(db.session)
+    with mock.patch.object(db.session.get_bind().dialect, "name", "postgresql"):
+      assert not _log_ids_ordered(db.session)
+
+
+def test_refresh_gap(app, seed_responses):
+  """
+  Test that ``ResponsePivot.refresh`` rebuilds the pivot if an entry is missing from the log in a DB
+  where log entries can commit out of order.
+  """
+  with app.app_context(), \
+      mock.patch("nbforms_server.pivot._log_ids_ordered", return_value=False):
+    nb = db.session.query(Notebook).filter_by(identifier="naboo").one()
+
+    # simulate a transaction that was assigned an ID before the first refresh committing after it
+    db.session.query(ResponseLogEntry).filter_by(id=5).delete()
+    db.session.commit()
+    pivot = ResponsePivot(nb.id)
+    pivot.refresh(db.session)
+
+    record_responses(db.session, 3, nb.id, [("r2d2", "jarjar naboo r2d2", dt.datetime(2024, 2, 20, 1))])
+    db.session.add(ResponseLogEntry(
+      id=5, user_id=1, notebook_id=nb.id, question_identifier="r2d2", response="anakin naboo r2d2",
+      timestamp=dt.datetime(2024, 2, 11, 16, 23, 57)))
+    db.session.commit()
+
+    with mock.patch.object(pivot, "_rebuild", wraps=pivot._rebuild) as mocked_rebuild:
+      pivot.refresh(db.session)
+
+    mocked_rebuild.assert_called_once()
+    assert_consistent(db.session, pivot, nb)
+
+
+def test_rows_streamed(app, seed_responses):
+  """Test that ``ResponsePivot.rows`` generates rows as they are consumed."""
+  with app.app_context():
+    nb = db.session.query(Notebook).filter_by(identifier="naboo").one()
+    pivot = ResponsePivot(nb.id)
+    pivot.refresh(db.session)
+
+    with mock.patch("nbforms_server.pivot.hash_username", side_effect=lambda u: f"hash {u}") as mocked_hash:
+      rows, _ = pivot.rows([], usernames=True)
+      assert next(rows) == ["user", "c3p0", "r2d2"]
+      assert next(rows) == ["anakin", "anakin naboo c3p0", "anakin naboo r2d2"]
+
+      # pseudonymized rows are all generated before the first is yielded so they can be shuffled
+      rows, _ = pivot.rows([], user_hashes=True)
+      mocked_hash.assert_not_called()
+      next(rows)
+      next(rows)
+      assert mocked_hash.call_count == 4
+
+
+def test_rows_concurrent_refresh(app):
+  """Test that ``ResponsePivot.rows`` can run while another thread refreshes the pivot."""
+  pivot = ResponsePivot(1)
+  with pivot._lock:
+    pivot._apply_log(mock.Mock(**{"execute.return_value": [
+      (u, f"user{u}", f"q{q}", "a", dt.datetime(2024, 2, 20, 1)) for u in range(5) for q in range(200)
+    ]}), 0, 0)
+
+  done = threading.Event()
+  def refresh():
+    # add a new question to every user's answers until the reader is done
+    i = 0
+    while not done.is_set():
+      i += 1
+      with pivot._lock:
+        pivot._apply_log(mock.Mock(**{"execute.return_value": [
+          (u, f"user{u}", f"new{i}", "b", dt.datetime(2024, 2, 20, 2)) for u in range(5)
+        ]}), 0, 0)
+
+  switch_interval = sys.getswitchinterval()
+  sys.setswitchinterval(1e-6)
+  thread = threading.Thread(target=refresh)
+  thread.start()
+  try:
+    deadline = time.monotonic() + 1
+    while time.monotonic() < deadline:
+      rows, err = pivot.rows([], usernames=True, since=dt.datetime(2024, 2, 20))
+      assert err is None
+      assert len(list(rows)) == 6
+  finally:
+    done.set()
+    thread.join()
+    sys.setswitchinterval(switch_interval)
+
+
+def test_get_pivot(app):
+  """Test ``nbforms_server.pivot.PivotCache.get_pivot``."""
+  pivot = response_pivots.get_pivot(1)
+  assert response_pivots.get_pivot(1) is pivot
+  assert response_pivots.get_pivot(2) is not pivot
+
+
+@pytest.mark.parametrize("cache_size", (32, 0))
+def test_data_etag(app, client, seed_responses, set_api_keys, cache_size):
+  """Test that ``/data`` returns a 304 if the responses have not changed since the ETag was sent."""
+  app.config["RESPONSE_PIVOT_CACHE_SIZE"] = cache_size
+  response_pivots.init_app(app)
+  set_api_keys({"jarjar": "abc123"})
+
+  def get_data(etag=None):
+    return client.get(
+      "/data",
+      data = json.dumps({"notebook": "naboo"}),
+      content_type = "application/json",
+      headers = {"If-None-Match": f'"{etag}"'} if etag else {},
+    )
+
+  res = get_data()
+  assert res.status_code == 200
+  etag = res.get_etag()[0]
+
+  res = get_data(etag)
+  assert res.status_code == 304
+  assert res.get_etag()[0] == etag
+  assert res.data == b""
+
+  res = client.post("/submit", data=json.dumps({
+    "api_key": "abc123",
+    "notebook": "naboo",
+    "responses": [{"identifier": "r2d2", "response": "jarjar naboo r2d2"}],
+  }), content_type="application/json")
+  assert res.status_code == 200
+
+  res = get_data(etag)
+  assert res.status_code == 200
+  assert res.get_etag()[0] != etag
+  assert "jarjar naboo c3p0,jarjar naboo r2d2" in res.data.decode()
+
+
+def test_data_latest_timestamp(app, client, seed_responses):
+  """Test that ``X-Latest-Timestamp`` does not cover responses committed after the pivot's snapshot."""
+  refresh = ResponsePivot.refresh
+
+  def refresh_then_submit(self, session):
+    version = refresh(self, session)
+    record_responses(session, 3, self.notebook_id, [("r2d2", "jarjar naboo r2d2", dt.datetime(2024, 2, 20, 1))])
+    session.commit()
+    return version
+
+  with mock.patch.object(ResponsePivot, "refresh", refresh_then_submit):
+    res = client.get("/data", data=json.dumps({"notebook": "naboo"}), content_type="application/json")
+
+  assert res.status_code == 200
+  assert "jarjar naboo r2d2" not in res.data.decode()
+  assert res.headers["X-Latest-Timestamp"] == "2024-02-11T17:23:57"
+
+  # the next delta picks up the response
+  res = client.get(
+    "/data",
+    data = json.dumps({"notebook": "naboo", "since": res.headers["X-Latest-Timestamp"]}),
+    content_type = "application/json",
+  )
+  assert "jarjar naboo r2d2" in res.data.decode()
+  assert res.headers["X-Latest-Timestamp"] == "2024-02-20T01:00:00"
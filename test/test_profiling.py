@@ -0,0 +1,178 @@
+"""Tests for ``nbforms_server.profiling``"""
+
+import json
+import os
+import pytest
+import sys
+
+from unittest import mock
+
+from nbforms_server import create_app
+from nbforms_server.bridge import AsgiApp
+from nbforms_server.metrics import _start_request_timer, server_metrics
+from nbforms_server.models import db, User
+from nbforms_server.profiling import load_slow_requests, request_profiler
+
+from .test_bridge import request
+
+
+@pytest.fixture
+def make_app(tmp_path):
+  """
+  A fixture that provides a function to create an app with profiling config values, with a user
+  whose API key is ``abc123``.
+  """
+  def do_make(**config):
+    with mock.patch("nbforms_server.os"):
+      app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": "sqlite://",
+        "PROFILE_DIR": str(tmp_path / "profiles"),
+        **config,
+      })
+
+    with app.app_context():
+      db.session.add(User(username="leia", password_hash="", api_key="abc123"))
+      db.session.commit()
+
+    return app
+
+  return do_make
+
+
+def submit(client, **kwargs):
+  res = client.post("/submit", data=json.dumps({
+    "api_key": "abc123",
+    "notebook": "naboo",
+    "responses": [{"identifier": "q1", "response": "a"}, {"identifier": "q2", "response": "b"}],
+  }), content_type="application/json", **kwargs)
+  assert res.status_code == 200
+
+
+def test_disabled(make_app):
+  """Test that the app is not instrumented if profiling and the slow-request log are disabled."""
+  app = make_app()
+  assert not request_profiler.enabled
+  assert request_profiler._before_request not in app.before_request_funcs.get(None, [])
+
+
+def test_slow_request_log(make_app, tmp_path):
+  """Test that requests slower than ``SLOW_REQUEST_MS`` are written to the slow-request log."""
+  log = tmp_path / "slow.jsonl"
+  app = make_app(SLOW_REQUEST_LOG=str(log), SLOW_REQUEST_MS=0)
+  client = app.test_client()
+
+  submit(client)
+  with client.get("/data", data=json.dumps({"notebook": "naboo"}), content_type="application/json") as res:
+    assert res.status_code == 200
+    res.get_data()
+
+  submit_record, data_record = load_slow_requests(log.read_text().splitlines())
+  assert submit_record["route"] == "/submit"
+  assert submit_record["method"] == "POST"
+  assert submit_record["status"] == 200
+  assert submit_record["notebook"] == "naboo"
+  assert submit_record["responses"] == 2
+  assert submit_record["sql_statements"] == len(submit_record["slowest_sql"]) > 0
+  assert submit_record["phases"]["commit_ms"] > 0
+  assert "profile" not in submit_record
+
+  # the export is generated while the response is streamed
+  assert data_record["route"] == "/data"
+  assert data_record["rows"] == 1
+  assert any("FROM responses" in s["statement"] for s in data_record["slowest_sql"])
+  assert data_record["duration_ms"] >= data_record["phases"]["handler_ms"] + data_record["phases"]["stream_ms"] - 0.01
+
+  # requests faster than the threshold are not logged
+  request_profiler.slow_ms = 60000
+  submit(client)
+  assert len(log.read_text().splitlines()) == 2
+
+
+@pytest.mark.parametrize("metrics", (True, False))
+def test_request_timer(make_app, tmp_path, metrics):
+  """Test that the slow-request log reads the request timer shared with the metrics registry."""
+  log = tmp_path / "slow.jsonl"
+  app = make_app(SLOW_REQUEST_LOG=str(log), SLOW_REQUEST_MS=0, METRICS=metrics)
+  assert app.before_request_funcs[None].count(_start_request_timer) == 1
+
+  submit(app.test_client())
+
+  record, = load_slow_requests(log.read_text().splitlines())
+  assert record["sql_statements"] == len(record["slowest_sql"]) > 0
+  assert record["phases"]["commit_ms"] > 0
+  if metrics:
+    sql_statements = server_metrics.values()[("nbforms_request_sql_statements", ("/submit",))]
+    assert sql_statements[-1] == record["sql_statements"]
+
+
+@pytest.mark.parametrize(("header", "want_profile"), (
+  (None, False),
+  ("wrong", False),
+  ("s3cret", True),
+))
+def test_profile_header(make_app, tmp_path, header, want_profile):
+  """Test that a request is profiled if it has the profile token in the profile header."""
+  log = tmp_path / "slow.jsonl"
+  app = make_app(SLOW_REQUEST_LOG=str(log), SLOW_REQUEST_MS=60000, PROFILE_TOKEN="s3cret")
+
+  submit(app.test_client(), headers={"X-Nbforms-Profile": header} if header else {})
+
+  records = load_slow_requests(log.read_text().splitlines()) if log.exists() else []
+  if not want_profile:
+    assert records == []
+    assert not (tmp_path / "profiles").exists()
+    return
+
+  record, = records
+  assert os.path.dirname(record["profile"]) == str(tmp_path / "profiles")
+  assert os.path.exists(record["profile"])
+  assert any("submit" in f["function"] for f in record["top_functions"])
+
+
+def test_profile_requests(make_app, tmp_path):
+  """Test that every request is profiled if ``PROFILE_REQUESTS`` is enabled."""
+  app = make_app(PROFILE_REQUESTS=True)
+  client = app.test_client()
+  submit(client)
+  submit(client)
+  assert len(os.listdir(tmp_path / "profiles")) == 2
+
+
+def test_profile_asgi(make_app, tmp_path):
+  """
+  Test that profiling a streamed response served by ``AsgiApp`` doesn't leave a profiler enabled in
+  any of the threads that the request ran in.
+  """
+  app = make_app(PROFILE_REQUESTS=True, ASGI_THREADS=2, PASSWORD_POOL_SIZE=1, PASSWORD_POOL_MAX_QUEUE=0)
+  submit(app.test_client())
+  asgi_app = AsgiApp(app)
+
+  profiles = []
+  run = asgi_app._run
+
+  async def run_and_check(fn, *args, context=None):
+    def call(*args):
+      try:
+        return fn(*args)
+      finally:
+        profiles.append(sys.getprofile())
+
+    return await run(call, *args, context=context)
+
+  with mock.patch.object(asgi_app, "_run", run_and_check):
+    status, _, body = request(asgi_app, "GET", "/data", {"notebook": "naboo", "api_key": "abc123"})
+
+  assert status == 200
+  assert body.decode().splitlines() == ["q1,q2", "a,b"]
+  assert len(profiles) > 1
+  assert profiles == [None] * len(profiles)
+  assert len(os.listdir(tmp_path / "profiles")) == 2
+
+
+def test_load_slow_requests():
+  """Test that ``load_slow_requests`` skips lines that are not valid JSON."""
+  assert load_slow_requests(['{"route": "/data"}', '{"route": "/sub', '{"route": "/submit"}']) == [
+    {"route": "/data"},
+    {"route": "/submit"},
+  ]
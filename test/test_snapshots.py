@@ -0,0 +1,188 @@
+"""Tests for ``nbforms_server.snapshots``"""
+
+import pytest
+import sqlite3
+
+from sqlalchemy import create_engine
+from unittest import mock
+
+from nbforms_server.snapshots import (
+  backup_database,
+  create_snapshot,
+  get_sqlite_path,
+  MAX_BACKUP_RESTARTS,
+  restore_snapshot,
+)
+
+
+@pytest.fixture
+def make_db(tmp_path):
+  """
+  A fixture that provides a function to create a SQLite database file with a table of ``rows``
+  rows in the given journal mode. The function returns the path to the database.
+  """
+  def do_make(name, rows, journal_mode="wal"):
+    path = str(tmp_path / name)
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+    conn.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, value TEXT)")
+    conn.executemany("INSERT INTO items (value) VALUES (?)", [("x" * 500,) for _ in range(rows)])
+    conn.close()
+    return path
+
+  return do_make
+
+
+def count_items(path):
+  conn = sqlite3.connect(path)
+  try:
+    return conn.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+  finally:
+    conn.close()
+
+
+@pytest.mark.parametrize(("url", "want_path"), (
+  ("sqlite:////srv/nbforms/nbforms.db", "/srv/nbforms/nbforms.db"),
+  ("sqlite://", None),
+  ("sqlite:///:memory:", None),
+))
+def test_get_sqlite_path(url, want_path):
+  """Test ``get_sqlite_path``."""
+  engine = create_engine(url)
+  if want_path is None:
+    with pytest.raises(ValueError, match="only supported for SQLite database files"):
+      get_sqlite_path(engine)
+  else:
+    assert get_sqlite_path(engine) == want_path
+
+  # other databases have their own backup tools
+  engine = mock.Mock()
+  engine.dialect.name = "postgresql"
+  with pytest.raises(ValueError, match="only supported for SQLite database files"):
+    get_sqlite_path(engine)
+
+
+def test_create_snapshot(make_db, tmp_path):
+  """Test that ``create_snapshot`` copies the database in steps and reports its progress."""
+  src = make_db("src.db", 1000)
+  dest = str(tmp_path / "snapshot.db")
+
+  progress = []
+  stats = create_snapshot(src, dest, pages=16, progress=progress.append)
+
+  assert count_items(dest) == 1000
+  assert not (tmp_path / "snapshot.db.tmp").exists()
+  assert stats.steps == len(progress) > 1
+  assert stats.restarts == 0
+  assert stats.bytes == (tmp_path / "snapshot.db").stat().st_size
+  assert progress[-1].copied == progress[-1].total == stats.pages
+  assert [p.copied for p in progress] == sorted(p.copied for p in progress)
+
+
+def test_create_snapshot_concurrent_writes(make_db, tmp_path):
+  """
+  Test that a snapshot of a database in WAL mode is a consistent copy of it as of the start of the
+  snapshot, and that writers are not blocked while it is taken.
+  """
+  src = make_db("src.db", 1000)
+  dest = str(tmp_path / "snapshot.db")
+
+  writer = sqlite3.connect(src, isolation_level=None, timeout=0)
+  stats = create_snapshot(
+    src, dest, pages=16, progress=lambda _: writer.execute("INSERT INTO items (value) VALUES ('y')"))
+  writer.close()
+
+  assert stats.restarts == 0
+  assert count_items(dest) == 1000
+  assert count_items(src) == 1000 + stats.steps
+
+
+def test_backup_database_restarts(make_db, tmp_path):
+  """
+  Test that ``backup_database`` gives up on a database in rollback journal mode that is written to
+  after every step, and that the partial snapshot is removed.
+  """
+  src = make_db("src.db", 1000, journal_mode="delete")
+  dest = tmp_path / "snapshot.db"
+
+  writer = sqlite3.connect(src, isolation_level=None)
+  with pytest.raises(RuntimeError, match=f"restarted {MAX_BACKUP_RESTARTS + 1} times"):
+    create_snapshot(
+      src, str(dest), pages=16, progress=lambda _: writer.execute("INSERT INTO items (value) VALUES ('y')"))
+  writer.close()
+
+  assert not dest.exists()
+  assert not (tmp_path / "snapshot.db.tmp").exists()
+
+
+def test_backup_database_pause(make_db, tmp_path):
+  """Test that ``backup_database`` pauses between steps but not after the last one."""
+  src = sqlite3.connect(make_db("src.db", 100))
+  dst = sqlite3.connect(str(tmp_path / "snapshot.db"))
+
+  with pytest.MonkeyPatch.context() as mp:
+    sleeps = []
+    mp.setattr("nbforms_server.snapshots.time.sleep", sleeps.append)
+    stats = backup_database(src, dst, pages=4, pause=0.01)
+
+  assert len(sleeps) == stats.steps - 1
+  assert set(sleeps) == {0.01}
+
+
+def test_restore_snapshot(make_db, tmp_path):
+  """Test that ``restore_snapshot`` replaces the database and advances its cache generations."""
+  live = make_db("live.db", 10)
+  snapshot = make_db("snapshot.db", 500)
+
+  conn = sqlite3.connect(live, isolation_level=None)
+  conn.execute("CREATE TABLE cache_generations (name TEXT PRIMARY KEY, generation INTEGER)")
+  conn.executemany("INSERT INTO cache_generations VALUES (?, ?)", [("users", 4), ("responses", 1)])
+  conn.close()
+
+  conn = sqlite3.connect(snapshot, isolation_level=None)
+  conn.execute("CREATE TABLE cache_generations (name TEXT PRIMARY KEY, generation INTEGER)")
+  conn.executemany("INSERT INTO cache_generations VALUES (?, ?)", [("users", 2), ("responses", 7)])
+  conn.close()
+
+  restore_snapshot(snapshot, live, pages=8)
+
+  assert count_items(live) == 500
+  conn = sqlite3.connect(live)
+  assert dict(conn.execute("SELECT name, generation FROM cache_generations")) == {"users": 5, "responses": 8}
+  conn.close()
+
+
+@pytest.mark.parametrize("journal_mode", ("wal", "delete"))
+def test_restore_snapshot_in_use(make_db, journal_mode):
+  """Test that ``restore_snapshot`` refuses to restore a database in WAL mode that is open."""
+  live = make_db("live.db", 10, journal_mode)
+  snapshot = make_db("snapshot.db", 500)
+
+  conn = sqlite3.connect(live, isolation_level=None)
+  assert conn.execute("SELECT COUNT(*) FROM items").fetchone()[0] == 10
+
+  if journal_mode == "wal":
+    with pytest.raises(RuntimeError, match="stop the server"):
+      restore_snapshot(snapshot, live)
+    assert count_items(live) == 10
+
+  conn.close()
+  restore_snapshot(snapshot, live)
+  assert count_items(live) == 500
+
+  # the restored database has the snapshot's journal mode
+  conn = sqlite3.connect(live)
+  assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+  conn.close()
+
+
+def test_restore_snapshot_corrupt(make_db, tmp_path):
+  """Test that ``restore_snapshot`` does not restore a corrupt snapshot."""
+  live = make_db("live.db", 10)
+  snapshot = tmp_path / "snapshot.db"
+  snapshot.write_bytes(b"not a database" * 1000)
+
+  with pytest.raises(sqlite3.DatabaseError):
+    restore_snapshot(str(snapshot), live)
+
+  assert count_items(live) == 10
@@ -0,0 +1,72 @@
+"""Tests for ``nbforms_server.sqlite``"""
+
+import pytest
+
+from sqlalchemy import create_engine, text
+from unittest import mock
+
+from nbforms_server import create_app
+from nbforms_server.models import db
+from nbforms_server.sqlite import configure_sqlite, get_sqlite_pragmas, SQLITE_PROFILES
+
+
+@pytest.mark.parametrize(("config", "want_pragmas", "want_exc"), (
+  ({}, {}, None),
+  ({"SQLITE_PROFILE": "fast"}, SQLITE_PROFILES["fast"], None),
+  # individual pragmas can be overridden
+  (
+    {"SQLITE_PROFILE": "safe", "SQLITE_BUSY_TIMEOUT": 100, "SQLITE_TEMP_STORE": "MEMORY"},
+    {"journal_mode": "WAL", "busy_timeout": 100, "synchronous": "FULL", "temp_store": "MEMORY"},
+    None,
+  ),
+  ({"SQLITE_PROFILE": "turbo"}, None, ValueError("Unknown SQLite profile: turbo")),
+  ({"SQLITE_SYNCHRONOUS": "OFF; DROP TABLE users"}, None, ValueError("Invalid value for SQLite pragma synchronous: OFF; DROP TABLE users")),
+))
+def test_get_sqlite_pragmas(config, want_pragmas, want_exc):
+  """Test ``nbforms_server.sqlite.get_sqlite_pragmas``."""
+  if want_exc is not None:
+    with pytest.raises(type(want_exc), match=str(want_exc)):
+      get_sqlite_pragmas(config)
+
+  else:
+    assert get_sqlite_pragmas(config) == want_pragmas
+
+
+def test_configure_sqlite(tmp_path):
+  """Test that ``nbforms_server.sqlite.configure_sqlite`` sets pragmas on new connections."""
+  engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+  configure_sqlite(engine, SQLITE_PROFILES["fast"])
+
+  with engine.connect() as conn:
+    assert conn.scalar(text("PRAGMA journal_mode")) == "wal"
+    assert conn.scalar(text("PRAGMA busy_timeout")) == 5000
+    assert conn.scalar(text("PRAGMA synchronous")) == 1
+    assert conn.scalar(text("PRAGMA cache_size")) == -64000
+    assert conn.scalar(text("PRAGMA temp_store")) == 2
+
+
+def test_configure_sqlite_other_dialect():
+  """Test that ``nbforms_server.sqlite.configure_sqlite`` ignores non-SQLite engines."""
+  engine = mock.MagicMock()
+  engine.dialect.name = "postgresql"
+  with mock.patch("nbforms_server.sqlite.event") as mocked_event:
+    configure_sqlite(engine, SQLITE_PROFILES["fast"])
+
+  mocked_event.listens_for.assert_not_called()
+
+
+@pytest.mark.parametrize(("profile", "want_journal_mode"), (
+  (None, "wal"),
+  ("default", "delete"),
+))
+def test_create_app_sqlite_profile(tmp_path, profile, want_journal_mode):
+  """Test that ``nbforms_server.create_app`` applies the SQLite profile."""
+  config = {"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'test.db'}"}
+  if profile is not None:
+    config["SQLITE_PROFILE"] = profile
+
+  with mock.patch("nbforms_server.os"):
+    app = create_app(config)
+
+  with app.app_context():
+    assert db.session.scalar(text("PRAGMA journal_mode")) == want_journal_mode
@@ -1,8 +1,70 @@
 """Tests for ``nbforms_server.utils``"""
 
-from nbforms_server.utils import get_db_path
+import pytest
+
+from unittest import mock
+from werkzeug.datastructures import Accept
+from werkzeug.http import parse_accept_header
+
+from nbforms_server.utils import compress_chunks, get_db_path, iter_csv, negotiate_encoding, to_csv
 
 
 def test_get_db_path(app):
   """Test ``nbforms_server.utils.get_db_path``."""
   assert get_db_path(app) == f"{app.instance_path}/nbforms_server.db"
+
+
+@pytest.mark.parametrize("chunk_size", (1, 10, 1024))
+def test_iter_csv(chunk_size):
+  """Test ``nbforms_server.utils.iter_csv``."""
+  rows = [["a", "b"], ["1", "foo, bar"], ["2", 'say "hi"'], ["3", ""]]
+  chunks = list(iter_csv(iter(rows), chunk_size))
+
+  assert b"".join(chunks).decode() == to_csv(rows)
+  assert all(len(c) >= chunk_size for c in chunks[:-1])
+  if chunk_size == 1024:
+    assert len(chunks) == 1
+
+
+def test_iter_csv_empty():
+  """Test ``nbforms_server.utils.iter_csv`` with no rows."""
+  assert list(iter_csv([])) == []
+
+
+@pytest.mark.parametrize(("header", "encodings", "want"), (
+  (None, ["zstd", "gzip"], None),
+  ("gzip, deflate, br", ["zstd", "gzip"], "gzip"),
+  ("gzip, deflate, br, zstd", ["zstd", "gzip"], "zstd"),
+  ("zstd;q=0.5, gzip", ["zstd", "gzip"], "gzip"),
+  ("*", ["zstd", "gzip"], "zstd"),
+  ("identity", ["zstd", "gzip"], None),
+  ("gzip;q=0", ["zstd", "gzip"], None),
+  # zstandard is not installed
+  ("zstd", ["gzip"], None),
+  ("zstd, gzip", ["gzip"], "gzip"),
+))
+def test_negotiate_encoding(header, encodings, want):
+  """Test ``nbforms_server.utils.negotiate_encoding``."""
+  with mock.patch("nbforms_server.utils.CONTENT_ENCODINGS", encodings):
+    assert negotiate_encoding(parse_accept_header(header, Accept)) == want
+
+
+@pytest.mark.parametrize("encoding", ("gzip", "zstd"))
+def test_compress_chunks(decompress, encoding):
+  """Test ``nbforms_server.utils.compress_chunks``."""
+  if encoding == "zstd":
+    pytest.importorskip("zstandard")
+
+  rows = [["user", "q1", "q2"], *([f"user{i}", "a", "b"] for i in range(10000))]
+  chunks = list(compress_chunks(iter_csv(rows, 1024), encoding))
+
+  assert all(chunks)
+  data = b"".join(chunks)
+  assert len(data) < len(to_csv(rows)) / 5
+  assert decompress(data, encoding).decode() == to_csv(rows)
+
+
+def test_compress_chunks_unsupported():
+  """Test that ``nbforms_server.utils.compress_chunks`` rejects unsupported encodings."""
+  with pytest.raises(ValueError, match="Unsupported content encoding: br"):
+    list(compress_chunks([b"a"], "br"))